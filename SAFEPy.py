@@ -2,18 +2,166 @@ import requests
 import zipfile
 import os
 import json
+import csv
+import io
 import re
 from dateutil import parser
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
-from multiprocessing import Manager, Pool, Lock, cpu_count
-from functools import partial
+import sqlite3
+import socket
+import hashlib
+import threading
+import tempfile
+import stat
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl, lock the state file with msvcrt instead
+    fcntl = None
+    import msvcrt
+import shutil
+import urllib.parse
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, cpu_count
+from functools import partial, lru_cache
 import copy
+import cProfile
+import pstats
+import tracemalloc
+from collections import Counter
+import numpy as np
 import pandas as pd
+try:
+    import pyarrow
+except ImportError:
+    # pyarrow is optional, exports are parsed with the C engine without it
+    pyarrow = None
 
 probe_url = "https://data.ntsb.gov/carol-main-public/api/Query/Main"
 file_url = "https://data.ntsb.gov/carol-main-public/api/Query/FileExport"
 
+# largest Event.ID handed out by the NTSB and the largest result count one export can safely return
+max_event_id = 200000
+max_export_count = 3500
+
+# Event.ID density histogram used to size segments before probing
+id_histogram_path = "./output/id_histogram.json"
+id_bucket_size = 400
+histogram_segment_target = 3000
+
+# columns of the summary export holding the Event.ID and the NTSB number of a case
+event_id_column = "Mkey"
+ntsb_number_column = "NtsbNo"
+
+# declared schema of the summary export, so every segment is parsed to the same dtypes
+export_schema = {
+    "NtsbNo": "string", "EventType": "category", "Mkey": "int", "EventDate": "date", "City": "string", "State": "category",
+    "Country": "category", "ReportNo": "string", "N": "string", "HasSafetyRec": "bool", "ReportType": "category",
+    "OriginalPublishDate": "date", "HighestInjuryLevel": "category", "FatalInjuryCount": "int", "SeriousInjuryCount": "int",
+    "MinorInjuryCount": "int", "ProbableCause": "string", "EventID": "string", "Latitude": "float", "Longitude": "float",
+    "Make": "string", "Model": "string", "AirCraftCategory": "category", "EngineType": "category", "AirportID": "string",
+    "AirportName": "string", "AmateurBuilt": "string", "NumberOfEngines": "string", "Scheduled": "category", "PurposeOfFlight": "category",
+    "FAR": "category", "AirCraftDamage": "category", "WeatherCondition": "category", "Operator": "string", "ReportStatus": "category",
+    "RepGenFlag": "category", "DocketUrl": "string", "DocketPublishDate": "date"
+}
+# categorical export columns whose codes are listed in possible_values.json, codes missing from it are added after the listed ones
+export_category_values = {
+    "EventType": ("Event", "EventType"), "State": ("Event", "State"), "Country": ("Event", "Country"),
+    "HighestInjuryLevel": ("Event", "HighestInjury"), "AirCraftCategory": ("Aircraft", "AircraftCategory"),
+    "EngineType": ("Aircraft", "EngineType"), "AirCraftDamage": ("Aircraft", "Damage"), "WeatherCondition": ("Weather", "AccidentSiteCondition")
+}
+# per-aircraft columns hold one value per aircraft joined with commas (e.g. "1,1" or "false,false"), so they are kept as text
+export_multi_aircraft_columns = ("AmateurBuilt", "NumberOfEngines")
+export_read_dtypes = {"string": "string", "category": "category", "int": "Int64", "float": "float64", "bool": "boolean", "date": "string"}
+
+# export formats offered by the CAROL FileExport endpoint, only the summary export has a declared schema
+export_formats = ("summary",)
+default_export_format = "summary"
+
+# materialized rollups of downloaded datasets, counts and sums of the measures over dimensions named after possible_values.json subfields
+rollup_path = "./output/rollups.sqlite"
+default_rollups = {"cases": ["year", "AircraftCategory", "EngineType", "Damage", "HasSafetyRec"]}
+rollup_measures = ["FatalInjuryCount", "SeriousInjuryCount", "MinorInjuryCount"]
+
+# compiled query rules kept in memory, keyed by the raw argument
+rule_cache_size = 4096
+
+# date pre-checks, so that only values that can be dates reach dateutil
+cond_date_pattern = re.compile(r'^(is(?:(?: on or)?(?: before| after)| not)?) (.+)+$')
+date_formats = ('%Y-%m-%d', '%m/%d/%Y', '%m-%d-%Y', '%Y/%m/%d')
+date_words = {'jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec', 'january', 'february', 'march',
+              'april', 'june', 'july', 'august', 'september', 'october', 'november', 'december', 'mon', 'tue', 'tues', 'wed', 'thu', 'thur',
+              'thurs', 'fri', 'sat', 'sun', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'}
+
+# number of segment files parsed at the same time when merging
+parse_workers = 4
+
+# earliest EventDate in the CAROL database and the date conditions that bound an EventDate window
+earliest_event_date = datetime(1962, 1, 1)
+date_bound_conditions = ["is on or after", "is after", "is on or before", "is before", "is"]
+# EventDate windows are cut to hold this share of an export, a window whose count probe fails is counted again this many times,
+# and the auto planner gives up on windows that need more probes than twice the fewest windows the query fits in, plus the margin
+date_window_fill = 0.7
+date_probe_retries = 2
+date_planner_probe_margin = 10
+
+# probe single-flight of a long running service, only valid in the process that created it
+shared_probes = None
+shared_pid = None
+
+# keyword arguments a service client may pass to query(), progress is reported in the job status instead and jobs never ask for confirmation
+service_job_kwargs = ("download", "require_all", "histogram_path", "spot_checks", "planner", "aggregated_csv_file", "refresh", "priority",
+                      "order", "profile", "export_format", "columns", "rollups")
+# job arguments naming files the service writes, which must lie inside its output directory
+service_path_kwargs = ("aggregated_csv_file", "profile", "histogram_path")
+
+# process-wide HTTP transport, one pooled session of keep-alive connections per process
+transport_pool_size = 8
+transport_connect_timeout = 10
+transport_read_timeout = 60
+transport_chunk_size = 1 << 16
+transport_prefetch = True
+transport_session = None
+transport_pid = None
+transport_lock = threading.Lock()
+
+# exports being downloaded are marked in the store, markers older than this are taken over
+export_inflight_seconds = 600
+
+# content-addressed store of raw exports
+export_store_path = "./output/store"
+
+# number of stored segments revalidated at the same time
+revalidate_workers = 4
+
+# host-wide request budget shared by every SAFEPy job, in requests per second
+rate_limits = {"probe": 0.5, "export": 0.2}
+rate_limit_burst = 3
+rate_limit_path = os.environ.get("SAFEPY_RATE_LIMIT_PATH", os.path.join(tempfile.gettempdir(), "safepy_rate_limit.json"))
+rate_limit_context = threading.local()
+# state of processes that cannot open the shared state file, which then only limits the requests of this process
+rate_limit_fallback = {}
+rate_limit_fallback_lock = threading.Lock()
+
+# shared work queue used to spread a download over several workers or hosts
+work_queue_path = "./output/work_queue.sqlite"
+work_queue_lease_seconds = 180
+
+# per-phase profiles of a query, only collected when query() is called with profile
+profile_path = "./output/profile"
+profile_context = threading.local()
+profile_top = 25
+# collapsed stacks lighter than this share of their phase, or than a microsecond, are left out
+profile_stack_resolution = 1e-4
+profile_stack_min_seconds = 1e-6
+
+# orders in which the segments of a download can be scheduled
+segment_orders = ('plan', 'newest', 'largest', 'interleaved')
+
 # Load JSON into dictionary
 f = open('possible_values.json')
 raw_json = json.load(f)
@@ -71,23 +219,526 @@ def extract_available_options(json_file_path):
     
     return available_options
 
-# multiprocessing lock init
-def init(ql, dl, fl, cl):
-    '''Initializes the locks for multiprocessing'''
+# multiprocessing worker init
+def init(job=None, priority=1.0):
+    '''Initializes the rate limit job of a pool worker'''
     
-    global query_lock
-    global download_lock
-    global file_lock
-    global complete_lock
-    query_lock = ql
-    download_lock = dl
-    file_lock = fl
-    complete_lock = cl
+    set_rate_limit_job(job, priority)
+
+def set_rate_limit_job(job=None, priority=1.0):
+    '''Sets the job and priority that requests of the current thread are charged to in the host-wide rate limiter.'''
+
+    rate_limit_context.job = str(job) if job is not None else None
+    rate_limit_context.priority = priority
+
+def configure_rate_limits(probe_rate=None, export_rate=None, burst=None, path=None):
+    '''
+    Configures the host-wide rate limiter. Rates are requests per second shared by every SAFEPy job on the host.
+    Every job on a host should use the same configuration.
+    '''
+
+    global rate_limit_burst, rate_limit_path
+    if probe_rate is not None:
+        rate_limits["probe"] = probe_rate
+    if export_rate is not None:
+        rate_limits["export"] = export_rate
+    if burst is not None:
+        rate_limit_burst = burst
+    if path is not None:
+        rate_limit_path = path
+
+def rate_limit(kind):
+    '''Blocks until the host-wide budget allows one more request of the given kind.'''
+
+    job = getattr(rate_limit_context, 'job', None) or str(os.getpid())
+    priority = getattr(rate_limit_context, 'priority', 1.0)
+    HostRateLimiter(rate_limit_path, rate_limits, rate_limit_burst).acquire(kind, job, priority)
+
+def _lock_file(file):
+    '''Takes an exclusive lock on an open file, waiting for other processes.'''
+
+    if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+
+def _unlock_file(file):
+    '''Releases the lock taken by _lock_file.'''
+
+    if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def process_alive(pid):
+    '''Returns False if no process with the given id runs on this host. Windows processes are assumed to be alive.'''
+
+    # os.kill terminates the process on Windows instead of checking it
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+class HostRateLimiter:
+    '''
+    Host-wide token bucket
+    Shares one request budget between every SAFEPy process on a host through a locked state file.
+    Waiting jobs are served in weighted fair order, so a job with priority 2 gets twice the requests of a job with priority 1.
+    '''
+    def __init__(self, path=None, rates=None, burst=None):
+        '''Initializes the HostRateLimiter class.'''
+
+        self.path = path or rate_limit_path
+        self.rates = rates or rate_limits
+        self.burst = burst or rate_limit_burst
+
+    def _open(self):
+        '''
+        Opens the state file, creating it writable by every user of the host. Returns None if it cannot be opened.
+        Symbolic links are never followed and an existing file is only used if it is a plain file with one link that is ours or shared with every user,
+        so another user cannot make this process overwrite or chmod one of its files by planting a link at the predictable path.
+        '''
+
+        flags = os.O_RDWR | getattr(os, "O_NOFOLLOW", 0)
+        fd = None
+        try:
+            for _ in range(2):
+                try:
+                    fd = os.open(self.path, flags | os.O_CREAT | os.O_EXCL, 0o666)
+                except FileExistsError:
+                    pass
+                else:
+                    # the umask strips the write permission of other users, only the file we just created is made shared
+                    try:
+                        os.fchmod(fd, 0o666)
+                    except (OSError, AttributeError):
+                        pass
+                    return os.fdopen(fd, 'r+')
+
+                try:
+                    fd = os.open(self.path, flags)
+                except FileNotFoundError:
+                    # removed after we tried to create it, create it again
+                    continue
+                info = os.fstat(fd)
+                owner = getattr(os, "getuid", lambda: info.st_uid)()
+                if not stat.S_ISREG(info.st_mode) or info.st_nlink != 1:
+                    raise OSError(f"{self.path} is not a plain file")
+                if info.st_uid != owner and not info.st_mode & stat.S_IWOTH:
+                    raise OSError(f"{self.path} belongs to another user and is not shared")
+                return os.fdopen(fd, 'r+')
+            raise OSError(f"{self.path} keeps disappearing")
+        except OSError as e:
+            if fd is not None:
+                os.close(fd)
+            if self.path not in rate_limit_fallback:
+                print(f"Warning: cannot open the rate limit state {self.path} ({e}), only this process is rate limited")
+            return None
+
+    @contextmanager
+    def _state(self):
+        '''Locks the state file and yields its state, writing it back when the block ends.'''
+
+        file = self._open()
+        if file is None:
+            with rate_limit_fallback_lock:
+                yield rate_limit_fallback.setdefault(self.path, {})
+            return
+
+        with file:
+            _lock_file(file)
+            try:
+                file.seek(0)
+                try:
+                    state = json.loads(file.read() or "{}")
+                except ValueError:
+                    state = {}
+                yield state
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps(state))
+                file.flush()
+            finally:
+                _unlock_file(file)
+
+    def acquire(self, kind, job, priority=1.0):
+        '''Blocks until a request of the given kind may be sent on behalf of a job.'''
+
+        rate = self.rates.get(kind)
+        if not rate:
+            return
+        priority = max(priority, 0.01)
+        waiter = f"{os.getpid()}-{threading.get_ident()}"
+        registered = False
+
+        while True:
+            with self._state() as state:
+                now = time.time()
+                bucket = state.setdefault(kind, {"tokens": self.burst, "updated": now, "clock": 0.0, "jobs": {}, "waiters": {}})
+
+                # refill the bucket for the time that passed
+                bucket["tokens"] = min(self.burst, bucket["tokens"] + (now - bucket["updated"]) * rate)
+                bucket["updated"] = now
+
+                # forget processes that stopped waiting without taking their turn, and jobs that went quiet
+                waiters = bucket["waiters"]
+                jobs = bucket["jobs"]
+                for key in [key for key, entry in waiters.items() if now - entry["seen"] > 10]:
+                    del waiters[key]
+                for key in [key for key, entry in jobs.items() if now - entry["seen"] > 600 and key != job]:
+                    del jobs[key]
+
+                record = jobs.setdefault(job, {"time": bucket["clock"], "priority": priority, "seen": now})
+                if not registered:
+                    # a job that was idle does not get to spend the share it did not use
+                    record["time"] = max(record["time"], bucket["clock"])
+                    registered = True
+                record["priority"] = priority
+                record["seen"] = now
+                waiters[waiter] = {"job": job, "seen": now}
+
+                # the waiting job that would finish its next request first goes next
+                waiting_jobs = {entry["job"] for entry in waiters.values() if entry["job"] in jobs}
+                next_job = min(waiting_jobs, key=lambda key: (jobs[key]["time"] + 1 / jobs[key]["priority"], key))
+                if next_job == job and bucket["tokens"] >= 1:
+                    bucket["tokens"] -= 1
+                    bucket["clock"] = record["time"]
+                    record["time"] += 1 / priority
+                    del waiters[waiter]
+                    return
+                wait = (1 - bucket["tokens"]) / rate if next_job == job else 0.05
+            time.sleep(min(max(wait, 0.01), 1.0))
+
+def configure_transport(probe=None, export=None, pool_size=None, connect_timeout=None, read_timeout=None, prefetch=None):
+    '''
+    Configures the process-wide transport. probe and export replace the CAROL URLs, e.g. to measure against a local test server.
+    Pool workers started afterwards inherit the configuration.
+    '''
+
+    global probe_url, file_url, transport_pool_size, transport_connect_timeout, transport_read_timeout, transport_prefetch, transport_session
+    if probe is not None:
+        probe_url = probe
+    if export is not None:
+        file_url = export
+    if pool_size is not None:
+        transport_pool_size = pool_size
+    if connect_timeout is not None:
+        transport_connect_timeout = connect_timeout
+    if read_timeout is not None:
+        transport_read_timeout = read_timeout
+    if prefetch is not None:
+        transport_prefetch = prefetch
+
+    # the next request builds a session with the new pool size
+    with transport_lock:
+        if transport_session is not None and transport_pid == os.getpid():
+            transport_session.close()
+        transport_session = None
+
+def get_transport():
+    '''Returns the pooled session shared by every request of this process, creating it on first use.'''
+
+    global transport_session, transport_pid
+    with transport_lock:
+        # sockets must never be shared with forked pool workers
+        if transport_session is None or transport_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=transport_pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            transport_session = session
+            transport_pid = os.getpid()
+        return transport_session
+
+def transport_timeout():
+    '''Returns the (connect, read) timeout of the transport.'''
+    return (transport_connect_timeout, transport_read_timeout)
+
+def get_shared_probes():
+    '''Returns the probe single-flight of a long running service, or None outside of the process that owns it.'''
+
+    if shared_probes is not None and shared_pid == os.getpid():
+        return shared_probes
+    return None
+
+class SingleFlight:
+    '''
+    Single-flight call group
+    Runs a call once for every group of concurrent callers asking for the same key, and optionally keeps its result for a while.
+    '''
+    def __init__(self, ttl=0):
+        '''Initializes the SingleFlight class.'''
+
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._results = {}
+
+    def do(self, key, fn):
+        '''Returns the result of fn(), sharing it with every concurrent caller using the same key.'''
+
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and time.time() - cached[0] < self.ttl:
+                return cached[1]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call["error"] is None and self.ttl:
+                    self._results[key] = (time.time(), call["result"])
+            call["done"].set()
+        return call["result"]
+
+class Profiler:
+    '''
+    Phase profiler
+    Collects cProfile statistics and tracemalloc snapshots for each phase of a query, including the segments downloaded inside pool workers.
+    Time is charged to the innermost phase only, while memory figures include the phases nested inside a phase.
+    '''
+    def __init__(self, directory=profile_path, trace_memory=True, run=None):
+        '''Initializes the Profiler class. Files dumped for a query are prefixed with its run id, a new one unless run is given.'''
+
+        self.directory = directory
+        self.trace_memory = trace_memory
+        self.run = run or f"{os.getpid()}-{time.time_ns() // 1000000}"
+        self.phases = {}
+        self._stack = []
+        os.makedirs(directory, exist_ok=True)
+
+    def _record(self, name):
+        '''Returns the accumulated record of a phase.'''
+
+        if name not in self.phases:
+            self.phases[name] = {"calls": 0, "wall": 0.0, "cpu": 0.0, "peak": 0, "allocated": 0, "allocations": Counter(), "stats": None}
+        return self.phases[name]
+
+    @contextmanager
+    def phase(self, name):
+        '''Profiles the block as one run of the named phase.'''
+
+        # only one cProfile profiler can be active at a time, so the enclosing phase pauses
+        if self._stack:
+            outer = self._stack[-1]
+            if outer["profile"] is not None:
+                outer["profile"].disable()
+            if outer["memory"]:
+                outer["peak"] = max(outer["peak"], tracemalloc.get_traced_memory()[1])
+
+        frame = {"profile": cProfile.Profile(), "memory": self.trace_memory, "peak": 0, "started_tracing": False, "snapshot": None}
+        if frame["memory"]:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                frame["started_tracing"] = True
+            tracemalloc.reset_peak()
+            frame["snapshot"] = tracemalloc.take_snapshot()
+        self._stack.append(frame)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            frame["profile"].enable()
+        except ValueError:
+            # another profiler is running in this process, keep the timings and memory only
+            frame["profile"] = None
+        try:
+            yield
+        finally:
+            if frame["profile"] is not None:
+                frame["profile"].disable()
+            record = self._record(name)
+            record["calls"] += 1
+            record["wall"] += time.perf_counter() - wall
+            record["cpu"] += time.process_time() - cpu
+            if frame["profile"] is not None:
+                try:
+                    if record["stats"] is None:
+                        record["stats"] = pstats.Stats(frame["profile"])
+                    else:
+                        record["stats"].add(frame["profile"])
+                except TypeError:
+                    # nothing was called while the phase ran
+                    pass
+
+            peak = 0
+            if frame["memory"]:
+                peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                record["peak"] = max(record["peak"], peak)
+                for stat in tracemalloc.take_snapshot().compare_to(frame["snapshot"], 'lineno')[:profile_top]:
+                    record["allocations"][str(stat.traceback)] += stat.size_diff
+                    record["allocated"] += max(stat.size_diff, 0)
+                if frame["started_tracing"]:
+                    tracemalloc.stop()
+
+            self._stack.pop()
+            if self._stack:
+                outer = self._stack[-1]
+                if outer["memory"] and tracemalloc.is_tracing():
+                    outer["peak"] = max(outer["peak"], peak)
+                    tracemalloc.reset_peak()
+                if outer["profile"] is not None:
+                    outer["profile"].enable()
+
+    def dump(self, name):
+        '''Writes the phases profiled in this process to the profile directory, so the process running the query can merge them.'''
+
+        for phase, record in self.phases.items():
+            prefix = os.path.join(self.directory, f"{self.run}-{name}-{phase}")
+            if record["stats"] is not None:
+                record["stats"].dump_stats(f"{prefix}.prof")
+            with open(f"{prefix}.json", 'w') as record_file:
+                json.dump({key: value for key, value in record.items() if key != "stats"}, record_file)
+        self.phases = {}
+
+    def collect(self, name):
+        '''Merges the phases dumped by other processes of this run under the given name prefix, removing their files.'''
+
+        for file in sorted(os.listdir(self.directory)):
+            if not file.startswith(f"{self.run}-{name}-") or not file.endswith(".json"):
+                continue
+            prefix = os.path.join(self.directory, file[:-len(".json")])
+            phase = file[:-len(".json")].rsplit("-", 1)[1]
+            with open(f"{prefix}.json") as record_file:
+                dumped = json.load(record_file)
+            record = self._record(phase)
+            for key in ("calls", "wall", "cpu", "allocated"):
+                record[key] += dumped[key]
+            record["peak"] = max(record["peak"], dumped["peak"])
+            record["allocations"].update(dumped["allocations"])
+            if os.path.exists(f"{prefix}.prof"):
+                if record["stats"] is None:
+                    record["stats"] = pstats.Stats(f"{prefix}.prof")
+                else:
+                    record["stats"].add(f"{prefix}.prof")
+                os.remove(f"{prefix}.prof")
+            os.remove(f"{prefix}.json")
+
+    def clear_stale(self):
+        '''Removes the dumps left behind by runs whose process is gone. Dumps of runs still going on are kept.'''
+
+        for file in os.listdir(self.directory):
+            pid = file.split("-", 1)[0]
+            if not file.endswith((".json", ".prof")) or not pid.isdigit() or process_alive(pid):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, file))
+            except FileNotFoundError:
+                pass
+
+    def collapsed_stacks(self, phase, stats):
+        '''
+        Derives flamegraph collapsed stacks (in microseconds) from the caller graph of a phase.
+        cProfile only records callers one level up, so the time of a function called from several places is split between them by their share of its cumulative time.
+        Branches lighter than profile_stack_resolution of the phase are not walked, which bounds the number of stacks however tangled the caller graph is.
+        '''
+
+        def frame_name(function):
+            file, line, function_name = function
+            return f"{function_name} ({os.path.basename(file)}:{line})".replace(";", ",")
+
+        callees = {}
+        for function, (_, _, _, _, callers) in stats.stats.items():
+            for caller, (_, _, _, cumulative) in callers.items():
+                callees.setdefault(caller, []).append((function, cumulative))
+
+        roots = [function for function, (_, _, _, _, callers) in stats.stats.items() if not callers]
+        # the walk carries at most the time of the roots at each depth, so the cutoff keeps it linear in the depth
+        minimum = max(profile_stack_min_seconds, profile_stack_resolution * sum(stats.stats[function][3] for function in roots))
+
+        stacks = Counter()
+        def walk(function, path, on_path, fraction, depth):
+            _, _, own, cumulative, _ = stats.stats[function]
+            stacks[path] += own * fraction
+            if depth >= 64:
+                return
+            for callee, edge in callees.get(function, []):
+                callee_cumulative = stats.stats[callee][3]
+                if callee_cumulative <= 0 or callee in on_path:
+                    continue
+                callee_fraction = fraction * min(1.0, edge / callee_cumulative)
+                if callee_cumulative * callee_fraction < minimum:
+                    continue
+                walk(callee, f"{path};{frame_name(callee)}", on_path | {callee}, callee_fraction, depth + 1)
+
+        for function in roots:
+            walk(function, f"{phase};{frame_name(function)}", frozenset([function]), 1.0, 0)
+        return [f"{path} {round(seconds * 1e6)}" for path, seconds in stacks.items() if round(seconds * 1e6) > 0]
+
+    def report(self):
+        '''Writes the merged report, the merged cProfile statistics and the collapsed stacks of every phase. Returns the path of the report.'''
+
+        report_path = os.path.join(self.directory, "profile.txt")
+        collapsed_path = os.path.join(self.directory, "profile.collapsed")
+        merged = pstats.Stats()
+        collapsed = []
+        with open(report_path, 'w') as report_file:
+            report_file.write(f"{'phase':<12}{'runs':>8}{'wall s':>12}{'cpu s':>12}{'peak MB':>12}{'allocated MB':>14}\n")
+            for phase, record in self.phases.items():
+                report_file.write(f"{phase:<12}{record['calls']:>8}{record['wall']:>12.3f}{record['cpu']:>12.3f}"
+                                  f"{record['peak'] / 2**20:>12.2f}{record['allocated'] / 2**20:>14.2f}\n")
+
+            for phase, record in self.phases.items():
+                report_file.write(f"\n===== {phase} =====\n")
+                if record["allocations"]:
+                    report_file.write("Largest allocations:\n")
+                    for line, size in record["allocations"].most_common(10):
+                        report_file.write(f"  {size / 2**10:>12.1f} KiB  {line}\n")
+                if record["stats"] is not None:
+                    record["stats"].stream = report_file
+                    record["stats"].sort_stats("cumulative").print_stats(profile_top)
+                    collapsed.extend(self.collapsed_stacks(phase, record["stats"]))
+                    merged.add(record["stats"])
+
+        if merged.stats:
+            merged.dump_stats(os.path.join(self.directory, "profile.prof"))
+        with open(collapsed_path, 'w') as collapsed_file:
+            collapsed_file.write("\n".join(collapsed) + "\n")
+
+        print(f"Profile saved to {report_path} and {collapsed_path}")
+        return report_path
+
+@contextmanager
+def profile_phase(name):
+    '''Profiles the block as a phase of the query being profiled by the current thread, if any.'''
+
+    profiler = getattr(profile_context, "profiler", None)
+    if profiler is None:
+        yield
+    else:
+        with profiler.phase(name):
+            yield
 
 class MalformedQueryError(Exception):
     '''Exception raised for errors in the input.'''
     pass
 
+class ProbeFailedError(Exception):
+    '''Exception raised when a probe returns no result count.'''
+    pass
+
 class query_keys:
     '''
     Query keys macro
@@ -95,6 +746,8 @@ class query_keys:
     '''
     fields = list(compressed_json.keys())
     subfields = [subfield for field in fields for subfield in compressed_json[field]]
+    field_set = set(fields)
+    subfield_set = set(subfields)
     conditions = set([condition for field in fields for subfield in compressed_json[field] for condition in compressed_json[field][subfield]["conditions"]])
     values = set([condition for field in fields for subfield in compressed_json[field] for condition in compressed_json[field][subfield]["values"]])
 
@@ -110,11 +763,11 @@ class CAROLQuery:
     CAROL Query class
     Builds queries using a set of rules and then probes the CAROL database to find results that match its query. Can also download the results as well.
     '''
-    def __init__(self):
+    def __init__(self, export_format=default_export_format):
         '''Initializes the CAROLQuery class.'''
         
-        # Create a session with connection pooling
-        self._session = requests.Session()
+        # Every query of a process shares the pooled connections of its transport
+        self._session = get_transport()
         self._data = compressed_json
 
         #Creates an unfinished probe with rules to be added
@@ -148,7 +801,7 @@ class CAROLQuery:
             ],
             "AndOr": "or",
             "TargetCollection": "cases",
-            "ExportFormat": "summary",
+            "ExportFormat": export_format,
             "SessionId": 100100,
             "ResultSetSize": 50,
             "SortDescending": True
@@ -168,11 +821,9 @@ class CAROLQuery:
         self._general_constraints = []
         self._values = []
         self._used_rule_sets = []
+        self._csv_file = None
+        self._probe_hash = None
         
-    def __del__(self):
-        '''Closes the session when the object is deleted.'''
-        self._session.close()
-
     def addQueryGroup(self, rule, condition, subfield, has_key_constraint):
         '''Adds a query group to the CAROLQuery class.'''
         if has_key_constraint:
@@ -277,22 +928,46 @@ class CAROLQuery:
         self._payload["QueryGroups"][0]["QueryRules"] = []
         print("Query parameters cleared!")
               
-    def query(self, download=False):
-        '''Sends a query probe to the CAROL Database.'''
+    def query(self, download=False, cached=True):
+        '''Sends a query probe to the CAROL Database. If cached is False, the probe is sent even if a long running service has a recent count.'''
+
+        # identical probes of concurrent jobs in a long running service are only sent once
+        probes = get_shared_probes()
+        if probes is not None and cached and not download:
+            try:
+                self._result_list_count, self._max_result_count_reached, self._probe_hash = probes.do(json.dumps(self._probe, sort_keys=True), self._probe_counts)
+            except ProbeFailedError:
+                # failed probes are never cached, the next identical probe is sent again
+                self._result_list_count = self._max_result_count_reached = self._probe_hash = None
+            return
+        self._send_probe(download)
+
+    def _probe_counts(self):
+        '''
+        Sends a query probe and returns its result count, whether the maximum was reached and the hash of the returned results.
+        Raises ProbeFailedError if the probe got no result count, so that the failure is not kept as a result.
+        '''
+
+        self._result_list_count = None
+        self._send_probe()
+        if self._result_list_count is None:
+            raise ProbeFailedError(f"The probe for {self._values} failed")
+        return self._result_list_count, self._max_result_count_reached, self._probe_hash
+
+    def _send_probe(self, download=False):
+        '''Sends the probe POST request.'''
 
         # Send the probe POST request
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36'}
         response = None
         try:
-            if download:
-                with query_lock:
-                    # avoids erroring concurrent api requests
-                    time.sleep(2)
+            # avoids erroring concurrent api requests from any SAFEPy job on this host
+            rate_limit("probe")
             # print query parameters currently working on
             print("Querying CAROL...")
             print(f"Query for {self._values}")
             # print(self._probe)
-            response = self._session.post(probe_url, json=self._probe, timeout=60, headers=headers)
+            response = self._session.post(probe_url, json=self._probe, timeout=transport_timeout(), headers=headers)
                 
         except requests.exceptions.Timeout:
             print("The request timed out")
@@ -319,37 +994,64 @@ class CAROLQuery:
             self._result_list_count = response_json['ResultListCount']
             self._max_result_count_reached = response_json['MaxResultCountReached']
 
+            # fingerprint the first page of results, so that changed cases are noticed even when the count stays the same
+            if response_json.get('Results') is not None:
+                self._probe_hash = hashlib.sha256(json.dumps(response_json['Results'], sort_keys=True).encode()).hexdigest()
+
             print(f'Result count: {self._result_list_count}')
             print(f'Max reached: {self._max_result_count_reached}\n')
 
-    def download(self, filenames, number_complete, total_queries):
-        '''Sends a download probe to the CAROL database.'''
+    def download(self, prefetch=None, claimed=False, expected_count=None):
+        '''
+        Sends a download probe to the CAROL database and streams the export into the store. prefetch is called once the export starts streaming.
+        claimed is True if the caller already holds the in-flight marker of the export.
+        A stored export of the same request is used instead if it holds expected_count cases, or any number of cases if expected_count is None.
+        '''
+
+        store = ExportStore(export_store_path)
+        request_hash, request = self.request_hash()
+
+        # a speculative download of the same export may already be in flight, or have finished since this query was probed
+        # another job can take the marker between waiting and acquiring, so only download once this job holds it
+        while not claimed:
+            if store.acquire(request_hash):
+                if store.get(request_hash) is None:
+                    break
+                # from_store waits on the marker, so it must not be held while reading the stored export
+                store.release(request_hash)
+                if self.from_store(expected_count):
+                    return
+                claimed = store.acquire(request_hash)
+            elif self.from_store(expected_count):
+                return
 
         # Send the file POST request
         response = None
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36'}
         try:
-            with query_lock:
-                # avoids erroring concurrent api requests
-                time.sleep(5)
-            # print dots to signify working
-            print(f"Downloading data from CAROL...")
-            response = self._session.post(file_url, json=self._payload, timeout=60, headers=headers)
-        except requests.exceptions.Timeout:
-            print("The request timed out")
-        except requests.exceptions.RequestException as e:
-            # handle other types of exceptions
-            print("An error occurred: ", e)
+            try:
+                # avoids erroring concurrent api requests from any SAFEPy job on this host
+                rate_limit("export")
+                # print dots to signify working
+                print(f"Downloading data from CAROL...")
+                response = self._session.post(file_url, json=self._payload, timeout=transport_timeout(), headers=headers, stream=True)
+            except requests.exceptions.Timeout:
+                print("The request timed out")
+            except requests.exceptions.RequestException as e:
+                # handle other types of exceptions
+                print("An error occurred: ", e)
+
+            # check the response
+            if response is None:
+                return
 
-        # check the response
-        if response is None:
-            return
-        else:
             # Ensure we got a successful response
             try:
                 response.raise_for_status()
             except requests.exceptions.HTTPError as e:
                 print(f"An error occured downloading {self._values}: {e}")
+                # never store an error page as an export
+                return
 
             print("\nsuccessful file request")
 
@@ -368,39 +1070,74 @@ class CAROLQuery:
                         break
             else:
                 print("No Content-Disposition header found.")
-                
-            # lock critical section for multiprocessing
-            with file_lock:
-                # Create the output directory if it doesn't exist
-                os.makedirs('./output', exist_ok=True)
-
-                # write zip to file
-                with open(f'./output/{folder}.zip', 'wb') as f:
-                    f.write(response.content)
-
-                # create a ZipFile object
-                with zipfile.ZipFile(f'./output/{folder}.zip', 'r') as zip_ref:
-                    # extract all the contents of the zip file to the current directory
-                    zip_ref.extractall(f'./output/{self._values}')
-                    filenames.append(f'./output/{self._values}/{folder}.csv')
-
-                # remove the zip file
-                os.remove(f'./output/{folder}.zip')
-                
-                with complete_lock:
-                    number_complete.value += 1
-                print(f"Completed {number_complete.value} of (at most) {total_queries.value}")
+
+            # the server has built the export, start on the next segment while this one streams
+            if prefetch is not None:
+                prefetch()
+
+            # stream the zip into the export store under the hash of the request, writes are atomic so no lock is needed
+            try:
+                self._csv_file = store.put(request_hash, request, response.iter_content(chunk_size=transport_chunk_size), folder,
+                                           response.headers.get('ETag'), self._probe_hash)
+            except requests.exceptions.RequestException as e:
+                print(f"An error occured downloading {self._values}: {e}")
+        finally:
+            if response is not None:
+                response.close()
+            store.release(request_hash)
+
+    def request_hash(self):
+        '''Returns the hash of the canonical download request and the canonical request itself.'''
+
+        request = canonical_request(self._payload)
+        return hashlib.sha256(request.encode()).hexdigest(), request
+
+    def from_store(self, expected_count=None):
+        '''
+        Uses a stored export of the exact same request instead of downloading it again. Returns True if one was found.
+        If expected_count is given, an export holding a different number of cases is out of date and is not used.
+        '''
+
+        request_hash, _ = self.request_hash()
+        store = ExportStore(export_store_path)
+        store.wait_for(request_hash)
+        stored = store.get(request_hash)
+        if stored is None:
+            return False
+        if expected_count is not None and stored["row_count"] != expected_count:
+            print(f"Stored export for {self._values} holds {stored['row_count']} cases but {expected_count} match now, downloading it again")
+            return False
+
+        print(f"Using stored export for {self._values}")
+        self._csv_file = stored["file"]
+        self._result_list_count = stored["row_count"]
+        return True
             
+def parse_date(value):
+    '''Parses a date, trying the common formats before dateutil. Returns None for values that are not dates.'''
+
+    value = value.strip()
+    for date_format in date_formats:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+
+    # dateutil only understands values with a digit or a month or weekday name
+    if not any(character.isdigit() for character in value) and not date_words.intersection(re.findall(r'[a-z]+', value.lower())):
+        return None
+    try:
+        return parser.parse(value)
+    except (ValueError, OverflowError):
+        return None
+
 def to_standard_date_format(cond_str, date_str):
     '''Converts a date string to a standard format.'''
     
-    try:
-        date_obj = parser.parse(date_str)
-        print(f"Detected condition: {cond_str.strip()}\n" + 
-            f"Detected date: {date_str}\n" +
-            f"Adding date condition to query.")
+    date_obj = parse_date(date_str)
+    if date_obj is not None:
         return date_obj.strftime('%Y-%m-%d')
-    except:
+    else:
         raise ValueError(f"\nDetected condition: {cond_str.strip()}\n" + 
             f"Detected date: {date_str}\n" + 
             f"Valid conditions are: is on or before, is on or after, is before, is after, is, is not\n" +
@@ -429,10 +1166,9 @@ def long_search(input_string):
     # Return True if either condition is met
     return ends_with_punctuation or is_longer_than_ten_words
 
-def query_decide(value: str):
-    '''Using pattern matching, decides which field, subfield, and condition an arbitrary value falls under.'''
+def confirm_long_search(value):
+    '''Asks whether a full sentence should be searched for in the Factual Narrative. Raises MalformedQueryError if not.'''
 
-    # Checks for full sentence
     if long_search(value):
         while True:
             user_input = input(f"Your input was: {value}\nFull sentences input to SAFEPy will search for the string in the Factual Narrative. Continue? (yes/no): ")
@@ -445,24 +1181,26 @@ def query_decide(value: str):
                 break
             else:
                 print("Invalid input. Please enter 'yes' or 'no'.")
+
+def query_decide(value: str, confirm = True):
+    '''Using pattern matching, decides which field, subfield, and condition an arbitrary value falls under.'''
+
+    # Checks for full sentence
+    if confirm:
+        confirm_long_search(value)
     
-    # Date decision with greedy check
+    # Date decision for dates including 'is on or before', ..., which can never be plain dates
     normalized_value = value.lower().strip()
-    try:
-        parsed_date = parser.parse(normalized_value)
+    match = cond_date_pattern.match(normalized_value)
+
+    # Date decision with greedy check
+    parsed_date = None if match else parse_date(normalized_value)
+    if parsed_date is not None:
         # Check if the parsed date is in the future and adjust the year if necessary
         if parsed_date > datetime.now():
             parsed_date = parsed_date.replace(year=parsed_date.year - 100)
-        print(f"Using default condition: is on or after\n" + 
-            f"Detected date: {parsed_date}\n" +
-            f"Adding date condition to query.")
         return "Event", "EventDate", "is on or after", parsed_date.strftime('%Y-%m-%d')
-    except:
-        pass
 
-    # Date decision for dates including 'is on or before', ...
-    cond_date_regex = r'^(is(?:(?: on or)?(?: before| after)| not)?) (.+)+$'
-    match = re.match(cond_date_regex, normalized_value)
     if match:
         return "Event", "EventDate", match.group(1), to_standard_date_format(match.group(1), match.group(2))
     
@@ -477,17 +1215,17 @@ def query_decide(value: str):
     # elif query_key_section == 3:
     #     print("Found value")
     # else:
-    print(f"Searching factual narrative for: {normalized_value}")
     return "Narrative", "Factual", "contains", normalized_value
 
+@lru_cache(maxsize=rule_cache_size)
 def query_key_sort(value):
     '''Sorts an arbitrary value into a field, subfield, condition, or value.'''
     str_methods = [str, str.lower, str.capitalize, str.upper]
     for m in str_methods:
         value = m(value)
-        if value in query_keys.fields:                
+        if value in query_keys.field_set:                
             return 0, value
-        if value in query_keys.subfields:
+        if value in query_keys.subfield_set:
             return 1, value
         if value in query_keys.conditions:
             return 2, value
@@ -495,14 +1233,14 @@ def query_key_sort(value):
             return 3, value
     return -1, value.lower()
 
-def query_rule_sort(arg):
+def query_rule_sort(arg, confirm = True):
     '''Sorts an arbitrary value into a field, subfield, condition, or value.'''
     rule = [None]*4
 
     # if one argument
     if (type(arg) == str) or (len(arg) == 1):
         if type(arg) == tuple: arg = arg[0]
-        rule[0:4] = query_decide(arg)
+        rule[0:4] = query_decide(arg, confirm)
 
     # If two arguments found
     elif (len(arg) == 2):
@@ -538,7 +1276,11 @@ def query_rule_sort(arg):
             key, a_match = query_key_sort(a)
             rule[key] = a_match
         if rule[1] == 'EventDate':
-            _, _, _, rule[3] = query_decide(rule[3])
+            _, subfield, _, date = query_decide(rule[3], confirm)
+            # anything that is not a date would otherwise be searched for as narrative text
+            if subfield != 'EventDate':
+                raise ValueError(f"{rule[3]} is not a date. Please enter dates in the following format: 'mm/dd/yyyy'.")
+            rule[3] = date
             
     # if 5 or more args found
     else:
@@ -603,10 +1345,10 @@ def generate_key_segments_or(keys_per_segment, key_constraints):
             if not not_cond:
                 not_cond = int(constraint.split(' ')[-1])
             elif not_cond and int(constraint.split(' ')[-1]) != not_cond or not_cond < global_lesser or not_cond > global_greater or not_cond in is_conditions:
-                return [(x, x + keys_per_segment) for x in range(0, 200000, keys_per_segment)]                
+                return [(x, min(x + keys_per_segment - 1, 200000)) for x in range(0, 200001, keys_per_segment)], []
         else:
             if not_cond and not_cond == int(constraint.split(' ')[-1]):
-                return [(x, x + keys_per_segment) for x in range(0, 200000, keys_per_segment)]                
+                return [(x, min(x + keys_per_segment - 1, 200000)) for x in range(0, 200001, keys_per_segment)], []
             is_conditions.append(int(constraint.split(' ')[-1]))
             
     # divide segments
@@ -701,74 +1443,1558 @@ def format_segments_as_constraints(segments, general_constraints, key_complement
     
     return constraints
 
-def aggregate_csv_files(csv_files):
-    '''Aggregates csv files from separte folders into a single CSV file.'''
+def merge_key_ranges(ranges):
+    '''Merges overlapping or adjacent inclusive key ranges into a sorted list of disjoint ranges.'''
+
+    merged = []
+    for start, end in sorted((int(start), int(end)) for start, end in ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def disjoint_key_segments(segments):
+    '''Clips key segments so that no Event.ID belongs to more than one of them, keeping their order.'''
+
+    covered = []
+    disjoint = []
+    for start, end in segments:
+        pieces = [(start, end)]
+        for covered_start, covered_end in covered:
+            clipped = []
+            for piece_start, piece_end in pieces:
+                # keep whatever lies outside of the covered range
+                if piece_end < covered_start or piece_start > covered_end:
+                    clipped.append((piece_start, piece_end))
+                    continue
+                if piece_start < covered_start:
+                    clipped.append((piece_start, covered_start - 1))
+                if piece_end > covered_end:
+                    clipped.append((covered_end + 1, piece_end))
+            pieces = clipped
+        disjoint.extend(pieces)
+        covered = merge_key_ranges(covered + [[start, end]])
+    return disjoint
+
+def plan_key(general_constraints, key_constraints, require_all, export_format):
+    '''Builds an order independent key for a query, under which its last plan is recorded.'''
+
+    rules = sorted(json.dumps([rule.field, rule.subfield, rule.condition, rule.value]) for rule in general_constraints)
+    data = {"rules": rules, "keys": sorted(key_constraints), "require_all": require_all, "export_format": export_format}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def rule_signature(rules, require_all=True):
+    '''Builds an order independent signature for the non-key rules of a query.'''
+
+    parts = sorted(f"{rule.field}.{rule.subfield} {rule.condition} {rule.value}" if rule.subfield else f"{rule.field} {rule.condition} {rule.value}"
+                   for rule in rules if rule.subfield != 'ID')
+    if not parts:
+        return "*"
+    return (" & " if require_all else " | ").join(parts)
+
+class IDHistogram:
+    '''
+    Event.ID density histogram
+    Persists the number of cases found in fixed width Event.ID buckets for each query signature, so that segments can be sized before probing the CAROL database.
+    '''
+    def __init__(self, path=id_histogram_path, bucket_size=id_bucket_size):
+        '''Loads the histogram from disk if it exists.'''
+
+        self.path = path
+        self.bucket_size = bucket_size
+        self._histograms = {}
+        self._updated = {}
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as file:
+                    data = json.load(file)
+            except (OSError, ValueError) as e:
+                print(f"Could not read Event.ID histogram {path}: {e}")
+                data = {}
+
+            # histograms built with a different bucket size cannot be reused
+            if data.get("bucket_size") == bucket_size:
+                for signature, histogram in data.get("histograms", {}).items():
+                    self._histograms[signature] = {int(bucket): count for bucket, count in histogram["buckets"].items()}
+                    self._updated[signature] = histogram.get("updated")
+
+    def save(self):
+        '''Writes the histogram to disk.'''
+
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        data = {"bucket_size": self.bucket_size, "histograms": {}}
+        for signature, histogram in self._histograms.items():
+            data["histograms"][signature] = {
+                "updated": self._updated.get(signature),
+                "buckets": {str(bucket): count for bucket, count in sorted(histogram.items())}
+            }
+
+        # write to a temporary file first so that concurrent readers never see a partial histogram
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, signature):
+        '''Returns the signature whose histogram can be used to estimate the given signature, if any.'''
+
+        if signature in self._histograms:
+            return signature
+        # unfiltered counts are an upper bound for every filtered query
+        if "*" in self._histograms:
+            return "*"
+        return None
+
+    def _full_buckets(self, lower, upper):
+        '''Returns the buckets that lie completely inside the inclusive range [lower, upper].'''
+
+        # no Event.ID lies beyond the maximum, so the last bucket counts as covered
+        if upper >= max_event_id:
+            upper = (upper // self.bucket_size + 1) * self.bucket_size - 1
+        first = -(-lower // self.bucket_size)
+        last = (upper + 1) // self.bucket_size - 1
+        return range(first, last + 1)
+
+    def _touch(self, signature):
+        '''Returns the histogram of a signature, creating it if necessary.'''
+
+        self._updated[signature] = datetime.now().isoformat(timespec='seconds')
+        return self._histograms.setdefault(signature, {})
+
+    def observe(self, signature, lower, upper, count):
+        '''Records the result count of a probe over the inclusive Event.ID range [lower, upper].'''
+
+        buckets = self._full_buckets(lower, upper)
+        if count is None or not buckets:
+            return
+
+        aligned = lower == buckets[0] * self.bucket_size and upper == (buckets[-1] + 1) * self.bucket_size - 1
+        known = self._histograms.get(signature, {})
+        if count == 0:
+            # nothing in the range, so every bucket inside it is empty
+            histogram = self._touch(signature)
+            for bucket in buckets:
+                histogram[bucket] = 0
+        elif aligned and len(buckets) == 1:
+            self._touch(signature)[buckets[0]] = count
+        elif aligned and all(bucket in known for bucket in buckets):
+            # keep the known shape of the range but rescale it to the new total
+            total = sum(known[bucket] for bucket in buckets)
+            histogram = self._touch(signature)
+            for bucket in buckets:
+                share = histogram[bucket] / total if total else 1 / len(buckets)
+                histogram[bucket] = round(count * share, 2)
+
+    def observe_rows(self, signature, ids, ranges):
+        '''Records exact case counts from downloaded Event.IDs for every bucket fully covered by the downloaded ranges.'''
+
+        counts = Counter(int(key) // self.bucket_size for key in ids)
+        histogram = self._touch(signature)
+        for lower, upper in merge_key_ranges(ranges):
+            for bucket in self._full_buckets(lower, upper):
+                histogram[bucket] = counts.get(bucket, 0)
+
+    def covers(self, signature, ranges):
+        '''Checks whether every bucket touching the given ranges has a known count.'''
+
+        histogram = self._histograms.get(signature, {})
+        return all(bucket in histogram for lower, upper in ranges for bucket in range(lower // self.bucket_size, upper // self.bucket_size + 1))
+
+    def estimate(self, signature, lower, upper):
+        '''Estimates the number of cases in the inclusive range [lower, upper], or None if part of it is unknown.'''
+
+        histogram = self._histograms.get(signature, {})
+        total = 0
+        for bucket in range(lower // self.bucket_size, upper // self.bucket_size + 1):
+            if bucket not in histogram:
+                return None
+            total += histogram[bucket]
+        return total
+
+    def plan(self, signature, ranges, target=histogram_segment_target):
+        '''
+        Splits Event.ID ranges into segments whose estimated result counts stay below the target.
+        Sparse regions become wide segments, dense regions narrow ones, and buckets with an unknown count get a segment of their own.
+        '''
+
+        histogram = self._histograms.get(signature, {})
+        segments = []
+        for lower, upper in ranges:
+            start = lower
+            total = 0
+            for bucket in range(lower // self.bucket_size, upper // self.bucket_size + 1):
+                bucket_lower = max(lower, bucket * self.bucket_size)
+                bucket_upper = min(upper, (bucket + 1) * self.bucket_size - 1)
+                count = histogram.get(bucket)
+                if count is None:
+                    # unknown density, fall back to a single bucket
+                    if start < bucket_lower:
+                        segments.append((start, bucket_lower - 1))
+                    segments.append((bucket_lower, bucket_upper))
+                    start = bucket_upper + 1
+                    total = 0
+                    continue
+                if total + count > target and start < bucket_lower:
+                    segments.append((start, bucket_lower - 1))
+                    start = bucket_lower
+                    total = 0
+                total += count
+            if start <= upper:
+                segments.append((start, upper))
+        return segments
+
+def pinned_key_segments(histogram, signature, ranges, pinned=None):
+    '''Plans Event.ID segments from the histogram, keeping the pinned segments of an earlier plan that lie inside the ranges so that their stored exports stay valid.'''
+
+    pinned = [tuple(segment) for segment in pinned or [] if any(lower <= segment[0] and segment[1] <= upper for lower, upper in ranges)]
+    uncovered = disjoint_key_segments(pinned + [tuple(key_range) for key_range in ranges])[len(pinned):]
+    return sorted(pinned + histogram.plan(signature, uncovered))
+
+def spot_check_segments(segments, histogram, signature, estimate_signature, general_constraints, require_all, spot_checks, target=histogram_segment_target):
+    '''Probes the segments with the largest estimates and splits any whose live count exceeds the target.'''
+
+    estimates = {segment: histogram.estimate(estimate_signature, *segment) or 0 for segment in segments}
+    checked = sorted(segments, key=lambda segment: estimates[segment], reverse=True)[:spot_checks]
+
+    planned = []
+    for segment in segments:
+        if segment not in checked:
+            planned.append(segment)
+            continue
+
+        print(f"Spot checking segment {segment} (estimated {estimates[segment]} results)...\n")
+        rules = format_segments_as_constraints([segment], general_constraints, [])[0]
+        count = submit_query(*rules, download=False, require_all=require_all, only_download=False, has_key_constraint=True)._result_list_count
+        histogram.observe(signature, segment[0], segment[1], count)
+
+        if count is not None and count > target:
+            # the histogram drifted, so fall back to bucket sized segments for this range
+            print(f"Segment {segment} has {count} results, splitting it into buckets\n")
+            start, upper = segment
+            while start <= upper:
+                end = min(upper, (start // histogram.bucket_size + 1) * histogram.bucket_size - 1)
+                planned.append((start, end))
+                start = end + 1
+        else:
+            planned.append(segment)
+    return planned
+
+def event_date_bounds(rules):
+    '''Finds the EventDate window implied by the date rules of a query and the rules that bound it.'''
+
+    start = earliest_event_date
+    end = datetime.combine(datetime.now().date(), datetime.min.time())
+    bounding_rules = []
+    for rule in rules:
+        if rule.subfield != 'EventDate' or rule.condition not in date_bound_conditions:
+            continue
+        try:
+            date = datetime.strptime(rule.value, '%Y-%m-%d')
+        except ValueError:
+            date = parser.parse(rule.value)
+
+        if rule.condition == "is on or after":
+            start = max(start, date)
+        elif rule.condition == "is after":
+            start = max(start, date + timedelta(days=1))
+        elif rule.condition == "is on or before":
+            end = min(end, date)
+        elif rule.condition == "is before":
+            end = min(end, date - timedelta(days=1))
+        else:
+            start = max(start, date)
+            end = min(end, date)
+        bounding_rules.append(rule)
+
+    return start, end, bounding_rules
+
+def date_window_rules(start, end):
+    '''Creates the query rules for the inclusive EventDate window [start, end].'''
+
+    return (query_rule("Event", "EventDate", "is on or after", start.strftime('%Y-%m-%d')),
+            query_rule("Event", "EventDate", "is on or before", end.strftime('%Y-%m-%d')))
+
+def count_date_window(general_constraints, window_start, window_end):
+    '''Counts the results of an EventDate window, probing again if the probe fails. Raises ProbeFailedError if it keeps failing.'''
+
+    print(f"Counting results from {window_start:%Y-%m-%d} to {window_end:%Y-%m-%d}...\n")
+    rules = tuple(general_constraints) + date_window_rules(window_start, window_end)
+    for _ in range(date_probe_retries + 1):
+        count = submit_query(*rules, download=False, require_all=True, only_download=False, has_key_constraint=False)._result_list_count
+        if count is not None:
+            return count
+    raise ProbeFailedError(f"Could not count the results from {window_start:%Y-%m-%d} to {window_end:%Y-%m-%d}. Check your connection and try again.")
+
+def plan_date_segments(general_constraints, start, end, target=max_export_count, total=None, max_probes=None):
+    '''
+    Splits an EventDate range into windows that each fit in one export, with a known count each.
+    A window with too many results is cut into as many equal windows as its count calls for, which are counted and cut again if needed.
+    total is the count of the whole range, if it is already known. Returns None if more than max_probes count probes would be needed.
+    '''
+
+    probes = 0
+    if total is None:
+        total = count_date_window(general_constraints, start, end)
+        probes += 1
+
+    windows = []
+    pending = [(start, end, total)]
+    while pending:
+        window_start, window_end, count = pending.pop(0)
+        days = (window_end - window_start).days + 1
+        if count == 0:
+            continue
+        if count < target or days == 1:
+            if count >= target:
+                print(f"Warning: {count} results on {window_start:%Y-%m-%d} cannot be split any further.")
+            windows.append((window_start, window_end, count))
+            continue
+
+        parts = min(days, -(-count // int(target * date_window_fill)))
+        if max_probes is not None and probes + parts > max_probes:
+            print(f"Planning EventDate windows would take more than {max_probes} count probes.")
+            return None
+        pieces = []
+        for part in range(parts):
+            piece_start = window_start + timedelta(days=days * part // parts)
+            piece_end = window_start + timedelta(days=days * (part + 1) // parts - 1)
+            pieces.append((piece_start, piece_end, count_date_window(general_constraints, piece_start, piece_end)))
+        probes += parts
+        pending[0:0] = pieces
+
+    return windows
+
+def format_date_segments_as_constraints(windows, general_constraints):
+    '''Formats a list of EventDate windows as a list of constraints.'''
+
+    constraints = []
+    for window_start, window_end, _ in windows:
+        constraints.append(date_window_rules(window_start, window_end) + tuple(general_constraints))
+    return constraints
+
+def canonical_request(payload):
+    '''Builds a canonical JSON form of a download request, independent of the order of its rules and groups.'''
+
+    groups = []
+    for group in payload["QueryGroups"]:
+        rules = sorted(json.dumps([rule["Columns"], rule["Operator"], rule["Values"]]) for rule in group["QueryRules"])
+        if rules:
+            groups.append([group["AndOr"], rules])
+    groups.sort()
+    return json.dumps({"groups": groups, "AndOr": payload["AndOr"], "TargetCollection": payload["TargetCollection"], "ExportFormat": payload["ExportFormat"]}, sort_keys=True)
+
+class ExportStore:
+    '''
+    Content-addressed export store
+    Keeps the compressed bytes of every export under the hash of its canonical request, sharded into subdirectories, along with a SQLite manifest.
+    '''
+    def __init__(self, path=export_store_path):
+        '''Opens the store, creating its manifest if necessary.'''
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS exports (request_hash TEXT PRIMARY KEY, request TEXT, file TEXT, name TEXT, "
+                               "row_count INTEGER, size INTEGER, etag TEXT, fetched REAL, content_hash TEXT, probe_hash TEXT)")
+            # manifests written before change detection lack the hash columns
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(exports)")]
+            for column in ("content_hash", "probe_hash"):
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE exports ADD COLUMN {column} TEXT")
+            # the segments of the last plan of every query, revalidated by their own rules on the next refresh
+            connection.execute("CREATE TABLE IF NOT EXISTS plans (plan_key TEXT PRIMARY KEY, plan TEXT, updated REAL)")
+
+    def _connect(self):
+        '''Opens a connection to the manifest.'''
+
+        connection = sqlite3.connect(os.path.join(self.path, "manifest.sqlite"), timeout=60, isolation_level=None)
+        connection.execute("PRAGMA busy_timeout = 60000")
+        return _ClosingConnection(connection)
+
+    def file_for(self, request_hash):
+        '''Returns the sharded path of an export.'''
+
+        return os.path.join(self.path, request_hash[:2], request_hash[2:4], f"{request_hash}.zip")
+
+    def get(self, request_hash):
+        '''Returns the manifest entry of a stored export, or None if it is not stored.'''
+
+        with self._connect() as connection:
+            connection.row_factory = sqlite3.Row
+            row = connection.execute("SELECT * FROM exports WHERE request_hash = ?", (request_hash,)).fetchone()
+        if row is None or not os.path.exists(row["file"]):
+            return None
+        return dict(row)
+
+    def put(self, request_hash, request, content, name=None, etag=None, probe_hash=None):
+        '''Stores the zipped bytes (or an iterable of chunks) of an export and records it in the manifest. Returns the path of the stored file.'''
+
+        file = self.file_for(request_hash)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+
+        # write to a temporary file first so that readers never see a partial export
+        tmp_file = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_file, 'wb') as f:
+                if isinstance(content, (bytes, bytearray)):
+                    f.write(content)
+                else:
+                    for chunk in content:
+                        f.write(chunk)
+                size = f.tell()
+            os.replace(tmp_file, file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        row_count, content_hash = count_export_rows(file)
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO exports (request_hash, request, file, name, row_count, size, etag, fetched, content_hash, probe_hash) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (request_hash, request, os.path.abspath(file), name, row_count, size, etag, time.time(), content_hash, probe_hash))
+        return os.path.abspath(file)
+
+    def put_plan(self, plan):
+        '''Records the segments of a plan under the key of its query.'''
+
+        plan_data = {
+            "require_all": plan.require_all,
+            "only_download": plan.only_download,
+            "has_key_constraint": plan.has_key_constraint,
+            "export_format": plan.export_format,
+            "segments": [[rule_to_list(rule) for rule in segment] for segment in plan.segments],
+            "key_segments": plan.key_segments,
+            "date_segments": [[f"{start:%Y-%m-%d}", f"{end:%Y-%m-%d}", count] for start, end, count in plan.date_segments] if plan.date_segments is not None else None
+        }
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO plans VALUES (?, ?, ?)", (plan.key, json.dumps(plan_data), time.time()))
+
+    def get_plan(self, plan_key):
+        '''Returns the last recorded plan of a query as a QueryPlan, or None if none was recorded.'''
+
+        with self._connect() as connection:
+            row = connection.execute("SELECT plan FROM plans WHERE plan_key = ?", (plan_key,)).fetchone()
+        if row is None:
+            return None
+
+        plan_data = json.loads(row[0])
+        plan = QueryPlan((), plan_data["require_all"])
+        plan.key = plan_key
+        plan.only_download = plan_data["only_download"]
+        plan.has_key_constraint = plan_data["has_key_constraint"]
+        plan.export_format = plan_data["export_format"]
+        plan.segments = [tuple(query_rule(*rule) for rule in segment) for segment in plan_data["segments"]]
+        if plan_data["key_segments"] is not None:
+            plan.key_segments = [tuple(segment) for segment in plan_data["key_segments"]]
+        if plan_data["date_segments"] is not None:
+            plan.date_segments = [(datetime.strptime(start, '%Y-%m-%d'), datetime.strptime(end, '%Y-%m-%d'), count) for start, end, count in plan_data["date_segments"]]
+        return plan
+
+    def _marker(self, request_hash):
+        '''Returns the path of the in-flight marker of an export.'''
+        return f"{self.file_for(request_hash)}.inflight"
+
+    def _live_marker(self, marker):
+        '''Returns True if a marker belongs to a download that is still running.'''
+
+        try:
+            with open(marker) as f:
+                host, pid = f.read().split()
+            age = time.time() - os.path.getmtime(marker)
+        except (OSError, ValueError):
+            return False
+        if host == socket.gethostname() and not process_alive(pid):
+            return False
+        return age < export_inflight_seconds
+
+    def acquire(self, request_hash):
+        '''Marks an export as being downloaded. Returns False if a running download already holds the marker.'''
+
+        marker = self._marker(request_hash)
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        for _ in range(2):
+            try:
+                fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._live_marker(marker):
+                    return False
+                # the download holding the marker died, take it over
+                try:
+                    os.remove(marker)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(f"{socket.gethostname()} {os.getpid()}")
+            return True
+        return False
+
+    def release(self, request_hash):
+        '''Removes the in-flight marker of an export.'''
+
+        try:
+            os.remove(self._marker(request_hash))
+        except FileNotFoundError:
+            pass
+
+    def wait_for(self, request_hash):
+        '''Waits while a running download holds the in-flight marker of an export.'''
+
+        marker = self._marker(request_hash)
+        while os.path.exists(marker) and self._live_marker(marker):
+            time.sleep(0.5)
+
+    def forget(self, request_hash):
+        '''Removes an export from the manifest, so that it is downloaded again.'''
+
+        with self._connect() as connection:
+            connection.execute("DELETE FROM exports WHERE request_hash = ?", (request_hash,))
+
+def export_csv_name(zip_ref):
+    '''Returns the name of the CSV file inside a zipped export.'''
+    return next(name for name in zip_ref.namelist() if name.lower().endswith('.csv'))
+
+def count_export_rows(file):
+    '''Counts the data rows of a zipped export and hashes its CSV content.'''
+
+    content_hash = hashlib.sha256()
+    with zipfile.ZipFile(file, 'r') as zip_ref:
+        with zip_ref.open(export_csv_name(zip_ref)) as f:
+            content = f.read()
+    content_hash.update(content)
+    rows = sum(1 for _ in csv.reader(io.StringIO(content.decode('utf-8', errors='replace'), newline='')))
+    return max(rows - 1, 0), content_hash.hexdigest()
+
+def export_categories(column):
+    '''Returns the codes listed in possible_values.json for a categorical export column, or an empty list.'''
+
+    if column not in export_category_values:
+        return []
+    field, subfield = export_category_values[column]
+    return [value for value in compressed_json.get(field, {}).get(subfield, {}).get("values", []) if value is not None]
+
+def apply_export_schema(df):
+    '''Coerces the columns of a parsed export to the declared schema. A column holding values that cannot be coerced is kept as text, with a warning.'''
+
+    for column in df.columns:
+        kind = export_schema.get(column)
+        if kind is None:
+            continue
+        values = original = df[column]
+
+        if kind == "date":
+            if not pd.api.types.is_datetime64_any_dtype(values):
+                try:
+                    values = pd.to_datetime(values, format='ISO8601', utc=True)
+                except (ValueError, TypeError):
+                    values = pd.to_datetime(values, format='mixed', utc=True, errors='coerce')
+            elif values.dt.tz is None:
+                values = values.dt.tz_localize('UTC')
+            # every segment ends up with the same naive UTC dates
+            values = values.dt.tz_convert(None)
+        elif kind == "int" and not isinstance(values.dtype, pd.Int64Dtype):
+            values = pd.to_numeric(values, errors='coerce')
+            try:
+                values = values.astype("Int64")
+            except (ValueError, TypeError):
+                values = values.round().astype("Int64")
+        elif kind == "float" and values.dtype != np.float64:
+            values = pd.to_numeric(values, errors='coerce').astype("float64")
+        elif kind == "bool" and not isinstance(values.dtype, pd.BooleanDtype):
+            values = values.astype("string").str.strip().str.lower().map({"true": True, "1": True, "yes": True, "y": True,
+                                                                         "false": False, "0": False, "no": False, "n": False}).astype("boolean")
+        elif kind == "category":
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype("string").astype("category")
+            declared = export_categories(column)
+            values = values.cat.set_categories(declared + sorted(set(values.cat.categories) - set(declared)))
+        elif kind == "string" and values.dtype != pd.StringDtype():
+            values = values.astype("string")
+
+        # never drop a value silently, keep the column as text if any value did not fit its type
+        if kind in ("date", "int", "float", "bool") and values is not original:
+            text = original.astype("string").str.strip()
+            lost = (text.notna() & (text != "") & values.isna()).to_numpy()
+            if lost.any():
+                examples = ', '.join(repr(value) for value in text[lost].unique()[:3])
+                print(f"Warning: {lost.sum()} values of {column} are not of type {kind} (e.g. {examples}), keeping {column} as text")
+                values = text
+        df[column] = values
+    return df
+
+def _read_export_csv(file, **kwargs):
+    '''Reads the CSV content of a segment file with the given read_csv arguments.'''
+
+    if file.lower().endswith('.zip'):
+        with zipfile.ZipFile(file, 'r') as zip_ref:
+            with zip_ref.open(export_csv_name(zip_ref)) as f:
+                return pd.read_csv(f, **kwargs)
+    return pd.read_csv(file, **kwargs)
+
+def export_header(file):
+    '''Returns the column names of a segment file without parsing its rows.'''
+
+    if file.lower().endswith('.zip'):
+        with zipfile.ZipFile(file, 'r') as zip_ref:
+            with zip_ref.open(export_csv_name(zip_ref)) as f:
+                line = f.readline().decode('utf-8-sig')
+    else:
+        with open(file, encoding='utf-8-sig') as f:
+            line = f.readline()
+    return next(csv.reader([line]), [])
+
+def projected_columns(columns):
+    '''Normalizes a column projection to a list of column names, or None to keep every column. Raises ValueError for columns the summary export does not have.'''
+
+    if columns is None:
+        return None
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    unknown = [column for column in columns if column not in export_schema]
+    if unknown:
+        raise ValueError(f"Unknown columns {', '.join(map(str, unknown))}. Valid columns are: {', '.join(export_schema)}")
+    return columns
+
+def export_read_columns(columns):
+    '''Returns the columns to parse for a projection, adding the Event.ID and NTSB number needed to drop duplicate cases.'''
+
+    if columns is None:
+        return None
+    return list(columns) + [column for column in (event_id_column, ntsb_number_column) if column not in columns]
+
+def project_export(df, columns):
+    '''Keeps the projected columns of a parsed export, in the order they were asked for.'''
+
+    if columns is None:
+        return df
+    return df[[column for column in columns if column in df.columns]]
+
+def read_export(file, columns = None, **kwargs):
+    '''
+    Reads a segment file, which is either a zipped export from the store or a plain CSV file, into the declared export schema.
+    The file is parsed straight into the schema with pyarrow (or the C engine), and only read as text and coerced column by column if that fails.
+    If columns is given, every other column is skipped by the parser.
+    '''
+
+    if columns is not None:
+        wanted = set(columns)
+        kwargs["usecols"] = [column for column in export_header(file) if column in wanted]
+    if "dtype" in kwargs:
+        return _read_export_csv(file, **kwargs)
+
+    dtypes = {column: export_read_dtypes[kind] for column, kind in export_schema.items()}
+    engines = (["pyarrow"] if pyarrow is not None else []) + ["c"]
+    for engine in engines:
+        try:
+            return apply_export_schema(_read_export_csv(file, dtype=dtypes, engine=engine, **kwargs))
+        except (ValueError, TypeError, NotImplementedError):
+            continue
+        except Exception as e:
+            # pyarrow raises its own errors for values that do not fit the schema
+            if engine != "pyarrow":
+                raise
+            print(f"Falling back to the C engine for {file}: {e}")
+
+    # malformed values, read the declared columns as text and coerce what can be coerced
+    return apply_export_schema(_read_export_csv(file, dtype={column: str for column in export_schema}, **kwargs))
+
+def concat_exports(frames):
+    '''Concatenates parsed exports, keeping categorical columns categorical even when segments found different codes.'''
+
+    frames = [df for df in frames if df is not None]
+    if not frames:
+        return pd.DataFrame()
+    for column in frames[0].columns:
+        if all(column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype) for df in frames):
+            categories = list(frames[0][column].cat.categories)
+            for df in frames[1:]:
+                categories += [category for category in df[column].cat.categories if category not in set(categories)]
+            for df in frames:
+                df[column] = df[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+class SeenSet:
+    '''
+    Seen-set of cases
+    Remembers the Event.IDs already written in a bitmap with one bit per possible ID, falling back to a set of NTSB numbers for exports without Event.IDs.
+    '''
+    def __init__(self, size=max_event_id + 1):
+        '''Initializes the SeenSet class.'''
+
+        self._bits = np.zeros(size // 8 + 1, dtype=np.uint8)
+        self._ntsb_numbers = set()
+
+    def new_rows(self, df):
+        '''Returns a mask of the rows of a segment whose case was not seen before, and remembers those cases.'''
+
+        if event_id_column in df.columns:
+            ids = pd.to_numeric(df[event_id_column], errors='coerce')
+            valid = (ids.notna() & (ids >= 0)).to_numpy()
+            keys = ids[valid].astype(np.int64).to_numpy()
+
+            # grow the bitmap if the NTSB handed out larger IDs than expected
+            if len(keys) and keys.max() // 8 >= len(self._bits):
+                self._bits = np.concatenate([self._bits, np.zeros(keys.max() // 8 + 1 - len(self._bits), dtype=np.uint8)])
+
+            seen = (self._bits[keys >> 3] >> (keys & 7).astype(np.uint8)) & 1
+            mask = np.ones(len(df), dtype=bool)
+            mask[valid] = (seen == 0) & ~pd.Series(keys).duplicated().to_numpy()
+            np.bitwise_or.at(self._bits, keys >> 3, np.left_shift(1, keys & 7).astype(np.uint8))
+            return mask
+
+        if ntsb_number_column in df.columns:
+            numbers = df[ntsb_number_column].astype(str)
+            mask = (~numbers.isin(self._ntsb_numbers) & ~numbers.duplicated()).to_numpy()
+            self._ntsb_numbers.update(numbers[mask])
+            return mask
+
+        return np.ones(len(df), dtype=bool)
+
+def aggregate_csv_files(csv_files, aggregated_csv_file = "./output/aggregated_data.csv", columns = None):
+    '''Aggregates csv files from separte folders into a single CSV file, dropping cases that appear in more than one of them and keeping only the given columns.'''
     
     if not csv_files:
         print("No results returned.")
         return
 
-    # Create an empty DataFrame to store aggregated data
-    aggregated_df = pd.DataFrame()
-
-    # Iterate through CSV files and append data to the aggregated DataFrame
-    for csv_file in csv_files:
+    columns = projected_columns(columns)
+    def parse(csv_file):
         try:
-            df = pd.read_csv(csv_file)
-            aggregated_df = pd.concat([aggregated_df, df], ignore_index=True)
+            return read_export(csv_file, columns = export_read_columns(columns))
         except Exception as e:
             print(f"Error reading {csv_file}: {e}")
-
-    # Specify the output aggregated CSV file path
-    aggregated_csv_file = "./output/aggregated_data.csv"
+            return None
+
+    # Parse the CSV files in parallel and keep the rows of cases we have not seen yet, in file order
+    seen = SeenSet()
+    frames = []
+    duplicates = 0
+    with ThreadPoolExecutor(max_workers=parse_workers) as executor:
+        for df in executor.map(parse, csv_files):
+            if df is None:
+                continue
+            mask = seen.new_rows(df)
+            duplicates += len(df) - int(mask.sum())
+            frames.append(project_export(df[mask], columns))
+
+    # Create the aggregated DataFrame in one go instead of growing it file by file
+    aggregated_df = concat_exports(frames)
+    if duplicates:
+        print(f"Dropped {duplicates} duplicate rows")
 
     # Save the aggregated data to the CSV file
+    os.makedirs(os.path.dirname(aggregated_csv_file) or '.', exist_ok=True)
     aggregated_df.to_csv(aggregated_csv_file, index=False)
 
     print(f"\nAggregated data saved to {aggregated_csv_file}")
     print(f"Search Results: {aggregated_df.shape[0]}")
-    
-def submit_query(*args, **kwargs):
-    '''A single query to the CAROL Database.
-    The queries are input as a list of tuples or strings.
+
+    return aggregated_df
+
+def order_segments(plan, order = 'plan'):
+    '''
+    Returns the indices of the segments of a plan in the order they should be downloaded.
+    newest starts with the highest Event.IDs or latest EventDates, largest with the segments expected to hold the most cases,
+    and interleaved alternates between the newest and the oldest segments so both ends of the data fill in together.
     '''
 
+    if order not in segment_orders:
+        raise ValueError(f"Unknown order {order}. Valid orders are: {', '.join(segment_orders)}")
+    indices = list(range(len(plan.segments)))
+    if order == 'plan' or len(indices) < 2:
+        return indices
+
+    # where each segment sits in time and how many cases it is expected to hold, segments outside the plan ranges come last
+    positions = [-1] * len(indices)
+    sizes = [-1] * len(indices)
+    if plan.date_segments is not None:
+        for index, (_, window_end, count) in enumerate(plan.date_segments):
+            positions[index] = window_end.toordinal()
+            sizes[index] = count if count is not None else -1
+    elif plan.key_segments is not None:
+        estimate_signature = plan.histogram.lookup(plan.signature) if plan.histogram else None
+        for index, (lower, upper) in enumerate(plan.key_segments):
+            positions[index] = upper
+            estimate = plan.histogram.estimate(estimate_signature, lower, upper) if estimate_signature else None
+            # without an estimate the width of the Event.ID range is the best guess
+            sizes[index] = estimate if estimate is not None else upper - lower + 1
+
+    if order == 'largest':
+        return sorted(indices, key=lambda index: sizes[index], reverse=True)
+
+    newest = sorted(indices, key=lambda index: positions[index], reverse=True)
+    if order == 'newest':
+        return newest
+
+    interleaved = []
+    while newest:
+        interleaved.append(newest.pop(0))
+        if newest:
+            interleaved.append(newest.pop())
+    return interleaved
+
+def rollup_column(dimension):
+    '''Returns the export column holding a rollup dimension, which is either a possible_values.json subfield or an export column.'''
+
+    if dimension == "year":
+        return "EventDate"
+    for column, (_, subfield) in export_category_values.items():
+        if subfield == dimension:
+            return column
+    return dimension
+
+class RollupStore:
+    '''
+    Rollup store
+    Keeps the counts and measure sums of every downloaded segment per group of dimension values in a SQLite database.
+    A segment's partial aggregates are replaced only when the segment changes, so rollups of a dataset are refreshed in time proportional to the changed rows
+    and read back by summing the partials of each group. An event found in more than one segment is counted by the first of them only, whatever order
+    the segments finished in, and the partials of the segments that gain or lose an event are corrected when a segment is written.
+    '''
+    def __init__(self, path=rollup_path, rollups=None, measures=None):
+        '''Opens the store, creating its tables if necessary. Rollups and measures default to the ones defined in the store, or to default_rollups and rollup_measures.'''
+
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS rollups (rollup TEXT PRIMARY KEY, definition TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS segments (dataset TEXT, rollup TEXT, segment TEXT, fingerprint TEXT, rows INTEGER, "
+                               "PRIMARY KEY (dataset, rollup, segment))")
+            connection.execute("CREATE TABLE IF NOT EXISTS partials (dataset TEXT, rollup TEXT, segment TEXT, key TEXT, measure TEXT, value REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS partials_rollup ON partials (dataset, rollup, segment)")
+            connection.execute("CREATE TABLE IF NOT EXISTS events (dataset TEXT, rollup TEXT, segment TEXT, event TEXT, key TEXT, measures TEXT)")
+            connection.execute("CREATE INDEX IF NOT EXISTS events_segment ON events (dataset, rollup, segment)")
+            connection.execute("CREATE INDEX IF NOT EXISTS events_event ON events (dataset, rollup, event)")
+            # rollups stored before partials were corrected in place have no unique groups
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'partials_group'").fetchone() is None:
+                connection.execute("DELETE FROM partials")
+                connection.execute("DELETE FROM events")
+                connection.execute("DELETE FROM segments")
+                connection.execute("CREATE UNIQUE INDEX partials_group ON partials (dataset, rollup, segment, key, measure)")
+            stored = {rollup: json.loads(definition) for rollup, definition in connection.execute("SELECT rollup, definition FROM rollups")}
+
+            self.rollups = dict(rollups or {rollup: definition["dimensions"] for rollup, definition in stored.items()} or default_rollups)
+            self.measures = list(measures or next((definition["measures"] for definition in stored.values()), None) or rollup_measures)
+
+            # a rollup whose dimensions or measures changed is rebuilt from scratch
+            connection.execute("BEGIN IMMEDIATE")
+            for rollup, dimensions in self.rollups.items():
+                definition = json.dumps({"dimensions": list(dimensions), "measures": self.measures, "events": True})
+                row = connection.execute("SELECT definition FROM rollups WHERE rollup = ?", (rollup,)).fetchone()
+                if row is not None and row[0] != definition:
+                    connection.execute("DELETE FROM partials WHERE rollup = ?", (rollup,))
+                    connection.execute("DELETE FROM events WHERE rollup = ?", (rollup,))
+                    connection.execute("DELETE FROM segments WHERE rollup = ?", (rollup,))
+                connection.execute("INSERT OR REPLACE INTO rollups VALUES (?, ?)", (rollup, definition))
+            connection.execute("COMMIT")
+
+    def _connect(self):
+        '''Opens a connection that waits for other writers instead of failing.'''
+
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.execute("PRAGMA busy_timeout = 60000")
+        return _ClosingConnection(connection)
+
+    def columns(self):
+        '''Returns the export columns the rollups need.'''
+
+        columns = [rollup_column(dimension) for dimensions in self.rollups.values() for dimension in dimensions] + self.measures
+        return list(dict.fromkeys(columns))
+
+    def _event_keys(self, df):
+        '''Returns the event of every row of a segment, keyed by its Event.ID or else its NTSB number, or None if it has neither.'''
+
+        if event_id_column in df.columns:
+            ids = pd.to_numeric(df[event_id_column], errors='coerce')
+            return pd.Series([None if pd.isna(key) else f"id:{int(key)}" for key in ids], index=df.index, dtype=object)
+        if ntsb_number_column in df.columns:
+            return pd.Series([None if pd.isna(key) else f"ntsb:{key}" for key in df[ntsb_number_column]], index=df.index, dtype=object)
+        return pd.Series([None] * len(df), index=df.index, dtype=object)
+
+    @staticmethod
+    def _encode(key, dimensions):
+        '''Encodes the dimension values of a group as its JSON key.'''
+
+        key = key if isinstance(key, tuple) else (key,)
+        return json.dumps([None if pd.isna(value) else (int(value) if dimension == "year" else str(value)) for dimension, value in zip(dimensions, key)])
+
+    def _frame(self, df, dimensions):
+        '''Returns the dimension values and measures of every row of a segment.'''
+
+        frame = pd.DataFrame(index=df.index)
+        for dimension in dimensions:
+            column = rollup_column(dimension)
+            if column not in df.columns:
+                frame[dimension] = None
+            elif dimension == "year":
+                frame[dimension] = pd.to_datetime(df[column], errors='coerce').dt.year.astype("Int64")
+            else:
+                frame[dimension] = df[column].astype("string")
+        for measure in self.measures:
+            frame[measure] = pd.to_numeric(df[measure], errors='coerce').fillna(0) if measure in df.columns else 0
+        return frame
+
+    def _group(self, frame, dimensions):
+        '''Groups the rows of a segment by the values of the dimensions, returning (key, measure, value) rows.'''
+
+        rows = []
+        grouped = frame.groupby(list(dimensions), dropna=False, observed=True)
+        for key, count in grouped.size().items():
+            rows.append((self._encode(key, dimensions), "count", int(count)))
+        for key, values in grouped[self.measures].sum().iterrows():
+            rows.extend((self._encode(key, dimensions), measure, float(values[measure])) for measure in self.measures)
+        return rows
+
+    def _events(self, events, frame, dimensions):
+        '''Returns the (event, key, measures) rows of a segment, used to count events that appear in several segments once.'''
+
+        keys = [self._encode(key, dimensions) for key in frame[list(dimensions)].itertuples(index=False, name=None)]
+        measures = [json.dumps([float(value) for value in values]) for values in frame[self.measures].itertuples(index=False, name=None)]
+        return [(event, key, measure) for event, key, measure in zip(events, keys, measures) if event is not None]
+
+    def update(self, dataset, segment, fingerprint, df):
+        '''Replaces the partial aggregates of a segment of a dataset, unless the segment is unchanged. Returns True if anything was written.'''
+
+        with self._connect() as connection:
+            known = dict(connection.execute("SELECT rollup, fingerprint FROM segments WHERE dataset = ? AND segment = ?", (dataset, segment)).fetchall())
+            changed = [rollup for rollup in self.rollups if known.get(rollup) != fingerprint]
+            if not changed:
+                return False
+
+            # a row repeated within the export is counted once, like in the aggregated file
+            events = self._event_keys(df)
+            keep = (events.isna() | ~events.duplicated()).to_numpy()
+            df, events = df[keep], events[keep]
+
+            frames = {rollup: self._frame(df, self.rollups[rollup]) for rollup in changed}
+
+            connection.execute("BEGIN IMMEDIATE")
+            for rollup, frame in frames.items():
+                owners = self._replace_events(connection, dataset, rollup, segment, self._events(events, frame, self.rollups[rollup]))
+                # the segment only counts the events it is the first segment of, and the rows without an event
+                owned = [event is None or owners.get(event) == segment for event in events]
+                connection.execute("DELETE FROM partials WHERE dataset = ? AND rollup = ? AND segment = ?", (dataset, rollup, segment))
+                connection.executemany("INSERT INTO partials VALUES (?, ?, ?, ?, ?, ?)",
+                                       [(dataset, rollup, segment) + row for row in self._group(frame[owned], self.rollups[rollup])])
+                connection.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)", (dataset, rollup, segment, fingerprint, len(df)))
+            connection.execute("COMMIT")
+        return True
+
+    def _owners(self, connection, dataset, rollup):
+        '''Returns the first segment holding each event of the touched_events table.'''
+
+        return dict(connection.execute("SELECT event, MIN(segment) FROM events WHERE dataset = ? AND rollup = ? AND event IN (SELECT event FROM touched_events) "
+                                       "GROUP BY event", (dataset, rollup)).fetchall())
+
+    def _replace_events(self, connection, dataset, rollup, segment, event_rows):
+        '''
+        Replaces the (event, key, measures) rows of a segment and moves the events it gained or lost between the partials of the other segments.
+        Only the events of this segment are looked at. Returns the first segment holding each event of this segment.
+        '''
+
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS touched_events (event TEXT PRIMARY KEY)")
+        connection.execute("DELETE FROM touched_events")
+        connection.execute("INSERT OR IGNORE INTO touched_events SELECT event FROM events WHERE dataset = ? AND rollup = ? AND segment = ?", (dataset, rollup, segment))
+        connection.executemany("INSERT OR IGNORE INTO touched_events VALUES (?)", [(event,) for event, _, _ in event_rows])
+        before = self._owners(connection, dataset, rollup)
+
+        connection.execute("DELETE FROM events WHERE dataset = ? AND rollup = ? AND segment = ?", (dataset, rollup, segment))
+        connection.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", [(dataset, rollup, segment) + row for row in event_rows])
+        after = self._owners(connection, dataset, rollup)
+
+        # another segment that stops or starts being the first one holding an event takes its copy out of or into its partials
+        moved = {}
+        for event in set(before) | set(after):
+            for owner, sign in ((before.get(event), -1), (after.get(event), 1)):
+                if owner is not None and owner != segment and before.get(event) != after.get(event):
+                    moved.setdefault(owner, []).append((event, sign))
+        deltas = Counter()
+        for owner, changes in moved.items():
+            signs = dict(changes)
+            for event, key, measures in connection.execute("SELECT event, key, measures FROM events WHERE dataset = ? AND rollup = ? AND segment = ? "
+                                                           "AND event IN (SELECT event FROM touched_events)", (dataset, rollup, owner)):
+                if event in signs:
+                    deltas[(owner, key, "count")] += signs[event]
+                    for measure, value in zip(self.measures, json.loads(measures)):
+                        deltas[(owner, key, measure)] += signs[event] * value
+        connection.executemany("INSERT INTO partials VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (dataset, rollup, segment, key, measure) DO UPDATE SET value = value + excluded.value",
+                               [(dataset, rollup, owner, key, measure, value) for (owner, key, measure), value in deltas.items()])
+        return after
+
+    def retain(self, dataset, segments):
+        '''Drops the partial aggregates of the segments of a dataset that are no longer part of it.'''
+
+        segments = set(segments)
+        with self._connect() as connection:
+            stale = [row[0] for row in connection.execute("SELECT DISTINCT segment FROM segments WHERE dataset = ?", (dataset,)) if row[0] not in segments]
+            connection.execute("BEGIN IMMEDIATE")
+            for segment in stale:
+                # the events of a dropped segment are counted by the next segment holding them
+                for rollup in self.rollups:
+                    self._replace_events(connection, dataset, rollup, segment, [])
+                connection.execute("DELETE FROM partials WHERE dataset = ? AND segment = ?", (dataset, segment))
+                connection.execute("DELETE FROM events WHERE dataset = ? AND segment = ?", (dataset, segment))
+                connection.execute("DELETE FROM segments WHERE dataset = ? AND segment = ?", (dataset, segment))
+            connection.execute("COMMIT")
+        return len(stale)
+
+    def query(self, dataset, rollup=None, dimensions=None, **filters):
+        '''
+        Returns the counts and measure sums of a rollup of a dataset as a DataFrame with one row per group.
+        Groups can be rolled up further to a subset of the dimensions, and filtered by dimension values, e.g. year=2020 or Damage=["Destroyed", "Substantial"].
+        '''
+
+        rollup = rollup or next(iter(self.rollups))
+        if rollup not in self.rollups:
+            raise ValueError(f"Unknown rollup {rollup}. Known rollups are: {', '.join(self.rollups)}")
+        all_dimensions = list(self.rollups[rollup])
+        dimensions = list(dimensions or all_dimensions)
+        unknown = [dimension for dimension in dimensions + list(filters) if dimension not in all_dimensions]
+        if unknown:
+            raise ValueError(f"Rollup {rollup} has no dimension {', '.join(unknown)}")
+
+        with self._connect() as connection:
+            rows = connection.execute("SELECT key, measure, SUM(value) FROM partials WHERE dataset = ? AND rollup = ? GROUP BY key, measure",
+                                      (dataset, rollup)).fetchall()
+
+        records = {}
+        for key, measure, value in rows:
+            records.setdefault(key, dict(zip(all_dimensions, json.loads(key))))[measure] = value
+        # groups whose only events moved to another segment are left with a count of 0
+        records = {key: record for key, record in records.items() if record.get("count", 0) > 0}
+        df = pd.DataFrame(list(records.values()), columns=all_dimensions + ["count"] + self.measures)
+        for dimension, values in filters.items():
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            df = df[df[dimension].isin([value if dimension == "year" else str(value) for value in values])]
+        df = df.groupby(dimensions, dropna=False, as_index=False)[["count"] + self.measures].sum()
+        df["count"] = df["count"].astype("int64")
+        return df.sort_values(dimensions).reset_index(drop=True)
+
+def rollup(dataset = "./output/aggregated_data.csv", rollup = None, dimensions = None, path = rollup_path, **filters):
+    '''Reads a materialized rollup of a downloaded dataset, see RollupStore.query.'''
+
+    return RollupStore(path).query(dataset, rollup, dimensions, **filters)
+
+class QueryProgress:
+    '''
+    Query progress
+    Tracks the segments, rows and bytes a download has finished as their results come back from the pool, and estimates the time left.
+    A callback given to query() receives a snapshot after every segment, and snapshot() can be polled at any time.
+    '''
+    def __init__(self, total_segments, callback=None):
+        '''Initializes the QueryProgress class.'''
+
+        self.total_segments = total_segments
+        self.callback = callback
+        self.segments_done = 0
+        self.segments_failed = 0
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.updated = self.started
+
+    def update(self, rows, size, failed=False):
+        '''Records a finished segment, reports the progress and calls the callback.'''
+
+        if failed:
+            self.segments_failed += 1
+        else:
+            self.segments_done += 1
+        self.rows += rows
+        self.bytes += size
+        self.updated = time.time()
+
+        snapshot = self.snapshot()
+        eta = f", about {snapshot['eta_seconds']:.0f} s left" if snapshot['eta_seconds'] else ""
+        print(f"Completed {snapshot['segments_done']} of {snapshot['segments_total']} segments ({snapshot['rows']} rows, {snapshot['rows_per_second']:.1f} rows/s{eta})")
+        if self.callback is not None:
+            try:
+                self.callback(snapshot)
+            except Exception as e:
+                # a broken callback must not stop the download
+                print(f"Progress callback failed: {e}")
+        return snapshot
+
+    def snapshot(self):
+        '''Returns the progress so far, its rates and the estimated seconds left (None until a segment finished).'''
+
+        elapsed = max(time.time() - self.started, 1e-9)
+        finished = self.segments_done + self.segments_failed
+        remaining = self.total_segments - finished
+        return {
+            "segments_total": self.total_segments,
+            "segments_done": self.segments_done,
+            "segments_failed": self.segments_failed,
+            "segments_remaining": remaining,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "elapsed": elapsed,
+            "rows_per_second": self.rows / elapsed,
+            "bytes_per_second": self.bytes / elapsed,
+            "eta_seconds": elapsed / finished * remaining if finished else None,
+            "updated": self.updated
+        }
+
+def prefetch_segment(rules, kwargs):
+    '''Downloads a later segment into the export store in the background, so the worker that is handed it finds it stored.'''
+
+    job = getattr(rate_limit_context, 'job', None)
+    priority = getattr(rate_limit_context, 'priority', 1.0)
+    def run():
+        set_rate_limit_job(job, priority)
+        try:
+            q = build_query(*rules, require_all = kwargs['require_all'], has_key_constraint = kwargs['has_key_constraint'], export_format = kwargs.get('export_format', default_export_format))
+            store = ExportStore(export_store_path)
+            request_hash, _ = q.request_hash()
+
+            # claim the segment before probing it, the worker handed the segment waits for the claim instead of exporting it again
+            if store.get(request_hash) is not None or not store.acquire(request_hash):
+                return
+            try:
+                if not kwargs['only_download']:
+                    q.query(download = True)
+                else:
+                    q._result_list_count = 1
+            except Exception:
+                store.release(request_hash)
+                raise
+            if q._result_list_count:
+                q.download(claimed = True)
+            else:
+                store.release(request_hash)
+        except Exception as e:
+            print(f"Prefetching {rules} failed: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
+
+def submit_segment(segment, profile = None, profile_run = None, counts = None, **kwargs):
+    '''
+    Submits one (index, rules, prefetch rules) segment of a plan and returns its index, result count and csv file.
+    The prefetch rules (or None) name a later segment that is downloaded speculatively once this segment's export starts streaming.
+    If profile is the directory of a query profile, the segment is profiled and written there under the run id of the query for the query to merge.
+    counts holds the counts of the plan's segments known while planning, None where a segment was not counted.
+    '''
+
+    index, rules, prefetch_rules = segment
+    if prefetch_rules is not None and transport_prefetch and kwargs.get('download') and not kwargs.get('refresh'):
+        kwargs['prefetch'] = partial(prefetch_segment, prefetch_rules, dict(kwargs))
+    if counts is not None:
+        kwargs['expected_count'] = counts[index]
+    if profile is None:
+        q = submit_query(*rules, **kwargs)
+    else:
+        profiler = Profiler(profile, run = profile_run)
+        with profiler.phase("workers"):
+            q = submit_query(*rules, **kwargs)
+        profiler.dump(f"worker-{os.getpid()}-{index}")
+    return index, q._result_list_count, q._csv_file
+
+class PartialDataset:
+    '''
+    Partial dataset
+    Appends the cases of every finished segment to one CSV file while a download runs, and publishes a coverage manifest after each segment.
+    A reader can use the first `bytes` bytes of the partial file listed in the manifest, which always hold whole, de-duplicated rows of the segments marked done.
+    '''
+    def __init__(self, plan, aggregated_csv_file = "./output/aggregated_data.csv", order = 'plan', columns = None, rollups = None):
+        '''Initializes the PartialDataset class and publishes an empty manifest. Segments are also added to the given RollupStore.'''
+
+        base = os.path.splitext(aggregated_csv_file)[0]
+        self.aggregated_csv_file = aggregated_csv_file
+        self.path = f"{base}.partial.csv"
+        self.manifest_path = f"{base}.manifest.json"
+        self.order = order
+        self.started = time.time()
+
+        self.seen = SeenSet()
+        self.projection = projected_columns(columns)
+        self.read_columns = export_read_columns(self.projection)
+        self.rollups = rollups
+        self.segment_keys = []
+        if rollups is not None and self.read_columns is not None:
+            self.read_columns += [column for column in rollups.columns() if column not in self.read_columns]
+        self.columns = None
+        self.rows = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self.ids = []
+
+        # what every segment covers, so readers know which part of the data is complete
+        self.coverage = []
+        for index in range(len(plan.segments)):
+            entry = {"segment": index, "status": "pending", "rows": 0}
+            if plan.date_segments is not None:
+                window_start, window_end, count = plan.date_segments[index]
+                entry["event_dates"] = [f"{window_start:%Y-%m-%d}", f"{window_end:%Y-%m-%d}"]
+                entry["expected_rows"] = count
+            elif plan.key_segments is not None and index < len(plan.key_segments):
+                entry["event_ids"] = list(plan.key_segments[index])
+            self.coverage.append(entry)
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._publish()
+
+    def add(self, index, result_count, csv_file):
+        '''Appends the new cases of a finished segment to the partial file, publishes the manifest and returns the coverage entry of the segment.'''
+
+        entry = self.coverage[index]
+        entry["result_count"] = result_count
+        if csv_file:
+            try:
+                df = read_export(csv_file, columns = self.read_columns)
+
+                # stored exports are named after their request, so a segment keeps its key until its request changes
+                # the partial is taken from the whole export, cases already seen in other segments are only dropped when the rollup is read
+                if self.rollups is not None:
+                    segment_key = os.path.splitext(os.path.basename(csv_file))[0]
+                    file_stat = os.stat(csv_file)
+                    self.rollups.update(self.aggregated_csv_file, segment_key, f"{file_stat.st_size}-{file_stat.st_mtime_ns}", df)
+                    self.segment_keys.append(segment_key)
+
+                mask = self.seen.new_rows(df)
+                self.duplicates += len(df) - int(mask.sum())
+                df = df[mask]
+                if event_id_column in df.columns:
+                    self.ids.extend(pd.to_numeric(df[event_id_column], errors='coerce').dropna().astype(np.int64).tolist())
+
+                df = project_export(df, self.projection)
+                if self.columns is None:
+                    self.columns = list(df.columns)
+                df = df.reindex(columns=self.columns)
+
+                # the manifest is only published once the rows are on disk, so readers never see a torn row
+                with open(self.path, 'a', newline='') as partial_file:
+                    df.to_csv(partial_file, index=False, header=self.bytes == 0)
+                    partial_file.flush()
+                    os.fsync(partial_file.fileno())
+                    self.bytes = partial_file.tell()
+
+                self.rows += len(df)
+                entry["rows"] = len(df)
+                entry["status"] = "done"
+            except Exception as e:
+                print(f"Error reading {csv_file}: {e}")
+                entry["status"] = "failed"
+        else:
+            entry["status"] = "done" if result_count == 0 else "failed"
+        self._publish()
+        return entry
+
+    def _publish(self, complete = False):
+        '''Atomically replaces the coverage manifest.'''
+
+        done = sum(entry["status"] == "done" for entry in self.coverage)
+        manifest = {
+            "complete": complete,
+            "file": self.aggregated_csv_file if complete else self.path,
+            "bytes": self.bytes,
+            "rows": self.rows,
+            "order": self.order,
+            "columns": self.columns,
+            "segments_total": len(self.coverage),
+            "segments_done": done,
+            "segments_failed": sum(entry["status"] == "failed" for entry in self.coverage),
+            "failed_segments": [entry["segment"] for entry in self.coverage if entry["status"] == "failed"],
+            "started": self.started,
+            "updated": time.time(),
+            "coverage": self.coverage
+        }
+        temporary_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        os.replace(temporary_path, self.manifest_path)
+
+    def finish(self):
+        '''
+        Moves the partial file to the aggregated CSV file once every segment is done. Returns its path, or None if there were no results.
+        If any segment failed, the partial file and a manifest listing the failed segments are left in place and None is returned.
+        '''
+
+        failed = [entry["segment"] for entry in self.coverage if entry["status"] != "done"]
+        if failed:
+            self._publish()
+            print(f"\nSegments {', '.join(str(segment) for segment in failed)} failed, the download is incomplete.")
+            print(f"Partial data of the other segments is kept in {self.path}, see {self.manifest_path}")
+            return None
+
+        if self.columns is None:
+            print("No results returned.")
+            self._publish()
+            return None
+
+        os.replace(self.path, self.aggregated_csv_file)
+        self._publish(complete = True)
+
+        # segments that left the dataset no longer count towards its rollups
+        if self.rollups is not None:
+            self.rollups.retain(self.aggregated_csv_file, self.segment_keys)
+        if self.duplicates:
+            print(f"Dropped {self.duplicates} duplicate rows")
+        print(f"\nAggregated data saved to {self.aggregated_csv_file}")
+        print(f"Search Results: {self.rows}")
+        return self.aggregated_csv_file
+    
+def build_query(*args, require_all = True, has_key_constraint = False, export_format = default_export_format):
+    '''Builds a CAROLQuery from a list of query rules without sending it.'''
+
     # Query class
-    q = CAROLQuery()
+    q = CAROLQuery(export_format)
 
     # Sorts through the args
     for rule in args:
 
         # Add query rule from args
-        q.addQueryRule(rule.field, rule.subfield, rule.condition, rule.value, kwargs['require_all'], kwargs['has_key_constraint'])
+        q.addQueryRule(rule.field, rule.subfield, rule.condition, rule.value, require_all, has_key_constraint)
 
     # add "or" or "and" to values
-    q._values.append(f"require_all = {kwargs['require_all']}")
-    
+    q._values.append(f"require_all = {require_all}")
+    return q
+
+def submit_query(*args, **kwargs):
+    '''A single query to the CAROL Database.
+    The queries are input as a list of tuples or strings.
+    '''
+
+    q = build_query(*args, require_all = kwargs['require_all'], has_key_constraint = kwargs['has_key_constraint'], export_format = kwargs.get('export_format', default_export_format))
+    expected_count = kwargs.get('expected_count')
+
+    # Reuse a stored export of the same request while it holds as many cases as the plan counted, without probing it again
+    if kwargs['download'] and kwargs.get('refresh'):
+        ExportStore(export_store_path).forget(q.request_hash()[0])
+    elif kwargs['download'] and expected_count is not None and q.from_store(expected_count):
+        return q
+
     # Run the query
     if not kwargs['only_download']:
         q.query(download = kwargs['download'])
+        expected_count = q._result_list_count
     else:
-        q._result_list_count = 1
+        q._result_list_count = 1 if expected_count is None else expected_count
 
-    # Download query
+    # Download query, a stored export is only used if it holds as many cases as the probe counted
     if (kwargs['download']):
-        if q._result_list_count > 0:
-            q.download(kwargs['csv_files'], kwargs['number_complete'], kwargs['total_queries'])
-        elif (q._result_list_count == 0):
-            with complete_lock:
-                kwargs['total_queries'].value -= 1
+        if q._result_list_count is not None and q._result_list_count > 0:
+            q.download(kwargs.get('prefetch'), expected_count = expected_count)
     
     # Return query object
     return q
 
-def query(*args, download = False, require_all = True):
-    '''A one-time query to the CAROL Database.
-    The queries are input as a list of tuples or strings.
-    '''
-        
-    start_time = time.time()
+def search_key_bounds(gen_rule, require_all, has_key_constraint, histogram=None, signature=None):
+    '''Searches for the lowest and highest Event.ID segments containing results and returns them as key rules.'''
+
+    one_request = False
+    optimizing_result_count = 0
+
+    # Initialize the search bounds
+    lower_bound = 0
+    upper_bound = max_event_id
+    segment_size = 400
+
+    # search for the lowest valid segment
+    while upper_bound - lower_bound > segment_size:
+        middle = lower_bound + (upper_bound - lower_bound) // 2
+        print(f"Searching in the range ({lower_bound}, {middle})...\n")
+
+        # Create key constraints for the lower half of the search space
+        lower_bound_rule = query_rule("Event", "ID", "is greater than", str(lower_bound - 1))
+        upper_bound_rule = query_rule("Event", "ID", "is less than", str(middle))
+
+        # Check all rules in gen_rule
+        found = False
+        if require_all:
+            modified_gen_rule = gen_rule + (lower_bound_rule, upper_bound_rule)
+
+            # Resubmit the query with the updated search space
+            optimizing_result_count = submit_query(*modified_gen_rule, download=False, require_all=True, only_download=one_request, has_key_constraint=has_key_constraint)._result_list_count
+            if histogram:
+                histogram.observe(signature, lower_bound, middle - 1, optimizing_result_count)
+            
+            if optimizing_result_count > 0:
+                found = True
+        else:
+            found = False
+            for rule in gen_rule:
+                modified_gen_rule = (rule, ) + (lower_bound_rule, upper_bound_rule)
+
+                # Resubmit the query with the updated search space
+                optimizing_result_count = submit_query(*modified_gen_rule, download=False, require_all=True, only_download=one_request, has_key_constraint=has_key_constraint)._result_list_count
+                
+                if optimizing_result_count > 0:
+                    found = True
+                    break
+                
+        print(f'Found {optimizing_result_count} results in the range ({lower_bound}, {middle})')
+
+        if found:
+            # If a result is found in the lower half, continue searching in the lower half
+            upper_bound = middle
+        else:
+            # If no result is found in the lower half, search in the upper half
+            lower_bound = middle + 1
+
+    # set global lower bound
+    global_lower_bound_rule = query_rule("Event", "ID", "is greater than", str(lower_bound - 1))
     
+    # reinit search bounds
+    lower_bound = 0
+    upper_bound = max_event_id
+    segment_size = 400
+
+    # search for the highest valid segmentq
+    while upper_bound - lower_bound > segment_size:
+        middle = lower_bound + (upper_bound - lower_bound) // 2
+        print(f"Searching in the range ({middle}, {upper_bound})...\n")
+
+        # Create key constraints for the lower half of the search space
+        lower_bound_rule = query_rule("Event", "ID", "is greater than", str(middle - 1))
+        upper_bound_rule = query_rule("Event", "ID", "is less than", str(upper_bound))
+
+        # Check all rules in gen_rule
+        found = False
+        if require_all:
+            modified_gen_rule = gen_rule + (lower_bound_rule, upper_bound_rule)
+
+            # Resubmit the query with the updated search space
+            optimizing_result_count = submit_query(*modified_gen_rule, download=False, require_all=True, only_download=one_request, has_key_constraint=has_key_constraint)._result_list_count
+            if histogram:
+                histogram.observe(signature, middle, upper_bound - 1, optimizing_result_count)
+            
+            if optimizing_result_count > 0:
+                found = True
+        else:
+            found = False
+            for rule in gen_rule:
+                modified_gen_rule = (rule,) + (lower_bound_rule, upper_bound_rule)
+
+                # Resubmit the query with the updated search space
+                optimizing_result_count = submit_query(*modified_gen_rule, download=False, require_all=True, only_download=one_request, has_key_constraint=has_key_constraint)._result_list_count
+                
+                if optimizing_result_count > 0:
+                    found = True
+                    break
+
+        print(f'Found {optimizing_result_count} results in the range ({middle}, {upper_bound})')
+
+        if found:
+            # If a result is found in the upper half, continue searching in the upper half
+            lower_bound = middle
+        else:
+            # If no result is found in the lower half, search in the upper half
+            upper_bound = middle - 1
+
+    # set global upper bound
+    global_upper_bound_rule = query_rule("Event", "ID", "is less than", str(upper_bound))
+
+    return global_lower_bound_rule, global_upper_bound_rule
+
+class CompiledRule:
+    '''
+    Compiled query rule
+    The field, subfield, condition and value an argument compiles to, or the error that kept it from compiling.
+    '''
+    __slots__ = ("arg", "field", "subfield", "condition", "value", "error", "error_type")
+
+    def __init__(self, arg, field=None, subfield=None, condition=None, value=None, error=None, error_type=None):
+        '''Initializes the CompiledRule class.'''
+
+        self.arg = arg
+        self.field = field
+        self.subfield = subfield
+        self.condition = condition
+        self.value = value
+        self.error = error
+        self.error_type = error_type
+
+    @property
+    def ok(self):
+        '''True if the argument compiled to a complete rule.'''
+        return self.error is None
+
+    def to_rule(self):
+        '''Creates a new query_rule, raising the compile error if there was one.'''
+
+        if self.error is not None:
+            raise (MalformedQueryError if self.error_type == "MalformedQueryError" else ValueError)(self.error)
+        return query_rule(self.field, self.subfield, self.condition, self.value)
+
+    def as_dict(self):
+        '''Returns the compiled rule as a dictionary.'''
+        return {name: getattr(self, name) for name in self.__slots__}
+
+def rule_cache_key(arg):
+    '''Returns the hashable form of a raw query argument that compiled rules are cached under.'''
+
+    if isinstance(arg, (list, tuple)):
+        return tuple(arg)
+    return arg
+
+@lru_cache(maxsize=rule_cache_size)
+def _compile_rule(arg):
+    '''Compiles one hashable raw argument into a CompiledRule.'''
+
+    try:
+        field, subfield, condition, value = query_rule_sort(arg, confirm = False)
+    except (MalformedQueryError, ValueError, TypeError, IndexError) as e:
+        return CompiledRule(arg, error=str(e), error_type=type(e).__name__)
+
+    # Check to make sure all query parameters were filled
+    e_list = []
+    if not field:
+        e_list.append("Field")
+    if not subfield and field != "HasSafetyRec":
+        e_list.append("Subfield")
+    if not condition:
+        e_list.append("Condition")
+    if not value:
+        e_list.append("Value")
+    if len(e_list):
+        return CompiledRule(arg, field, subfield, condition, value, f"Incorrect {e_list} found in argument {arg}.", "ValueError")
+    return CompiledRule(arg, field, subfield, condition, value)
+
+def compile_rules(args, confirm = True):
+    '''
+    Compiles raw query arguments into CompiledRules, which carry their errors instead of raising them.
+    Every distinct argument is compiled once and kept in an LRU cache, so repeated arguments and repeated catalogs cost a lookup.
+    If confirm is set, full sentences are confirmed interactively before they are searched for in the Factual Narrative.
+    '''
+
+    compiled = {}
+    results = []
+    for arg in args:
+        key = rule_cache_key(arg)
+        try:
+            hash(key)
+        except TypeError:
+            results.append(CompiledRule(arg, error=f"Unsupported argument {arg}.", error_type="ValueError"))
+            continue
+        if key not in compiled:
+            single = key if isinstance(key, str) else key[0] if len(key) == 1 else None
+            if confirm and isinstance(single, str):
+                try:
+                    confirm_long_search(single)
+                except MalformedQueryError as e:
+                    compiled[key] = CompiledRule(arg, error=str(e), error_type="MalformedQueryError")
+            if key not in compiled:
+                compiled[key] = _compile_rule(key)
+        results.append(compiled[key])
+    return results
+
+def rule_cache_info():
+    '''Returns the hit and miss counts of the compiled rule cache.'''
+    return _compile_rule.cache_info()
+
+def parse_query_args(args, download=False, confirm=True):
+    '''Sorts query arguments into query rules and collects the Event.ID key constraints of a download. Full sentences are only confirmed interactively if confirm is set.'''
+
     key_constraints = []
     general_constraints = []
 
@@ -777,222 +3003,868 @@ def query(*args, download = False, require_all = True):
         raise ValueError("No queries found")
 
     # Sorts through the args
-    for arg in args:
-        field, subfield, condition, value = query_rule_sort(arg)
-        
-        # Check to make sure all query parameters were filled
-        e_list = []
-        if not field:
-            e_list.append("Field")
-        if not subfield and field != "HasSafetyRec":
-            e_list.append("Subfield")
-        if not condition:
-            e_list.append("Condition")
-        if not value:
-            e_list.append("Value")
-            
-        if len(e_list):
-            raise ValueError(f"Incorrect {e_list} found in argument {arg}.")
-        
-        # create query_rule object
-        rule = query_rule(field, subfield, condition, value)
+    for compiled in compile_rules(args, confirm):
+        # create query_rule object, raising the first compile error
+        rule = compiled.to_rule()
+        subfield, condition, value = rule.subfield, rule.condition, rule.value
         
         if subfield == "ID" and download == True:
             key_constraints.append(f'{condition} {value}')
             general_constraints.append(rule)
         else:
             general_constraints.append(rule)
-        
+
+    return general_constraints, key_constraints
+
+class QueryPlan:
+    '''
+    Query plan
+    Holds the segments a download is split into and how each of them is submitted to the CAROL database.
+    '''
+    def __init__(self, rules, require_all):
+        '''Initializes the QueryPlan class.'''
+
+        self.rules = tuple(rules)
+        self.require_all = require_all
+        self.key = None
+        self.segments = []
+        self.only_download = False
+        self.has_key_constraint = False
+        self.one_request = False
+
+        # export downloaded for every segment and the columns kept from it, None keeps every column
+        self.export_format = default_export_format
+        self.columns = None
+
+        # Event.ID ranges or EventDate windows matching the segments
+        self.key_segments = None
+        self.date_segments = None
+
+        # counts of the segments known while planning, None where a segment was not counted
+        self.counts = None
+
+        # histogram refreshed once the segments are downloaded
+        self.histogram = None
+        self.signature = None
+        self.histogram_ranges = None
+
+    def submit_kwargs(self):
+        '''Returns the submit_query key word arguments shared by every segment of the plan.'''
+
+        return {"require_all": self.require_all, "only_download": self.only_download, "has_key_constraint": self.has_key_constraint, "export_format": self.export_format}
+
+def plan_query(*args, require_all = True, histogram_path = id_histogram_path, spot_checks = 0, planner = 'auto', export_format = default_export_format, columns = None, revalidate = False, store_path = None, confirm = True):
+    '''
+    Plans how a download is split into segments. Returns None if the query has no results.
+    If revalidate is True, the segments of the last plan of the same query are revalidated in the export store first,
+    and Event.ID segments planned from the histogram keep the boundaries of those that still fit in one export.
+    If confirm is False, full sentences are searched for in the Factual Narrative without asking.
+    '''
+
+    if export_format not in export_formats:
+        raise ValueError(f"Unknown export format {export_format}. Valid export formats are: {', '.join(export_formats)}")
+    columns = projected_columns(columns)
+
+    # choose how large downloads are split, EventDate windows are used by default for date bounded queries
+    if planner not in ('auto', 'id', 'date'):
+        raise ValueError(f"Unknown planner {planner}. Valid planners are: auto, id, date")
+    if planner == 'date' and not require_all:
+        raise ValueError("The EventDate planner requires require_all = True.")
+
+    with profile_phase("parse"):
+        general_constraints, key_constraints = parse_query_args(args, download=True, confirm=confirm)
     has_key_constraint = len(key_constraints) > 0
     gen_rule = tuple(general_constraints)
-    if download == False:
-        submit_query(*gen_rule, download = download, require_all = require_all, only_download = False, has_key_constraint = has_key_constraint)
-    else:
-        
-        global_lower_bound_rule = None
-        global_upper_bound_rule = None
-        
-        one_request = False
+    plan = QueryPlan(gen_rule, require_all)
+    plan.key = plan_key(general_constraints, key_constraints, require_all, export_format)
+    plan.export_format = export_format
+    plan.columns = columns
+
+    # stored segments are revalidated by their own rules, a re-plan would move the boundaries of histogram sized segments
+    pinned = None
+    revalidated = {}
+    if revalidate:
+        previous = ExportStore(store_path or export_store_path).get_plan(plan.key)
+        if previous is None:
+            print("No earlier plan of this query is stored, only exports of identical segments are reused\n")
+        else:
+            counts = revalidate_plan(previous, store_path = store_path)
+            revalidated = {segment_key(segment): count for segment, count in zip(previous.segments, counts)}
+            if previous.key_segments is not None:
+                # segments that grew too large for one export are planned again
+                pinned = [segment for segment, count in zip(previous.key_segments, counts) if count is None or count < max_export_count]
+
+    global_lower_bound_rule = None
+    global_upper_bound_rule = None
+    one_request = False
+    date_segments = None
+    date_start, date_end, date_bounding_rules = event_date_bounds(general_constraints)
+    use_date_planner = planner == 'date' or (planner == 'auto' and require_all and not has_key_constraint and len(date_bounding_rules) > 0)
+
+    # the Event.ID density of this query lets us split a large query without the bounds search
+    histogram = None
+    histogram_ranges = None
+    estimate_signature = None
+    planned_segments = None
+    signature = rule_signature(general_constraints, require_all)
+    if histogram_path and (require_all or not has_key_constraint):
+        histogram = IDHistogram(histogram_path)
+        histogram_ranges = generate_key_segments_and(max_event_id + 1, key_constraints)
+    plan.histogram = histogram
+    plan.signature = signature
+    plan.histogram_ranges = histogram_ranges
+
+    # one count probe tells whether the query needs splitting at all, a histogram only ever gives an upper bound
+    with profile_phase("bounds"):
         print("Checking number of datapoints for request...\n")
         result_count = submit_query(*gen_rule, download = False, require_all = require_all, only_download = one_request, has_key_constraint = False)._result_list_count
-        if 0 < result_count < 3500:
-            print("Good news! We can download the data in one request.")
-            one_request = True
-        elif result_count == 0:
-            print("No results found.")
-            return
+    if result_count is None:
+        raise ProbeFailedError("Could not count the results of the query. Check your connection and try again.")
+    if 0 < result_count < max_export_count:
+        print("Good news! We can download the data in one request.")
+        one_request = True
+    elif result_count == 0:
+        print("No results found.")
+        return None
+    else:
+        print("Query too big for one reqeust. Dividing into segments and optimizing search\n")
+        # counts of unfiltered queries are an upper bound, which is only worth using for a query that must be split anyway
+        estimate_signature = histogram.lookup(signature) if histogram else None
+        if planner != 'date' and estimate_signature and histogram.covers(estimate_signature, histogram_ranges):
+            print(f"Planning segments from the Event.ID histogram for {estimate_signature}\n")
+            planned_segments = pinned_key_segments(histogram, estimate_signature, histogram_ranges, pinned)
+            if spot_checks:
+                with profile_phase("bounds"):
+                    planned_segments = spot_check_segments(planned_segments, histogram, signature, estimate_signature, [x for x in general_constraints if x.subfield != 'ID'], require_all, spot_checks)
+        else:
+            with profile_phase("bounds"):
+                if use_date_planner:
+                    # EventDate windows need no Event.ID bounds search, unless a sparse query would take too many probes to split
+                    max_probes = None if planner == 'date' else date_planner_probe_margin + 2 * -(-result_count // max_export_count)
+                    date_segments = plan_date_segments([x for x in gen_rule if x not in date_bounding_rules], date_start, date_end, total = result_count, max_probes = max_probes)
+                    if date_segments is None:
+                        print("Splitting the query into Event.ID segments instead\n")
+                if date_segments is None and not has_key_constraint:
+                    global_lower_bound_rule, global_upper_bound_rule = search_key_bounds(gen_rule, require_all, has_key_constraint, histogram, signature)
+
+    if one_request:
+        plan.one_request = True
+        plan.only_download = True
+        plan.segments = [gen_rule]
+        plan.counts = [result_count]
+        return plan
+
+    if date_segments is not None:
+        # EventDate windows were already counted while planning, so they can be downloaded without probing again
+        plan.date_segments = date_segments
+        plan.only_download = True
+        plan.segments = format_date_segments_as_constraints(date_segments, [x for x in gen_rule if x not in date_bounding_rules])
+        plan.counts = [count for _, _, count in date_segments]
+        return plan
+
+    complement_flag = True
+    if global_lower_bound_rule:
+        # restrict based on optimization
+        key_constraints.append(f'{global_lower_bound_rule.condition} {global_lower_bound_rule.value}')
+        complement_flag = False
+    if global_upper_bound_rule:
+        # restrict based on optimization
+        key_constraints.append(f'{global_upper_bound_rule.condition} {global_upper_bound_rule.value}')
+        complement_flag = False
+
+    # generate key segments correlating with key constraints
+    key_segments = []
+    key_complement = []
+    key_segment_length = 400
+    if planned_segments is not None:
+        complement_flag = False
+        key_segments = planned_segments
+    elif require_all:
+        complement_flag = False
+        if estimate_signature:
+            # size segments from the parts of the histogram we already know
+            key_segments = pinned_key_segments(histogram, estimate_signature, generate_key_segments_and(max_event_id + 1, key_constraints), pinned)
         else:
-            print("Query too big for one reqeust. Dividing into segments and optimizing search\n")
-            optimizing_result_count = 0
-            if not has_key_constraint:
-                # Initialize the search bounds
-                lower_bound = 0
-                upper_bound = 200000
-                segment_size = 400
-
-                # search for the lowest valid segment
-                while upper_bound - lower_bound > segment_size:
-                    middle = lower_bound + (upper_bound - lower_bound) // 2
-                    print(f"Searching in the range ({lower_bound}, {middle})...\n")
-
-                    # Create key constraints for the lower half of the search space
-                    lower_bound_rule = query_rule("Event", "ID", "is greater than", str(lower_bound - 1))
-                    upper_bound_rule = query_rule("Event", "ID", "is less than", str(middle))
-
-                    # Check all rules in gen_rule
-                    found = False
-                    if require_all:
-                        modified_gen_rule = gen_rule + (lower_bound_rule, upper_bound_rule)
-
-                        # Resubmit the query with the updated search space
-                        optimizing_result_count = submit_query(*modified_gen_rule, download=False, require_all=True, only_download=one_request, has_key_constraint=has_key_constraint)._result_list_count
-                        
-                        if optimizing_result_count > 0:
-                            found = True
-                    else:
-                        found = False
-                        for rule in gen_rule:
-                            modified_gen_rule = (rule, ) + (lower_bound_rule, upper_bound_rule)
-
-                            # Resubmit the query with the updated search space
-                            optimizing_result_count = submit_query(*modified_gen_rule, download=False, require_all=True, only_download=one_request, has_key_constraint=has_key_constraint)._result_list_count
-                            
-                            if optimizing_result_count > 0:
-                                found = True
-                                break
-                            
-                    print(f'Found {optimizing_result_count} results in the range ({lower_bound}, {middle})')
-
-                    if found:
-                        # If a result is found in the lower half, continue searching in the lower half
-                        upper_bound = middle
-                    else:
-                        # If no result is found in the lower half, search in the upper half
-                        lower_bound = middle + 1
-
-                # set global lower bound
-                global_lower_bound_rule = query_rule("Event", "ID", "is greater than", str(lower_bound - 1))
-                
-                # reinit search bounds
-                lower_bound = 0
-                upper_bound = 200000
-                segment_size = 400
-
-                # search for the highest valid segmentq
-                while upper_bound - lower_bound > segment_size:
-                    middle = lower_bound + (upper_bound - lower_bound) // 2
-                    print(f"Searching in the range ({middle}, {upper_bound})...\n")
-
-                    # Create key constraints for the lower half of the search space
-                    lower_bound_rule = query_rule("Event", "ID", "is greater than", str(middle - 1))
-                    upper_bound_rule = query_rule("Event", "ID", "is less than", str(upper_bound))
-
-                    # Check all rules in gen_rule
-                    found = False
-                    if require_all:
-                        modified_gen_rule = gen_rule + (lower_bound_rule, upper_bound_rule)
-
-                        # Resubmit the query with the updated search space
-                        optimizing_result_count = submit_query(*modified_gen_rule, download=False, require_all=True, only_download=one_request, has_key_constraint=has_key_constraint)._result_list_count
-                        
-                        if optimizing_result_count > 0:
-                            found = True
-                    else:
-                        found = False
-                        for rule in gen_rule:
-                            modified_gen_rule = (rule,) + (lower_bound_rule, upper_bound_rule)
-
-                            # Resubmit the query with the updated search space
-                            optimizing_result_count = submit_query(*modified_gen_rule, download=False, require_all=True, only_download=one_request, has_key_constraint=has_key_constraint)._result_list_count
-                            
-                            if optimizing_result_count > 0:
-                                found = True
-                                break
-
-                    print(f'Found {optimizing_result_count} results in the range ({middle}, {upper_bound})')
-
-                    if found:
-                        # If a result is found in the upper half, continue searching in the upper half
-                        lower_bound = middle
-                    else:
-                        # If no result is found in the lower half, search in the upper half
-                        upper_bound = middle - 1
-
-                # set global upper bound
-                global_upper_bound_rule = query_rule("Event", "ID", "is less than", str(upper_bound))
-
-        complement_flag = True
-        if global_lower_bound_rule:
-            # restrict based on optimization
-            key_constraints.append(f'{global_lower_bound_rule.condition} {global_lower_bound_rule.value}')
-            complement_flag = False
-        if global_upper_bound_rule:
-            # restrict based on optimization
-            key_constraints.append(f'{global_upper_bound_rule.condition} {global_upper_bound_rule.value}')
-            complement_flag = False
-    
-        # generate key segments correlating with key constraints
-        key_segments = []
-        key_complement = []
-        key_segment_length = 400
-        has_key_constraint = True
-        if require_all:
-            complement_flag = False
             key_segments = generate_key_segments_and(key_segment_length, key_constraints)
-        elif not key_constraints:
-            key_segments, _ = generate_key_segments_or(key_segment_length, key_constraints)
-        elif key_constraints:
-            key_segments, key_complement = generate_key_segments_or(key_segment_length, key_constraints)
+    elif not key_constraints:
+        key_segments, _ = generate_key_segments_or(key_segment_length, key_constraints)
+    elif key_constraints:
+        key_segments, key_complement = generate_key_segments_or(key_segment_length, key_constraints)
 
-        # remove key constraints from general constraints
-        if require_all:
-            general_constraints = [x for x in general_constraints if x.subfield != 'ID']
+    # overlapping segments would download the same cases more than once
+    key_segments = disjoint_key_segments(key_segments)
+    key_complement = disjoint_key_segments(key_segments + list(key_complement))[len(key_segments):]
 
-        # generate query segments
-        query_segments = []
-        if complement_flag:
-            query_segments = format_segments_as_constraints(key_segments, general_constraints, key_complement)
+    # remove key constraints from general constraints
+    if require_all:
+        general_constraints = [x for x in general_constraints if x.subfield != 'ID']
+
+    # generate query segments
+    if complement_flag:
+        plan.segments = format_segments_as_constraints(key_segments, general_constraints, key_complement)
+    else:
+        plan.segments = format_segments_as_constraints(key_segments, general_constraints, [])
+    plan.key_segments = [tuple(segment) for segment in key_segments]
+    plan.has_key_constraint = True
+    # segments that were just revalidated are not probed again
+    if revalidated:
+        plan.counts = [revalidated.get(segment_key(segment)) for segment in plan.segments]
+    return plan
+
+def revalidate_plan(plan, max_workers = revalidate_workers, store_path = None):
+    '''
+    Checks the stored exports of a plan against cheap count probes, a few at a time.
+    Exports whose count or first page of results changed are dropped from the store so that only they are downloaded again.
+    Returns the live count of every segment, or None for segments that are not stored or could not be probed.
+    '''
+
+    store = ExportStore(store_path or export_store_path)
+    stored = []
+    new = 0
+    for index, segment in enumerate(plan.segments):
+        q = build_query(*segment, require_all = plan.require_all, has_key_constraint = plan.has_key_constraint, export_format = plan.export_format)
+        request_hash, _ = q.request_hash()
+        entry = store.get(request_hash)
+        if entry is None:
+            new += 1
         else:
-            query_segments = format_segments_as_constraints(key_segments, general_constraints, [])
-                    
-        # Create a multiprocessing Pool with the desired number of processes
-        num_processes = cpu_count()  # Use all available CPU cores
-        ql = Lock() # query lock
-        dl = Lock() # download lock
-        fl = Lock() # file lock
-        cl = Lock() # complete lock
-        pool = Pool(initializer=init, initargs=(ql, dl, fl, cl), processes=num_processes)
-        
+            stored.append((index, q, request_hash, entry))
+
+    # probe threads are charged to the job of the caller
+    job = getattr(rate_limit_context, 'job', None)
+    priority = getattr(rate_limit_context, 'priority', 1.0)
+
+    def changed(item):
+        _, q, request_hash, entry = item
+        set_rate_limit_job(job, priority)
+        # a count kept by the probe cache of a service may be older than the stored export
+        q.query(cached = False)
+        if q._result_list_count is None:
+            # keep the stored export if the server could not be reached
+            return False
+        if q._result_list_count != entry["row_count"]:
+            return True
+        return q._probe_hash is not None and entry["probe_hash"] is not None and q._probe_hash != entry["probe_hash"]
+
+    print(f"Revalidating {len(stored)} stored segments...\n")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        changes = list(executor.map(changed, stored))
+
+    counts = [None] * len(plan.segments)
+    for (index, q, request_hash, entry), is_changed in zip(stored, changes):
+        counts[index] = q._result_list_count
+        if is_changed:
+            store.forget(request_hash)
+
+    print(f"Revalidated {len(stored)} stored segments: {changes.count(False)} unchanged, {changes.count(True)} changed, {new} not stored")
+    return counts
+
+def refresh_id_histogram(plan, segment_results, ids):
+    '''Refreshes the Event.ID histogram of a plan from the (result count, csv file) of each downloaded segment and the Event.IDs of the downloaded cases.'''
+
+    histogram = plan.histogram
+    if not histogram:
+        return
 
-        # Create a multiprocessing-safe list to store CSV file names generated by each process
-        manager = Manager()
-        csv_files = manager.list()
-        number_complete = manager.Value('i', 0)
-        total_queries = manager.Value('i', len(query_segments))
+    covered = []
+    if plan.key_segments is None:
+        # the whole query was downloaded, so every Event.ID range it touches is covered
+        if all(count == 0 or csv_file for count, csv_file in segment_results):
+            covered = plan.histogram_ranges
+    else:
+        for (lower, upper), (count, csv_file) in zip(plan.key_segments, segment_results):
+            histogram.observe(plan.signature, lower, upper, count)
+            if count == 0 or csv_file:
+                covered.append((lower, upper))
+    if ids is not None:
+        histogram.observe_rows(plan.signature, ids, covered)
+    histogram.save()
+
+def query(*args, download = False, require_all = True, histogram_path = id_histogram_path, spot_checks = 0, planner = 'auto', aggregated_csv_file = "./output/aggregated_data.csv", refresh = False, priority = 1.0, order = 'plan', profile = None, progress = None, export_format = default_export_format, columns = None, rollups = None, confirm = True):
+    '''A one-time query to the CAROL Database.
+    The queries are input as a list of tuples or strings.
+    Returns the result count, or the path of the aggregated CSV file when downloading (None if a segment could not be downloaded).
+    While downloading, the finished segments are published as a partial dataset next to the aggregated CSV file, in the given order.
+    If profile is True (or a directory), each phase of the query is profiled and a report is written to ./output/profile (or that directory).
+    If progress is a callable, it is called with a QueryProgress snapshot after every downloaded segment.
+    When downloading, only the given columns of the export are parsed and kept, and export_format picks the CAROL export.
+    If rollups is True (or a dict of rollup names and dimensions), the rollups of the aggregated CSV file are refreshed from the segments that changed.
+    If confirm is False, full sentences are searched for in the Factual Narrative without asking, as in a service or script that has no one to ask.
+    '''
         
-        # Use the map function to distribute the segments among processes
-        with pool as p:
-            if one_request:
-                p.starmap(partial(submit_query, download = download, require_all = require_all, csv_files = csv_files, number_complete = number_complete, total_queries = manager.Value('i', 1), only_download = one_request, has_key_constraint = False), [gen_rule])
-            else:
-                p.starmap(partial(submit_query, download = download, require_all = require_all, csv_files = csv_files, number_complete = number_complete, total_queries = total_queries, only_download = one_request, has_key_constraint = has_key_constraint), query_segments)
+    start_time = time.time()
 
-        # Close the pool to free up resources
-        pool.close()
-        pool.join()  # Wait for all processes to finish
-        
-        # for segment in query_segments:
-        #     print(segment[0])
-        #     process_segment(segment)
+    # every request of this query, including those of its pool workers, is charged to one job in the host-wide rate limiter
+    rate_limit_job = f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}-{start_time}"
+    set_rate_limit_job(rate_limit_job, priority)
+    result = None
+
+    profiler = None
+    if profile:
+        profiler = Profiler(profile if isinstance(profile, str) else profile_path)
+        profiler.clear_stale()
+    profile_context.profiler = profiler
 
-        csv_files = list(csv_files)
-        csv_files.sort(reverse=True)
-        aggregate_csv_files(csv_files)
+    try:
+        if download == False:
+            with profile_phase("parse"):
+                general_constraints, key_constraints = parse_query_args(args, download, confirm)
+            with profile_phase("bounds"):
+                result = submit_query(*general_constraints, download = download, require_all = require_all, only_download = False, has_key_constraint = len(key_constraints) > 0)._result_list_count
+        else:
+            with profile_phase("plan"):
+                # only download the stored segments whose counts changed, plus the new ones
+                plan = plan_query(*args, require_all = require_all, histogram_path = histogram_path, spot_checks = spot_checks, planner = planner, export_format = export_format, columns = columns,
+                                  revalidate = refresh == 'revalidate', confirm = confirm)
+                if plan is None:
+                    return
+                if refresh == 'revalidate':
+                    refresh = False
+                ExportStore(export_store_path).put_plan(plan)
+                schedule = order_segments(plan, order)
+
+            with profile_phase("download"):
+                # Create a multiprocessing Pool with the desired number of processes
+                num_processes = cpu_count()  # Use all available CPU cores
+                pool = Pool(initializer=init, initargs=(rate_limit_job, priority), processes=num_processes)
+
+                # Distribute the segments among processes in the scheduled order, results come back through the pool's result pipe
+                # and each segment is published and counted as soon as it is finished
+                rollup_store = None
+                if rollups:
+                    rollup_store = RollupStore(rollup_path, rollups if isinstance(rollups, dict) else None)
+                dataset = PartialDataset(plan, aggregated_csv_file, order, plan.columns, rollup_store)
+                query_progress = QueryProgress(len(plan.segments), progress)
+                segment_results = [(None, None)] * len(plan.segments)
+                with pool as p:
+                    segment_args = partial(submit_segment, profile = profiler.directory if profiler else None, profile_run = profiler.run if profiler else None, counts = plan.counts, download = download, refresh = refresh, **plan.submit_kwargs())
+                    # every worker prefetches the segment it is likely to be handed next
+                    tasks = [(index, plan.segments[index], plan.segments[schedule[position + num_processes]] if position + num_processes < len(schedule) else None)
+                             for position, index in enumerate(schedule)]
+                    for index, result_count, csv_file in p.imap_unordered(segment_args, tasks):
+                        segment_results[index] = (result_count, csv_file)
+                        with profile_phase("aggregate"):
+                            entry = dataset.add(index, result_count, csv_file)
+                        query_progress.update(entry["rows"], os.path.getsize(csv_file) if csv_file and os.path.exists(csv_file) else 0, entry["status"] == "failed")
+
+                # Close the pool to free up resources
+                pool.close()
+                pool.join()  # Wait for all processes to finish
+        
+            # for segment in query_segments:
+            #     print(segment[0])
+            #     process_segment(segment)
+
+            with profile_phase("aggregate"):
+                result = dataset.finish()
+
+                # refresh the histogram with what we just learned about this query
+                refresh_id_histogram(plan, segment_results, dataset.ids)
+    finally:
+        profile_context.profiler = None
+        if profiler is not None:
+            profiler.collect("worker")
+            profiler.report()
     
     end_time = time.time()
     execution_time = end_time - start_time
 
     print(f"Execution time: {execution_time:.6f} seconds")
+    return result
+
+class WorkQueue:
+    '''
+    Shared work queue
+    Stores the segments of planned downloads in a SQLite database, so that workers on any host sharing the database can lease, download and report them.
+    '''
+    def __init__(self, path=work_queue_path, lease_seconds=work_queue_lease_seconds, max_attempts=3):
+        '''Opens the work queue, creating its tables if necessary.'''
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (job TEXT PRIMARY KEY, plan TEXT, created REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS segments (job TEXT, segment INTEGER, rules TEXT, status TEXT, worker TEXT, "
+                               "lease_expires REAL, attempts INTEGER, result_count INTEGER, csv_file TEXT, PRIMARY KEY (job, segment))")
+            # queues created before segments were scheduled have no rank column
+            if "rank" not in [column[1] for column in connection.execute("PRAGMA table_info(segments)")]:
+                connection.execute("ALTER TABLE segments ADD COLUMN rank INTEGER")
+
+    def _connect(self):
+        '''Opens a connection that waits for other writers instead of failing.'''
+
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.execute("PRAGMA busy_timeout = 60000")
+        return _ClosingConnection(connection)
+
+    def publish(self, plan, job=None, order='plan'):
+        '''Writes the segments of a plan to the queue, ranked in the given order, and returns the job id.'''
+
+        if job is None:
+            job = hashlib.sha1(f"{plan.signature} {time.time()} {os.getpid()}".encode()).hexdigest()[:12]
+
+        # everything needed to submit the segments and merge the results later on
+        plan_data = {
+            "require_all": plan.require_all,
+            "only_download": plan.only_download,
+            "has_key_constraint": plan.has_key_constraint,
+            "signature": plan.signature,
+            "histogram_path": plan.histogram.path if plan.histogram else None,
+            "histogram_ranges": plan.histogram_ranges,
+            "key_segments": plan.key_segments,
+            "export_format": plan.export_format,
+            "columns": plan.columns,
+            "counts": plan.counts
+        }
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("INSERT INTO jobs VALUES (?, ?, ?)", (job, json.dumps(plan_data), time.time()))
+            connection.executemany("INSERT INTO segments (job, segment, rules, status, attempts, rank) VALUES (?, ?, ?, 'pending', 0, ?)",
+                                   [(job, index, json.dumps([rule_to_list(rule) for rule in plan.segments[index]]), rank)
+                                    for rank, index in enumerate(order_segments(plan, order))])
+            connection.execute("COMMIT")
+
+        print(f"Published {len(plan.segments)} segments as job {job}")
+        return job
+
+    def claim(self, worker, job=None):
+        '''Leases the next pending segment (or one whose lease expired) to a worker. Returns None if there is nothing to claim.'''
+
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            # leases that expired too often are given up on
+            connection.execute("UPDATE segments SET status = 'failed' WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, self.max_attempts))
+            row = connection.execute("SELECT job, segment, rules FROM segments WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) "
+                                     "AND (? IS NULL OR job = ?) ORDER BY job, COALESCE(rank, segment), segment LIMIT 1", (now, job, job)).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            connection.execute("UPDATE segments SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE job = ? AND segment = ?",
+                               (worker, now + self.lease_seconds, row[0], row[1]))
+            plan_data = json.loads(connection.execute("SELECT plan FROM jobs WHERE job = ?", (row[0],)).fetchone()[0])
+            connection.execute("COMMIT")
+
+        rules = tuple(query_rule(*rule) for rule in json.loads(row[2]))
+        return row[0], row[1], rules, plan_data
+
+    def heartbeat(self, job, segment, worker):
+        '''Extends the lease of a segment. Returns False if the worker lost its lease.'''
+
+        with self._connect() as connection:
+            cursor = connection.execute("UPDATE segments SET lease_expires = ? WHERE job = ? AND segment = ? AND worker = ? AND status = 'leased'",
+                                        (time.time() + self.lease_seconds, job, segment, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, job, segment, worker, result_count, csv_file):
+        '''Reports the result of a downloaded segment.'''
+
+        with self._connect() as connection:
+            connection.execute("UPDATE segments SET status = 'done', result_count = ?, csv_file = ?, lease_expires = NULL WHERE job = ? AND segment = ? AND worker = ?",
+                               (result_count, csv_file, job, segment, worker))
+
+    def fail(self, job, segment, worker):
+        '''Returns a segment to the queue, or marks it failed once it ran out of attempts.'''
+
+        with self._connect() as connection:
+            connection.execute("UPDATE segments SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, lease_expires = NULL "
+                               "WHERE job = ? AND segment = ? AND worker = ?", (self.max_attempts, job, segment, worker))
+
+    def status(self, job=None):
+        '''Counts the segments of a job (or of every job) by status.'''
+
+        with self._connect() as connection:
+            rows = connection.execute("SELECT status, COUNT(*) FROM segments WHERE (? IS NULL OR job = ?) GROUP BY status", (job, job)).fetchall()
+        return dict(rows)
+
+    def results(self, job):
+        '''Returns the plan of a job and the (result count, csv file) of each of its segments in plan order.'''
+
+        with self._connect() as connection:
+            plan_data = json.loads(connection.execute("SELECT plan FROM jobs WHERE job = ?", (job,)).fetchone()[0])
+            rows = connection.execute("SELECT result_count, csv_file FROM segments WHERE job = ? ORDER BY segment", (job,)).fetchall()
+        return plan_data, rows
+
+class _ClosingConnection:
+    '''Context manager closing a SQLite connection when the block ends.'''
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __enter__(self):
+        return self._connection
+
+    def __exit__(self, *exc):
+        if exc[0] is not None and self._connection.in_transaction:
+            self._connection.execute("ROLLBACK")
+        self._connection.close()
+
+def work_queue_store(queue_path, store_path=None):
+    '''Returns the export store shared by the workers of a queue, by default a store directory next to the queue database.'''
+    return os.path.abspath(store_path or os.path.join(os.path.dirname(os.path.abspath(queue_path)), "store"))
+
+def rule_to_list(rule):
+    '''Converts a query rule to a JSON serializable list.'''
+    return [rule.field, rule.subfield, rule.condition, rule.value]
+
+def segment_key(segment):
+    '''Returns a key identifying the rules of a segment.'''
+    return json.dumps([rule_to_list(rule) for rule in segment])
+
+def coordinate(*args, queue_path = work_queue_path, job = None, require_all = True, histogram_path = id_histogram_path, spot_checks = 0, planner = 'auto', workers = 0, refresh = False, priority = 1.0, order = 'plan', export_format = default_export_format, columns = None, store_path = None):
+    '''
+    Plans a download and publishes its segments to a shared work queue instead of downloading them.
+    Workers started with work() on any host claim the segments, and merge() collects the results.
+    If workers is set, that many local workers are run and the results are merged before returning.
+    Exports are kept in the store shared by the workers, a store directory next to the queue database unless store_path is given.
+    '''
+
+    set_rate_limit_job(f"coordinate-{socket.gethostname()}-{os.getpid()}", priority)
+    store_path = work_queue_store(queue_path, store_path)
+    plan = plan_query(*args, require_all = require_all, histogram_path = histogram_path, spot_checks = spot_checks, planner = planner, export_format = export_format, columns = columns,
+                      revalidate = refresh == 'revalidate', store_path = store_path)
+    if plan is None:
+        return None
+    ExportStore(store_path).put_plan(plan)
+
+    work_queue = WorkQueue(queue_path)
+    job = work_queue.publish(plan, job, order)
+    if workers:
+        work(queue_path = queue_path, job = job, processes = workers, priority = priority, store_path = store_path)
+        merge(job, queue_path = queue_path, store_path = store_path)
+    return job
+
+def _work_loop(queue_path, worker, job, wait, priority=1.0, store_path=None):
+    '''Claims and downloads segments until the queue has nothing left for this worker.'''
+
+    init(f"queue-{job}" if job else worker, priority)
+    work_queue = WorkQueue(queue_path)
+
+    # every worker, on any host, downloads into the shared store so that merge() finds the exports
+    global export_store_path
+    local_store_path = export_store_path
+    export_store_path = work_queue_store(queue_path, store_path)
+    try:
+        completed = _work_segments(work_queue, worker, job, wait)
+    finally:
+        export_store_path = local_store_path
+
+    print(f"Worker {worker} finished after {completed} segments")
+    return completed
+
+def _work_segments(work_queue, worker, job, wait):
+    '''Claims and downloads segments into the shared store and returns how many were completed.'''
+
+    completed = 0
+
+    while True:
+        claimed = work_queue.claim(worker, job)
+        if claimed is None:
+            status = work_queue.status(job)
+            # other workers may still drop their leases, so keep waiting while anything is leased
+            if wait and status.get('leased', 0) > 0:
+                time.sleep(work_queue.lease_seconds / 4)
+                continue
+            break
+
+        segment_job, segment, rules, plan_data = claimed
+        print(f"Worker {worker} claimed segment {segment} of job {segment_job}")
+
+        # keep the lease alive while the segment downloads
+        stop = threading.Event()
+        def beat():
+            while not stop.wait(work_queue.lease_seconds / 3):
+                work_queue.heartbeat(segment_job, segment, worker)
+        heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        heartbeat_thread.start()
+
+        try:
+            q = submit_query(*rules, download = True, require_all = plan_data["require_all"], only_download = plan_data["only_download"],
+                             has_key_constraint = plan_data["has_key_constraint"], export_format = plan_data.get("export_format", default_export_format),
+                             expected_count = plan_data["counts"][segment] if plan_data.get("counts") else None)
+        except Exception as e:
+            print(f"Worker {worker} failed on segment {segment} of job {segment_job}: {e}")
+            q = None
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+
+        if q is not None and (q._result_list_count == 0 or q._csv_file):
+            # hosts mount the shared store in different places, so files are recorded relative to it
+            csv_file = os.path.relpath(os.path.abspath(q._csv_file), export_store_path) if q._csv_file else None
+            work_queue.complete(segment_job, segment, worker, q._result_list_count, csv_file)
+            completed += 1
+        else:
+            work_queue.fail(segment_job, segment, worker)
+
+    return completed
+
+def work(queue_path = work_queue_path, job = None, processes = 1, worker = None, wait = True, priority = 1.0, store_path = None):
+    '''
+    Runs workers that download segments from a shared work queue.
+    Several workers can run on one host and on as many hosts as share the queue.
+    Exports are kept in the store shared by the workers, a store directory next to the queue database unless store_path is given.
+    '''
+
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    if processes <= 1:
+        return _work_loop(queue_path, worker, job, wait, priority, store_path)
+
+    with Pool(processes=processes) as p:
+        completed = p.starmap(_work_loop, [(queue_path, f"{worker}-{index}", job, wait, priority, store_path) for index in range(processes)])
+    return sum(completed)
+
+def merge(job, queue_path = work_queue_path, aggregated_csv_file = "./output/aggregated_data.csv", columns = None, store_path = None):
+    '''
+    Merges the downloaded segments of a job from a shared work queue into a single CSV file, keeping the columns given to coordinate() unless columns is set.
+    The segment files are looked up in the store shared by the workers, a store directory next to the queue database unless store_path is given.
+    '''
+
+    work_queue = WorkQueue(queue_path)
+    status = work_queue.status(job)
+    unfinished = sum(count for key, count in status.items() if key != 'done')
+    if unfinished:
+        print(f"Job {job} still has {unfinished} unfinished segments: {status}")
+
+    plan_data, rows = work_queue.results(job)
+    # files recorded relative to the shared store, absolute paths of older queues are kept as they are
+    store_path = work_queue_store(queue_path, store_path)
+    csv_files = sorted([os.path.join(store_path, csv_file) for _, csv_file in rows if csv_file], reverse=True)
+    aggregated_df = aggregate_csv_files(csv_files, aggregated_csv_file, columns or plan_data.get("columns"))
+
+    # refresh the histogram the same way a local download would
+    if plan_data["histogram_path"] and not unfinished:
+        plan = QueryPlan((), plan_data["require_all"])
+        plan.histogram = IDHistogram(plan_data["histogram_path"])
+        plan.signature = plan_data["signature"]
+        plan.histogram_ranges = plan_data["histogram_ranges"]
+        plan.key_segments = plan_data["key_segments"]
+        refresh_id_histogram(plan, rows, aggregated_df[event_id_column].dropna() if aggregated_df is not None and event_id_column in aggregated_df.columns else None)
+
+    return aggregated_df
+
+class SAFEPyService:
+    '''
+    SAFEPy service
+    Runs queries submitted over a local HTTP API in one long running process. Sessions and caches stay warm between jobs,
+    identical jobs submitted while one is still queued or running share its result, and identical probes are sent only once.
+    '''
+    def __init__(self, max_jobs=2, probe_cache_seconds=300, output_dir="./output/jobs", job_retention_seconds=3600):
+        '''Initializes the SAFEPyService class. Finished jobs are forgotten job_retention_seconds after they finish.'''
+
+        self.output_dir = output_dir
+        self.job_retention_seconds = job_retention_seconds
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self._jobs = {}
+        self._in_flight = {}
+        self._progress = {}
+        self._submitted = 0
+
+        # warm the transport and probe cache of this process
+        global shared_probes, shared_pid
+        get_transport()
+        shared_probes = SingleFlight(ttl=probe_cache_seconds)
+        shared_pid = os.getpid()
+
+    def job_key(self, args, kwargs):
+        '''Builds a canonical key for a job, independent of the order of its rules.'''
+
+        rules = sorted(json.dumps(arg if isinstance(arg, str) else list(arg)) for arg in args)
+        return hashlib.sha1(json.dumps({"rules": rules, "kwargs": kwargs}, sort_keys=True).encode()).hexdigest()[:16]
+
+    def confine(self, name, path):
+        '''Resolves a path given by a client against the output directory. Raises ValueError if it leads outside of it.'''
+
+        root = os.path.realpath(self.output_dir)
+        resolved = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, resolved]) != root:
+            raise ValueError(f"{name} must lie inside the service output directory {self.output_dir}")
+        return resolved
+
+    def _evict(self):
+        '''Forgets the jobs that finished more than job_retention_seconds ago, and their progress. Called with the lock held.'''
+
+        now = time.time()
+        for job, record in list(self._jobs.items()):
+            if record["finished"] is None and record["future"].done():
+                record["finished"] = now
+            if record["finished"] is not None and now - record["finished"] >= self.job_retention_seconds:
+                del self._jobs[job]
+
+        keys = set(record["key"] for record in self._jobs.values())
+        for key, future in list(self._in_flight.items()):
+            if key not in keys and future.done():
+                del self._in_flight[key]
+                self._progress.pop(key, None)
+
+    def submit(self, args, kwargs=None):
+        '''Queues a query and returns its job id. Identical jobs already in flight are joined instead of queued again.'''
+
+        kwargs = dict(kwargs or {})
+        unknown = sorted(set(kwargs) - set(service_job_kwargs))
+        if unknown:
+            raise ValueError(f"Unsupported job arguments {', '.join(unknown)}. Valid arguments are: {', '.join(service_job_kwargs)}")
+        # clients never choose where outside the output directory the service writes
+        for name in service_path_kwargs:
+            if isinstance(kwargs.get(name), str):
+                kwargs[name] = self.confine(name, kwargs[name])
+        # a misspelled column fails the request instead of the job
+        projected_columns(kwargs.get("columns"))
+        args = tuple(arg if isinstance(arg, str) else tuple(arg) for arg in args)
+        key = self.job_key(args, kwargs)
+        if kwargs.get("download"):
+            kwargs.setdefault("aggregated_csv_file", os.path.join(self.output_dir, f"{key}.csv"))
+
+        with self._lock:
+            self._evict()
+            job = f"{key}-{self._submitted}"
+            self._submitted += 1
+            future = self._in_flight.get(key)
+            shared = future is not None and not future.done()
+            if not shared:
+                # nobody can answer a confirmation prompt in a service thread
+                future = self._executor.submit(query, *args, progress = partial(self._progress.__setitem__, key), confirm = False, **kwargs)
+                self._in_flight[key] = future
+            self._jobs[job] = {"key": key, "future": future, "shared": shared, "args": args, "kwargs": kwargs, "submitted": time.time(), "finished": None}
+
+        if shared:
+            print(f"Job {job} joined an identical job already in flight")
+        return job
+
+    def status(self, job):
+        '''Returns the status of a job, and its result once it is done.'''
+
+        with self._lock:
+            self._evict()
+            record = self._jobs.get(job)
+        if record is None:
+            return None
+
+        future = record["future"]
+        status = {"job": job, "shared": record["shared"], "submitted": record["submitted"], "args": record["args"], "kwargs": record["kwargs"],
+                  "progress": self._progress.get(record["key"])}
+        if future.done():
+            error = future.exception()
+            status["status"] = "failed" if error else "done"
+            status["error"] = str(error) if error else None
+            status["result"] = None if error else future.result()
+        else:
+            status["status"] = "running" if future.running() else "queued"
+        return status
+
+    def jobs(self):
+        '''Returns the status of every job.'''
+
+        with self._lock:
+            self._evict()
+            jobs = list(self._jobs)
+        return [status for status in map(self.status, jobs) if status is not None]
+
+    def serve(self, host="127.0.0.1", port=8765, socket_path=None):
+        '''Serves the HTTP API on a local TCP port, or on a Unix socket if socket_path is given, until interrupted.'''
+
+        handler = partial(_ServiceRequestHandler, self)
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = _UnixHTTPServer(socket_path, handler)
+            print(f"SAFEPy service listening on {socket_path}")
+        else:
+            server = ThreadingHTTPServer((host, port), handler)
+            print(f"SAFEPy service listening on http://{host}:{port}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self._executor.shutdown(wait=False)
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''HTTP server listening on a Unix socket.'''
+    daemon_threads = True
+
+class _ServiceRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Request handler of the SAFEPy service
+    POST /jobs                 submit {"args": [...], "kwargs": {...}}
+    GET  /jobs                 status of every job
+    GET  /jobs/<job>           status of one job
+    GET  /jobs/<job>/result    aggregated CSV file of a finished download
+    GET  /rollups/<rollup>     rows of a rollup, ?dataset=<csv file>&dimensions=year,Damage&<dimension>=<value>
+    '''
+    def __init__(self, service, *args, **kwargs):
+        self.service = service
+        super().__init__(*args, **kwargs)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+    def _send_json(self, code, body):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != "/jobs":
+            return self._send_json(404, {"error": "not found"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.service.submit(body["args"], body.get("kwargs"))
+        except (KeyError, TypeError, ValueError) as e:
+            return self._send_json(400, {"error": f"invalid job: {e}"})
+        self._send_json(202, self.service.status(job))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if len(parts) == 2 and parts[0] == "rollups":
+            parameters = {key: values[0] if len(values) == 1 else values for key, values in urllib.parse.parse_qs(url.query).items()}
+            dataset = parameters.pop("dataset", "./output/aggregated_data.csv")
+            dimensions = parameters.pop("dimensions", None)
+            if "year" in parameters:
+                parameters["year"] = [int(year) for year in (parameters["year"] if isinstance(parameters["year"], list) else [parameters["year"]])]
+            try:
+                df = rollup(dataset, parts[1], dimensions.split(",") if dimensions else None, **parameters)
+            except ValueError as e:
+                return self._send_json(400, {"error": str(e)})
+            return self._send_json(200, json.loads(df.to_json(orient="records")))
+        if parts == ["jobs"]:
+            return self._send_json(200, self.service.jobs())
+        if len(parts) < 2 or parts[0] != "jobs":
+            return self._send_json(404, {"error": "not found"})
+
+        status = self.service.status(parts[1])
+        if status is None:
+            return self._send_json(404, {"error": f"unknown job {parts[1]}"})
+        if len(parts) == 2:
+            return self._send_json(200, status)
+
+        # stream the aggregated data of a finished download
+        result = status.get("result")
+        if status["status"] != "done" or not isinstance(result, str) or not os.path.exists(result):
+            return self._send_json(409, {"error": "no result file available", "status": status["status"]})
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(os.path.getsize(result)))
+        self.end_headers()
+        with open(result, 'rb') as file:
+            shutil.copyfileobj(file, self.wfile)
+
+def serve(host = "127.0.0.1", port = 8765, socket_path = None, max_jobs = 2, probe_cache_seconds = 300, output_dir = "./output/jobs", job_retention_seconds = 3600):
+    '''Runs SAFEPy as a long running service with a local HTTP API.'''
+
+    SAFEPyService(max_jobs = max_jobs, probe_cache_seconds = probe_cache_seconds, output_dir = output_dir, job_retention_seconds = job_retention_seconds).serve(host, port, socket_path)
 
 if __name__ == '__main__':
     
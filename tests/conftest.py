@@ -0,0 +1,83 @@
+import io
+import json
+import os
+import sys
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import SAFEPy
+
+class FakeCarol:
+    '''
+    Fake CAROL server
+    Answers count probes with result_count (or result_count(probe) if it is callable) and exports with a zipped CSV of rows (or rows(export) if it is callable), recording every request it gets.
+    '''
+    def __init__(self):
+        self.result_count = 1
+        self.probe_seconds = 0
+        self.export_seconds = 0
+        self.rows = "Mkey,NtsbNo\n1,ERA20LA001\n"
+        self.probes = []
+        self.exports = []
+        self._lock = threading.Lock()
+
+        carol = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with carol._lock:
+                    (carol.probes if self.path == "/probe" else carol.exports).append(body)
+                if self.path == "/probe":
+                    time.sleep(carol.probe_seconds)
+                    count = carol.result_count(body) if callable(carol.result_count) else carol.result_count
+                    data = json.dumps({"ResultListCount": count, "MaxResultCountReached": False, "Results": []}).encode()
+                    content_type = "application/json"
+                else:
+                    time.sleep(carol.export_seconds)
+                    buffer = io.BytesIO()
+                    with zipfile.ZipFile(buffer, 'w') as zip_file:
+                        zip_file.writestr("cases.csv", carol.rows(body) if callable(carol.rows) else carol.rows)
+                    data = buffer.getvalue()
+                    content_type = "application/zip"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("Content-Disposition", "attachment; filename=cases.zip")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+def write_histogram(path, count):
+    '''Writes an unfiltered Event.ID histogram with the same count in every bucket, as probes of every bucket would record it.'''
+
+    histogram = SAFEPy.IDHistogram(str(path))
+    for bucket in range(SAFEPy.max_event_id // histogram.bucket_size + 1):
+        histogram.observe("*", bucket * histogram.bucket_size, (bucket + 1) * histogram.bucket_size - 1, count)
+    histogram.save()
+
+@pytest.fixture
+def carol(tmp_path, monkeypatch):
+    '''Points SAFEPy at a fake CAROL server, without rate limits, with its output under a temporary directory.'''
+
+    server = FakeCarol()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(SAFEPy, "rate_limits", {"probe": 0, "export": 0})
+    monkeypatch.setattr(SAFEPy, "rate_limit_path", str(tmp_path / "rate_limit.json"))
+    probe_url, file_url = SAFEPy.probe_url, SAFEPy.file_url
+    SAFEPy.configure_transport(probe=f"{server.url}/probe", export=f"{server.url}/export", read_timeout=10)
+    yield server
+    SAFEPy.configure_transport(probe=probe_url, export=file_url, connect_timeout=10, read_timeout=60)
+    server.server.shutdown()
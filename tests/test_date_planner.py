@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import SAFEPy
+
+def window_of(probe):
+    '''Returns the EventDate window a probe asks for.'''
+
+    start, end = SAFEPy.earliest_event_date, datetime(2020, 12, 31)
+    for rule in probe["QueryGroups"][0]["QueryRules"]:
+        if rule["Columns"] == ["Event.EventDate"]:
+            date = datetime.strptime(rule["Values"][0], '%Y-%m-%d')
+            if rule["Operator"] == "is on or after":
+                start = max(start, date)
+            elif rule["Operator"] == "is on or before":
+                end = min(end, date)
+    return start, end
+
+def cases_per_day(density):
+    '''Answers count probes as if every day held density(day) cases.'''
+
+    def count(probe):
+        start, end = window_of(probe)
+        return sum(density(start + timedelta(days=day)) for day in range((end - start).days + 1))
+    return count
+
+def test_upper_bound_only_query_is_planned_in_few_probes(carol):
+    '''A query bounded only from above is split in about as many probes as it has windows, into windows that each fit in one export.'''
+
+    carol.result_count = cases_per_day(lambda day: 1)
+    plan = SAFEPy.plan_query(("Event", "EventDate", "is on or before", "12/31/2020"), histogram_path = None)
+
+    total = (datetime(2020, 12, 31) - SAFEPy.earliest_event_date).days + 1
+    assert plan.only_download
+    assert sum(count for _, _, count in plan.date_segments) == total
+    assert all(count < SAFEPy.max_export_count for _, _, count in plan.date_segments)
+    assert plan.date_segments[0][0] == SAFEPy.earliest_event_date and plan.date_segments[-1][1] == datetime(2020, 12, 31)
+    assert all(end + timedelta(days=1) == start for (_, end, _), (start, _, _) in zip(plan.date_segments, plan.date_segments[1:]))
+    assert len(carol.probes) <= 2 * len(plan.date_segments)
+
+def test_failed_window_probes_are_sent_again(carol):
+    '''A window whose count probe fails is counted again, so no window is downloaded without a count.'''
+
+    counted = cases_per_day(lambda day: 1)
+    failed = set()
+    def flaky(probe):
+        window = window_of(probe)
+        if window not in failed:
+            failed.add(window)
+            return None
+        return counted(probe)
+    carol.result_count = lambda probe: counted(probe) if len(carol.probes) == 1 else flaky(probe)
+
+    plan = SAFEPy.plan_query(("Event", "EventDate", "is on or before", "12/31/2020"), histogram_path = None)
+    assert all(count is not None for _, _, count in plan.date_segments)
+    assert plan.counts == [count for _, _, count in plan.date_segments]
+
+def test_window_that_cannot_be_counted_fails_the_plan(carol):
+    '''Planning stops with ProbeFailedError instead of exporting a window whose count is unknown.'''
+
+    carol.result_count = lambda probe: 20000 if len(carol.probes) == 1 else None
+    with pytest.raises(SAFEPy.ProbeFailedError):
+        SAFEPy.plan_query(("Event", "EventDate", "is on or before", "12/31/2020"), histogram_path = None)
+    assert len(carol.probes) == 1 + SAFEPy.date_probe_retries + 1
+
+def test_sparse_query_falls_back_to_event_id_segments(carol, monkeypatch):
+    '''The auto planner gives up on EventDate windows that would take too many probes and splits by Event.ID instead.'''
+
+    # every case is on the last day, so each cut only narrows the window down
+    carol.result_count = cases_per_day(lambda day: 8000 if day == datetime(2020, 12, 31) else 0)
+    monkeypatch.setattr(SAFEPy, "search_key_bounds", lambda *args: (SAFEPy.query_rule("Event", "ID", "is greater than", "1000"),
+                                                                     SAFEPy.query_rule("Event", "ID", "is less than", "2000")))
+    plan = SAFEPy.plan_query(("Event", "EventDate", "is on or before", "12/31/2020"), histogram_path = None)
+    assert plan.date_segments is None
+    assert plan.key_segments
+    assert len(carol.probes) <= 1 + SAFEPy.date_planner_probe_margin + 2 * 3
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import SAFEPy
+
+header = "Mkey,NtsbNo,EventDate,FatalInjuryCount,HasSafetyRec,AirCraftCategory,AmateurBuilt,NumberOfEngines\n"
+
+def test_multi_aircraft_row_keeps_per_aircraft_values(tmp_path):
+    '''A two-aircraft event keeps its comma joined per-aircraft values through aggregation.'''
+
+    segment = tmp_path / "segment.csv"
+    segment.write_text(header +
+                       '101,ERA20LA001,2020-01-02T00:00:00Z,0,false,"Airplane,Airplane","false,false","1,1"\n'
+                       '102,ERA20LA002,2020-01-03T00:00:00Z,1,true,Airplane,true,2\n')
+    aggregated = tmp_path / "aggregated.csv"
+    SAFEPy.aggregate_csv_files([str(segment)], str(aggregated))
+
+    df = pd.read_csv(aggregated, dtype=str)
+    assert list(df["AmateurBuilt"]) == ["false,false", "true"]
+    assert list(df["NumberOfEngines"]) == ["1,1", "2"]
+    assert list(df["AirCraftCategory"]) == ["Airplane,Airplane", "Airplane"]
+    assert list(df["FatalInjuryCount"]) == ["0", "1"]
+
+def test_unconvertible_values_are_kept_as_text(capsys):
+    '''A declared integer column with a value that is not an integer is kept as text and reported.'''
+
+    df = SAFEPy.apply_export_schema(pd.DataFrame({"FatalInjuryCount": ["1", "2,0", None]}))
+    assert list(df["FatalInjuryCount"].iloc[:2]) == ["1", "2,0"]
+    assert df["FatalInjuryCount"].isna().iloc[2]
+    assert "FatalInjuryCount" in capsys.readouterr().out
+
+def test_declared_types():
+    '''Counts and flags that fit their declared types are coerced to them.'''
+
+    df = SAFEPy.apply_export_schema(pd.DataFrame({"FatalInjuryCount": ["1", ""], "HasSafetyRec": ["true", "false"]}))
+    assert isinstance(df["FatalInjuryCount"].dtype, pd.Int64Dtype)
+    assert isinstance(df["HasSafetyRec"].dtype, pd.BooleanDtype)
+
+def test_seen_set_ids_at_word_boundaries():
+    '''Event.IDs on either side of a byte of the bitmap are told apart, and each is kept only the first time it is seen.'''
+
+    seen = SAFEPy.SeenSet(size = 24)
+    first = pd.DataFrame({"Mkey": [0, 7, 8, 15, 16, 23, 8]})
+    assert list(seen.new_rows(first)) == [True, True, True, True, True, True, False]
+
+    second = pd.DataFrame({"Mkey": [1, 6, 7, 8, 9, 16, 17, 23, 24]})
+    assert list(seen.new_rows(second)) == [True, True, False, False, True, False, True, False, True]
+
+def test_seen_set_grows_and_skips_invalid_ids():
+    '''IDs past the end of the bitmap grow it, and rows without a usable ID are always kept.'''
+
+    seen = SAFEPy.SeenSet(size = 8)
+    df = pd.DataFrame({"Mkey": ["63", "64", "x", None, "-1", "64"]})
+    assert list(seen.new_rows(df)) == [True, True, True, True, True, False]
+    assert list(seen.new_rows(df)) == [False, False, True, True, True, False]
+
+def test_seen_set_falls_back_to_ntsb_numbers():
+    '''Exports without Event.IDs are deduplicated by NTSB number.'''
+
+    seen = SAFEPy.SeenSet()
+    assert list(seen.new_rows(pd.DataFrame({"NtsbNo": ["ERA20LA001", "ERA20LA002", "ERA20LA001"]}))) == [True, True, False]
+    assert list(seen.new_rows(pd.DataFrame({"NtsbNo": ["ERA20LA002", "ERA20LA003"]}))) == [False, True]
+
+def test_requested_columns_reach_the_aggregated_csv(carol):
+    '''The export request carries the export format, and the aggregated CSV file holds only the requested columns, in their order.'''
+
+    carol.rows = header + '101,ERA20LA001,2020-01-02T00:00:00Z,0,false,Airplane,false,1\n'
+    aggregated_csv_file = SAFEPy.query(("Aircraft", "AircraftCategory", "is", "AIR"), download = True, histogram_path = None,
+                                       columns = ["EventDate", "AirCraftCategory"], export_format = "summary")
+    assert [export["ExportFormat"] for export in carol.exports] == ["summary"]
+
+    df = pd.read_csv(aggregated_csv_file, dtype=str)
+    assert list(df.columns) == ["EventDate", "AirCraftCategory"]
+    assert list(df["AirCraftCategory"]) == ["Airplane"]
+
+def test_unknown_columns_are_rejected_up_front(carol):
+    '''A column the summary export does not have is rejected before anything is probed.'''
+
+    with pytest.raises(ValueError, match="AircraftCategory"):
+        SAFEPy.query(("Aircraft", "AircraftCategory", "is", "AIR"), download = True, histogram_path = None, columns = ["Mkey", "AircraftCategory"])
+    assert carol.probes == []
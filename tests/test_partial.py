@@ -0,0 +1,80 @@
+import io
+import json
+import os
+from datetime import datetime
+
+import pandas
+import pytest
+
+import SAFEPy
+
+header = "Mkey,NtsbNo,EventDate\n"
+
+def date_plan(windows):
+    '''Returns a plan of EventDate windows given as (year, expected count) pairs.'''
+
+    plan = SAFEPy.QueryPlan((), True)
+    plan.date_segments = [(datetime(year, 1, 1), datetime(year, 12, 31), count) for year, count in windows]
+    plan.segments = [()] * len(windows)
+    return plan
+
+def test_order_segments():
+    '''Segments are scheduled by their place in time or their expected size.'''
+
+    plan = date_plan([(2000, 10), (2001, 30), (2002, 20), (2003, None)])
+    assert SAFEPy.order_segments(plan, 'plan') == [0, 1, 2, 3]
+    assert SAFEPy.order_segments(plan, 'newest') == [3, 2, 1, 0]
+    assert SAFEPy.order_segments(plan, 'largest') == [1, 2, 0, 3]
+    assert SAFEPy.order_segments(plan, 'interleaved') == [3, 0, 2, 1]
+
+    plan = SAFEPy.QueryPlan((), True)
+    plan.key_segments = [(0, 99), (100, 999), (1000, 1049)]
+    plan.segments = [()] * 3
+    assert SAFEPy.order_segments(plan, 'largest') == [1, 0, 2]
+    assert SAFEPy.order_segments(plan, 'newest') == [2, 1, 0]
+    with pytest.raises(ValueError, match="oldest"):
+        SAFEPy.order_segments(plan, 'oldest')
+
+def read_manifest(tmp_path):
+    '''Returns the published manifest of the dataset.'''
+    with open(tmp_path / "aggregated.manifest.json") as manifest_file:
+        return json.load(manifest_file)
+
+def test_manifest_covers_the_finished_segments(tmp_path):
+    '''The manifest lists every segment, and its bytes of the partial file hold whole, de-duplicated rows.'''
+
+    (tmp_path / "a.csv").write_text(header + "1,ERA20LA001,2000-01-02\n2,ERA20LA002,2000-03-04\n")
+    (tmp_path / "b.csv").write_text(header + "2,ERA20LA002,2000-03-04\n3,ERA21LA003,2001-05-06\n")
+    dataset = SAFEPy.PartialDataset(date_plan([(2000, 2), (2001, 2), (2002, 0)]), str(tmp_path / "aggregated.csv"))
+    assert [entry["status"] for entry in read_manifest(tmp_path)["coverage"]] == ["pending"] * 3
+
+    dataset.add(1, 2, str(tmp_path / "b.csv"))
+    dataset.add(0, 2, str(tmp_path / "a.csv"))
+    manifest = read_manifest(tmp_path)
+    assert [entry["status"] for entry in manifest["coverage"]] == ["done", "done", "pending"]
+    assert manifest["coverage"][0]["event_dates"] == ["2000-01-01", "2000-12-31"]
+    assert (manifest["rows"], manifest["segments_done"], manifest["complete"]) == (3, 2, False)
+    with open(manifest["file"], 'rb') as partial_file:
+        assert sorted(pandas.read_csv(io.BytesIO(partial_file.read(manifest["bytes"])))["Mkey"]) == [1, 2, 3]
+
+    dataset.add(2, 0, None)
+    assert dataset.finish() == str(tmp_path / "aggregated.csv")
+    manifest = read_manifest(tmp_path)
+    assert manifest["complete"] and manifest["file"] == str(tmp_path / "aggregated.csv") and manifest["failed_segments"] == []
+    assert not os.path.exists(tmp_path / "aggregated.partial.csv")
+
+def test_failed_segments_leave_the_download_incomplete(tmp_path):
+    '''A download with a failed segment keeps its partial file and a manifest listing the failed segment.'''
+
+    (tmp_path / "a.csv").write_text(header + "1,ERA20LA001,2000-01-02\n")
+    dataset = SAFEPy.PartialDataset(date_plan([(2000, 1), (2001, 5)]), str(tmp_path / "aggregated.csv"))
+    dataset.add(0, 1, str(tmp_path / "a.csv"))
+    dataset.add(1, 5, None)
+
+    assert dataset.finish() is None
+    manifest = read_manifest(tmp_path)
+    assert not manifest["complete"]
+    assert manifest["failed_segments"] == [1]
+    assert manifest["file"] == str(tmp_path / "aggregated.partial.csv")
+    assert os.path.exists(tmp_path / "aggregated.partial.csv")
+    assert not os.path.exists(tmp_path / "aggregated.csv")
@@ -0,0 +1,43 @@
+import SAFEPy
+
+from conftest import write_histogram
+
+def test_small_filtered_query_is_one_request(carol, tmp_path):
+    '''The unfiltered histogram never turns a query that fits in one export into many segments.'''
+
+    write_histogram(tmp_path / "histogram.json", 800)
+    carol.result_count = 12
+    plan = SAFEPy.plan_query(("Aircraft", "AircraftCategory", "is", "BLIM"), histogram_path = str(tmp_path / "histogram.json"))
+    assert plan.one_request
+    assert len(plan.segments) == 1
+    assert len(carol.probes) == 1
+
+def test_large_query_is_split_from_the_histogram(carol, tmp_path):
+    '''A query that is too large for one export is split from the histogram without a bounds search.'''
+
+    write_histogram(tmp_path / "histogram.json", 800)
+    carol.result_count = SAFEPy.max_export_count * 20
+    plan = SAFEPy.plan_query(("Aircraft", "AircraftCategory", "is", "AIR"), histogram_path = str(tmp_path / "histogram.json"))
+    assert not plan.one_request
+    assert len(plan.segments) > 1
+    assert len(carol.probes) == 1
+
+def test_disjoint_key_segments_clip_overlapping_bounds():
+    '''Segments that share bounds with earlier segments are clipped to the IDs no earlier segment covers, in order.'''
+
+    assert SAFEPy.disjoint_key_segments([(0, 10), (20, 30)]) == [(0, 10), (20, 30)]
+    # a shared bound belongs to the first segment only
+    assert SAFEPy.disjoint_key_segments([(0, 10), (10, 20)]) == [(0, 10), (11, 20)]
+    assert SAFEPy.disjoint_key_segments([(10, 20), (0, 10)]) == [(10, 20), (0, 9)]
+    # a segment around an earlier one keeps both sides, one inside it is dropped
+    assert SAFEPy.disjoint_key_segments([(5, 5), (0, 10), (3, 7)]) == [(5, 5), (0, 4), (6, 10)]
+    # earlier segments that touch are clipped as one range
+    assert SAFEPy.disjoint_key_segments([(0, 4), (5, 9), (2, 12)]) == [(0, 4), (5, 9), (10, 12)]
+
+def test_disjoint_key_segments_complement():
+    '''Clipping the complement against disjoint segments keeps the segments as they are, so the complement can be sliced off after them.'''
+
+    segments = [(0, 99), (200, 299)]
+    complement = SAFEPy.disjoint_key_segments(segments + [(0, SAFEPy.max_event_id)])
+    assert complement[:len(segments)] == segments
+    assert complement[len(segments):] == [(100, 199), (300, SAFEPy.max_event_id)]
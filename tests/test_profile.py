@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+import time
+
+import numpy
+import pandas
+
+import SAFEPy
+
+from conftest import write_histogram
+
+def dump_worker(directory, run, index):
+    '''Profiles one segment the way a pool worker does and dumps it under the given run id.'''
+
+    profiler = SAFEPy.Profiler(str(directory), trace_memory = False, run = run)
+    with profiler.phase("workers"):
+        sum(range(1000))
+    profiler.dump(f"worker-{os.getpid()}-{index}")
+
+def test_collect_only_merges_this_run(tmp_path):
+    '''Dumps of a concurrent query sharing the profile directory are left alone.'''
+
+    profiler = SAFEPy.Profiler(str(tmp_path), trace_memory = False)
+    other = SAFEPy.Profiler(str(tmp_path), trace_memory = False, run = f"{os.getpid()}-1")
+    dump_worker(tmp_path, profiler.run, 0)
+    dump_worker(tmp_path, profiler.run, 1)
+    dump_worker(tmp_path, other.run, 0)
+
+    profiler.collect("worker")
+    assert profiler.phases["workers"]["calls"] == 2
+    assert all(file.startswith(other.run) for file in os.listdir(tmp_path))
+
+def test_stale_dumps_are_cleared(tmp_path):
+    '''Dumps of a run whose process is gone are removed when a new run starts, dumps of live runs are kept.'''
+
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    dump_worker(tmp_path, f"{finished.pid}-1", 0)
+    dump_worker(tmp_path, f"{os.getpid()}-1", 0)
+
+    SAFEPy.Profiler(str(tmp_path), trace_memory = False).clear_stale()
+    assert os.listdir(tmp_path)
+    assert all(file.startswith(f"{os.getpid()}-1-") for file in os.listdir(tmp_path))
+
+def test_stacks_of_a_pandas_aggregation(tmp_path):
+    '''The caller graph of a real pandas workload is collapsed quickly and keeps most of its time.'''
+
+    profiler = SAFEPy.Profiler(str(tmp_path), trace_memory = False)
+    with profiler.phase("aggregate"):
+        frame = pandas.DataFrame({"Mkey": numpy.arange(20000) % 37, "Fatal": numpy.random.rand(20000),
+                                  "EventDate": pandas.date_range("2000-01-01", periods=20000, freq="h")})
+        frame.to_csv(tmp_path / "aggregate.csv", index = False)
+        frame = pandas.read_csv(tmp_path / "aggregate.csv", parse_dates = ["EventDate"]).drop_duplicates("Mkey")
+        frame.groupby("Mkey").agg({"Fatal": ["sum", "mean"], "EventDate": "max"})
+
+    stats = profiler.phases["aggregate"]["stats"]
+    started = time.perf_counter()
+    stacks = profiler.collapsed_stacks("aggregate", stats)
+    assert time.perf_counter() - started < 5
+    collapsed = sum(int(stack.rsplit(" ", 1)[1]) for stack in stacks) / 1e6
+    assert collapsed > 0.8 * sum(own for _, _, own, _, _ in stats.stats.values())
+
+def test_profiled_download_writes_a_report(carol, tmp_path):
+    '''A profiled download of many segments finishes and reports the phases of its workers.'''
+
+    carol.result_count = lambda probe: 1 if len(probe["QueryGroups"][0]["QueryRules"]) > 1 else SAFEPy.max_export_count * 20
+    write_histogram(tmp_path / "histogram.json", 60)
+    SAFEPy.query(("Aircraft", "AircraftCategory", "is", "AIR"), download = True, histogram_path = str(tmp_path / "histogram.json"), profile = str(tmp_path / "profile"))
+
+    assert len(carol.exports) > 10
+    with open(tmp_path / "profile" / "profile.txt") as report:
+        assert "===== workers =====" in report.read()
+    assert os.path.getsize(tmp_path / "profile" / "profile.collapsed") > 0
@@ -0,0 +1,45 @@
+import pytest
+
+import SAFEPy
+
+def key_bounds(body):
+    '''Returns the Event.ID bounds of the rules of a CAROL request.'''
+    return [rule["Values"][0] for group in body["QueryGroups"] for rule in group["QueryRules"] if rule["Columns"] == ["Event.ID"]]
+
+def test_progress_of_a_download_with_a_failed_segment(carol):
+    '''Every finished segment reports a snapshot, a segment whose probe failed is counted as failed, and the ETA follows the finished segments.'''
+
+    # three Event.ID segments, the probe of the middle one fails
+    def result_count(body):
+        bounds = key_bounds(body)
+        if bounds == ["99", "1200"]:
+            return SAFEPy.max_export_count * 2
+        return None if "499" in bounds else 1
+    carol.result_count = result_count
+    carol.rows = lambda body: f"Mkey,NtsbNo\n{int(key_bounds(body)[0]) + 1},ERA20LA001\n"
+    carol.export_seconds = 0.2
+
+    snapshots = []
+    result = SAFEPy.query(("Aircraft", "AircraftCategory", "is", "AIR"), ("Event", "ID", "is greater than", "99"), ("Event", "ID", "is less than", "1200"),
+                          download = True, histogram_path = None, progress = snapshots.append)
+    assert result is None
+
+    assert len(snapshots) == 3
+    for finished, snapshot in enumerate(snapshots, 1):
+        assert snapshot["segments_total"] == 3
+        assert snapshot["segments_done"] + snapshot["segments_failed"] == finished
+        assert snapshot["segments_remaining"] == 3 - finished
+        assert snapshot["rows_per_second"] == pytest.approx(snapshot["rows"] / snapshot["elapsed"])
+        assert snapshot["eta_seconds"] == pytest.approx(snapshot["elapsed"] / finished * (3 - finished))
+    assert [snapshot["rows"] for snapshot in snapshots] == sorted(snapshot["rows"] for snapshot in snapshots)
+
+    last = snapshots[-1]
+    assert (last["segments_done"], last["segments_failed"], last["rows"], last["eta_seconds"]) == (2, 1, 2, 0)
+    assert 0 < last["rows_per_second"] < 2 / 0.2
+    assert last["bytes"] > 0
+
+def test_progress_before_any_segment_finished():
+    '''A snapshot taken before any segment finished has no ETA yet.'''
+
+    snapshot = SAFEPy.QueryProgress(4).snapshot()
+    assert (snapshot["segments_remaining"], snapshot["rows"], snapshot["eta_seconds"]) == (4, 0, None)
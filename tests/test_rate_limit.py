@@ -0,0 +1,51 @@
+import json
+import os
+import stat
+
+import SAFEPy
+
+def test_state_file_is_writable_by_every_user(tmp_path):
+    '''The shared state file is created group and world writable, whatever the umask of the first job.'''
+
+    path = tmp_path / "rate_limit.json"
+    umask = os.umask(0o022)
+    try:
+        SAFEPy.HostRateLimiter(path=str(path), rates={"probe": 100}, burst=3).acquire("probe", "job")
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o666
+
+def test_unopenable_state_falls_back_to_this_process(tmp_path, capsys):
+    '''A state file that cannot be opened limits only this process instead of failing the request.'''
+
+    path = str(tmp_path / "missing" / "rate_limit.json")
+    limiter = SAFEPy.HostRateLimiter(path=path, rates={"probe": 100}, burst=2)
+    for _ in range(3):
+        limiter.acquire("probe", "job")
+    assert "only this process is rate limited" in capsys.readouterr().out
+    assert SAFEPy.rate_limit_fallback[path]["probe"]["tokens"] < 1
+
+def test_planted_links_are_never_followed(tmp_path, capsys):
+    '''A symbolic or hard link at the state path never gets the file it points to overwritten or made writable by every user.'''
+
+    target = tmp_path / "private.txt"
+    target.write_text("secret")
+    os.chmod(target, 0o600)
+    os.symlink(target, tmp_path / "symlink.json")
+    os.link(target, tmp_path / "hardlink.json")
+
+    for name in ("symlink.json", "hardlink.json"):
+        SAFEPy.HostRateLimiter(path=str(tmp_path / name), rates={"probe": 100}, burst=3).acquire("probe", "job")
+        assert "only this process is rate limited" in capsys.readouterr().out
+    assert target.read_text() == "secret"
+    assert stat.S_IMODE(os.stat(target).st_mode) == 0o600
+
+def test_existing_state_file_keeps_its_mode(tmp_path):
+    '''Only a state file this process created is made writable by every user.'''
+
+    path = tmp_path / "rate_limit.json"
+    path.write_text("{}")
+    os.chmod(path, 0o644)
+    SAFEPy.HostRateLimiter(path=str(path), rates={"probe": 100}, burst=3).acquire("probe", "job")
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert "probe" in json.loads(path.read_text())
@@ -0,0 +1,53 @@
+import os
+
+import SAFEPy
+
+from conftest import write_histogram
+
+def store_plan_exports(carol, plan):
+    '''Downloads every segment of a plan into the export store and records the plan.'''
+
+    for segment in plan.segments:
+        SAFEPy.submit_query(*segment, download = True, **plan.submit_kwargs())
+    SAFEPy.ExportStore(SAFEPy.export_store_path).put_plan(plan)
+
+def test_revalidation_bypasses_the_probe_cache(carol, monkeypatch):
+    '''A service's cached count never hides a change from revalidation.'''
+
+    monkeypatch.setattr(SAFEPy, "shared_probes", SAFEPy.SingleFlight(ttl=300))
+    monkeypatch.setattr(SAFEPy, "shared_pid", os.getpid())
+    plan = SAFEPy.plan_query(("Event", "ID", "is greater than", "10"), histogram_path = None)
+    store_plan_exports(carol, plan)
+
+    # the service has the old count cached when a case is added
+    SAFEPy.build_query(*plan.segments[0], require_all = True, has_key_constraint = plan.has_key_constraint).query()
+    carol.result_count = 2
+    assert SAFEPy.revalidate_plan(plan) == [2]
+    assert SAFEPy.ExportStore(SAFEPy.export_store_path).get(SAFEPy.build_query(*plan.segments[0], require_all = True, has_key_constraint = plan.has_key_constraint).request_hash()[0]) is None
+
+def test_revalidation_keeps_the_stored_segments(carol, tmp_path):
+    '''Segments planned from a histogram that was refreshed since keep the boundaries of their stored exports.'''
+
+    # the whole query is too large for one export, each stored segment holds the one row of its export
+    carol.result_count = lambda probe: 1 if len(probe["QueryGroups"][0]["QueryRules"]) > 1 else SAFEPy.max_export_count * 20
+    histogram_path = tmp_path / "histogram.json"
+    write_histogram(histogram_path, 60)
+    rules = ("Aircraft", "AircraftCategory", "is", "AIR")
+    first = SAFEPy.plan_query(rules, histogram_path = str(histogram_path))
+    store_plan_exports(carol, first)
+    exports = len(carol.exports)
+
+    # the refreshed histogram would size every segment differently
+    write_histogram(histogram_path, 40)
+    assert SAFEPy.plan_query(rules, histogram_path = str(histogram_path)).key_segments != first.key_segments
+
+    carol.probes.clear()
+    second = SAFEPy.plan_query(rules, histogram_path = str(histogram_path), revalidate = True)
+    assert second.key_segments == first.key_segments
+    assert len(carol.probes) == len(first.segments) + 1
+
+    store = SAFEPy.ExportStore(SAFEPy.export_store_path)
+    for segment in second.segments:
+        request_hash, _ = SAFEPy.build_query(*segment, require_all = True, has_key_constraint = second.has_key_constraint).request_hash()
+        assert store.get(request_hash) is not None
+    assert len(carol.exports) == exports
@@ -0,0 +1,93 @@
+import io
+import os
+import sqlite3
+
+import pandas
+
+import SAFEPy
+
+header = "Mkey,NtsbNo,EventDate,FatalInjuryCount,SeriousInjuryCount,MinorInjuryCount,HasSafetyRec,AirCraftCategory,EngineType,AirCraftDamage\n"
+
+def write_segments(directory):
+    '''Writes two overlapping segments that share the event with Mkey 2.'''
+
+    first = directory / "a.csv"
+    first.write_text(header +
+                     "1,ERA20LA001,2020-01-02,0,0,1,false,AIR,REC,SUBS\n"
+                     "2,ERA20LA002,2020-03-04,1,0,0,true,AIR,TF,DEST\n")
+    second = directory / "b.csv"
+    second.write_text(header +
+                      "2,ERA20LA002,2020-03-04,1,0,0,true,AIR,TF,DEST\n"
+                      "3,ERA21LA003,2021-05-06,0,2,0,false,HELI,TS,SUBS\n")
+    return [str(first), str(second)]
+
+def build_rollup(tmp_path, files):
+    '''Adds the segments to a partial dataset in the given order and returns the rollup of the dataset.'''
+
+    plan = SAFEPy.QueryPlan((), True)
+    plan.segments = [(), ()]
+    store = SAFEPy.RollupStore(str(tmp_path / "rollups.sqlite"))
+    dataset = SAFEPy.PartialDataset(plan, str(tmp_path / "aggregated.csv"), rollups = store)
+    for index, csv_file in enumerate(files):
+        dataset.add(index, 2, csv_file)
+    return SAFEPy.rollup(str(tmp_path / "aggregated.csv"), dimensions = ["year", "AircraftCategory"], path = str(tmp_path / "rollups.sqlite"))
+
+def test_rollups_count_overlapping_events_once(tmp_path):
+    '''Events found in two segments are counted once, whichever segment finished first.'''
+
+    (tmp_path / "forward").mkdir()
+    (tmp_path / "backward").mkdir()
+    forward = build_rollup(tmp_path / "forward", write_segments(tmp_path / "forward"))
+    backward = build_rollup(tmp_path / "backward", write_segments(tmp_path / "backward")[::-1])
+
+    assert forward.equals(backward)
+    assert forward["count"].sum() == 3
+    assert forward["FatalInjuryCount"].sum() == 1
+    assert forward[forward["year"] == 2020]["count"].tolist() == [2]
+
+def test_rollups_of_a_rerun_are_unchanged(tmp_path):
+    '''A re-run in another order, where only one of the overlapping segments was exported again, keeps the rollup as it was.'''
+
+    files = write_segments(tmp_path)
+    first = build_rollup(tmp_path, files)
+    os.utime(files[1], ns=(os.stat(files[1]).st_atime_ns, os.stat(files[1]).st_mtime_ns + 10 ** 9))
+    second = build_rollup(tmp_path, files[::-1])
+    assert first.equals(second)
+    assert second["count"].sum() == 3
+
+def expected_rollup(frames):
+    '''Counts the cases of the segments by year and AircraftCategory, each case once.'''
+
+    cases = pandas.concat(frames).drop_duplicates("Mkey")
+    cases = cases.assign(year=pandas.to_datetime(cases["EventDate"]).dt.year, AircraftCategory=cases["AirCraftCategory"])
+    return cases.groupby(["year", "AircraftCategory"]).size().to_dict()
+
+def test_overlapping_segments_move_between_owners(tmp_path):
+    '''Events shared by segments written, rewritten and dropped in any order are counted once, and reads only sum the partials.'''
+
+    rows = {1: "1,ERA20LA001,2020-01-02,0,0,1,false,AIR,REC,SUBS\n", 2: "2,ERA20LA002,2020-03-04,1,0,0,true,AIR,TF,DEST\n",
+            3: "3,ERA21LA003,2021-05-06,0,2,0,false,HELI,TS,SUBS\n", 4: "4,ERA21LA004,2021-07-08,0,0,0,false,AIR,REC,MINR\n"}
+    segments = {"a": [1, 2], "b": [2, 3], "c": [3, 4, 1]}
+    frames = {segment: pandas.read_csv(io.StringIO(header + "".join(rows[key] for key in keys))) for segment, keys in segments.items()}
+
+    store = SAFEPy.RollupStore(str(tmp_path / "rollups.sqlite"), {"cases": ["year", "AircraftCategory"]})
+    def rollup():
+        df = store.query("dataset")
+        return {(year, category): count for year, category, count in zip(df["year"], df["AircraftCategory"], df["count"])}
+
+    for segment in ("c", "b", "a"):
+        store.update("dataset", segment, "1", frames[segment])
+    assert rollup() == expected_rollup(frames.values())
+
+    # a rewritten first segment that lost a case hands it to the next segment holding it
+    frames["a"] = frames["a"][frames["a"]["Mkey"] == 2]
+    store.update("dataset", "a", "2", frames["a"])
+    assert rollup() == expected_rollup(frames.values())
+
+    store.retain("dataset", ["b", "c"])
+    assert rollup() == expected_rollup([frames["b"], frames["c"]])
+
+    # reads never look at the events
+    with sqlite3.connect(tmp_path / "rollups.sqlite") as connection:
+        connection.execute("DELETE FROM events")
+    assert rollup() == expected_rollup([frames["b"], frames["c"]])
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import SAFEPy
+
+def test_parse_date_formats():
+    '''Common formats are parsed, anything without a digit or a month name is not a date.'''
+
+    assert SAFEPy.parse_date("2020-01-02") == datetime(2020, 1, 2)
+    assert SAFEPy.parse_date("01/02/2020") == datetime(2020, 1, 2)
+    assert SAFEPy.parse_date(" 9-23-2010 ") == datetime(2010, 9, 23)
+    assert SAFEPy.parse_date("January 2, 2020") == datetime(2020, 1, 2)
+    assert SAFEPy.parse_date("not a date") is None
+    assert SAFEPy.parse_date("engine failure 1") is None
+    assert SAFEPy.parse_date("") is None
+
+def test_compile_rules_reports_errors_as_results():
+    '''Every argument compiles to a rule or to its error, in order.'''
+
+    compiled = SAFEPy.compile_rules([("Event", "EventDate", "is on or after", "9-23-2010"), ("Event", "EventDate", "is on or after", "not a date"),
+                                     "01/02/2020", "is before 2015-06-01", "is before someday", ("Aircraft", "AircraftCategory", "is", "HELI"), ("a", "b", "c", "d", "e")],
+                                    confirm = False)
+    assert [rule.ok for rule in compiled] == [True, False, True, True, False, True, False]
+    assert (compiled[0].field, compiled[0].subfield, compiled[0].condition, compiled[0].value) == ("Event", "EventDate", "is on or after", "2010-09-23")
+    assert compiled[1].error_type == "ValueError" and "not a date" in compiled[1].error
+    assert (compiled[2].subfield, compiled[2].condition, compiled[2].value) == ("EventDate", "is on or after", "2020-01-02")
+    assert (compiled[3].condition, compiled[3].value) == ("is before", "2015-06-01")
+    assert (compiled[5].field, compiled[5].subfield, compiled[5].value) == ("Aircraft", "AircraftCategory", "HELI")
+    assert compiled[6].error_type == "MalformedQueryError"
+
+def test_compiling_a_large_catalog_is_quiet_and_cached(capsys):
+    '''Compiling thousands of date rules prints nothing, and compiling them again only hits the cache.'''
+
+    catalog = [("Event", "EventDate", condition, f"{month}/{day}/{year}") for condition in ("is on or after", "is before")
+               for year in range(2000, 2020) for month in range(1, 13) for day in (1, 15)]
+    SAFEPy.compile_rules(catalog, confirm = False)
+    assert capsys.readouterr().out == ""
+
+    hits = SAFEPy.rule_cache_info().hits
+    assert all(rule.ok for rule in SAFEPy.compile_rules(catalog, confirm = False))
+    assert SAFEPy.rule_cache_info().hits - hits == len(catalog)
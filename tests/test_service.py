@@ -0,0 +1,98 @@
+import os
+import time
+
+import pytest
+
+import SAFEPy
+
+def test_failed_probe_is_not_cached(carol, monkeypatch):
+    '''A probe that failed is sent again by the next identical query instead of being served from the probe cache.'''
+
+    monkeypatch.setattr(SAFEPy, "shared_probes", SAFEPy.SingleFlight(ttl=300))
+    monkeypatch.setattr(SAFEPy, "shared_pid", os.getpid())
+    rule = SAFEPy.query_rule("Event", "ID", "is greater than", "10")
+
+    # nothing listens on port 9 of the loopback interface
+    SAFEPy.configure_transport(probe="http://127.0.0.1:9/probe", connect_timeout=2)
+    failed = SAFEPy.build_query(rule, require_all = True, has_key_constraint = False)
+    failed.query()
+    assert failed._result_list_count is None
+
+    SAFEPy.configure_transport(probe=f"{carol.url}/probe")
+    carol.result_count = 42
+    retried = SAFEPy.build_query(rule, require_all = True, has_key_constraint = False)
+    retried.query()
+    assert retried._result_list_count == 42
+    assert len(carol.probes) == 1
+
+    # successful probes are still cached
+    cached = SAFEPy.build_query(rule, require_all = True, has_key_constraint = False)
+    cached.query()
+    assert cached._result_list_count == 42
+    assert len(carol.probes) == 1
+
+def test_service_rejects_unknown_job_arguments(tmp_path, monkeypatch):
+    '''Clients cannot pass progress, any argument query() does not take, or columns the export does not have, to a job.'''
+
+    # the service warms the probe cache of this process
+    monkeypatch.setattr(SAFEPy, "shared_probes", None)
+    monkeypatch.setattr(SAFEPy, "shared_pid", None)
+    service = SAFEPy.SAFEPyService(output_dir=str(tmp_path))
+    with pytest.raises(ValueError, match="progress"):
+        service.submit([["Event", "ID", "is greater than", "10"]], {"progress": "x"})
+    with pytest.raises(ValueError, match="bogus"):
+        service.submit([["Event", "ID", "is greater than", "10"]], {"bogus": 1})
+    with pytest.raises(ValueError, match="Valid columns"):
+        service.submit([["Event", "ID", "is greater than", "10"]], {"download": True, "columns": ["Bogus"]})
+    assert service.jobs() == []
+
+def wait_for_job(service, job):
+    '''Waits until a job of the service is finished and returns its status.'''
+
+    for _ in range(200):
+        status = service.status(job)
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"job {job} did not finish")
+
+def test_service_jobs_never_ask_for_confirmation(carol, monkeypatch):
+    '''A full sentence in a job is searched for in the Factual Narrative instead of blocking a worker thread on input().'''
+
+    monkeypatch.setattr(SAFEPy, "shared_probes", None)
+    monkeypatch.setattr(SAFEPy, "shared_pid", None)
+    monkeypatch.setattr("builtins.input", lambda prompt: pytest.fail(f"the service asked: {prompt}"))
+    service = SAFEPy.SAFEPyService()
+    carol.result_count = 3
+    status = wait_for_job(service, service.submit(["The pilot lost control of the airplane during the landing roll."]))
+    assert status["status"] == "done", status["error"]
+    assert status["result"] == 3
+    assert carol.probes[0]["QueryGroups"][0]["QueryRules"][0]["Columns"] == ["Narrative.Factual"]
+
+def test_service_confines_job_files_to_its_output_directory(tmp_path, monkeypatch):
+    '''Clients cannot make the service write files outside of its output directory.'''
+
+    monkeypatch.setattr(SAFEPy, "shared_probes", None)
+    monkeypatch.setattr(SAFEPy, "shared_pid", None)
+    service = SAFEPy.SAFEPyService(output_dir=str(tmp_path / "jobs"))
+    rule = [["Event", "ID", "is greater than", "10"]]
+    for name, path in (("aggregated_csv_file", str(tmp_path / "elsewhere.csv")), ("profile", "../profile"), ("histogram_path", "/etc/histogram.json")):
+        with pytest.raises(ValueError, match=name):
+            service.submit(rule, {"download": True, name: path})
+    assert service.confine("aggregated_csv_file", "team/cases.csv") == os.path.realpath(tmp_path / "jobs" / "team" / "cases.csv")
+    assert service.jobs() == []
+
+def test_finished_jobs_are_forgotten(carol, monkeypatch):
+    '''Finished jobs and their progress are dropped once their retention window has passed.'''
+
+    monkeypatch.setattr(SAFEPy, "shared_probes", None)
+    monkeypatch.setattr(SAFEPy, "shared_pid", None)
+    service = SAFEPy.SAFEPyService(job_retention_seconds=0.5)
+    job = service.submit([["Event", "ID", "is greater than", "10"]])
+    assert wait_for_job(service, job)["status"] == "done"
+    assert service.status(job) is not None
+
+    time.sleep(0.6)
+    assert service.jobs() == []
+    assert service.status(job) is None
+    assert service._in_flight == {} and service._progress == {}
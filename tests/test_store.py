@@ -0,0 +1,116 @@
+import hashlib
+import io
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+
+import pandas
+
+import SAFEPy
+
+def zipped(rows):
+    '''Returns the bytes of a zipped export holding the given CSV content.'''
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_file:
+        zip_file.writestr("cases.csv", rows)
+    return buffer.getvalue()
+
+def test_request_hash_ignores_rule_order():
+    '''The same rules in a different order are the same request.'''
+
+    rules = (SAFEPy.query_rule("Aircraft", "AircraftCategory", "is", "AIR"), SAFEPy.query_rule("Event", "ID", "is greater than", "10"))
+    first = SAFEPy.build_query(*rules, require_all = True, has_key_constraint = True)
+    second = SAFEPy.build_query(*reversed(rules), require_all = True, has_key_constraint = True)
+    other = SAFEPy.build_query(*rules[:1], require_all = True, has_key_constraint = False)
+    assert first.request_hash() == second.request_hash()
+    assert first.request_hash()[0] != other.request_hash()[0]
+
+def test_manifest_records_the_export(tmp_path):
+    '''A stored export is sharded under its hash and the manifest records its rows, size and content hash.'''
+
+    store = SAFEPy.ExportStore(str(tmp_path))
+    rows = "Mkey,NtsbNo\n1,ERA20LA001\n2,ERA20LA002\n"
+    content = zipped(rows)
+    request_hash = hashlib.sha256(b"request").hexdigest()
+    file = store.put(request_hash, "request", [content[:10], content[10:]], "cases", "etag", "probe")
+
+    assert file == os.path.abspath(tmp_path / request_hash[:2] / request_hash[2:4] / f"{request_hash}.zip")
+    entry = store.get(request_hash)
+    assert entry["row_count"] == 2
+    assert entry["size"] == len(content)
+    assert entry["content_hash"] == hashlib.sha256(rows.encode()).hexdigest()
+    assert (entry["etag"], entry["probe_hash"]) == ("etag", "probe")
+
+    store.forget(request_hash)
+    assert store.get(request_hash) is None
+
+def test_markers_keep_one_download_per_export(tmp_path):
+    '''Only one download holds the marker of an export, and the marker of a process that exited is taken over.'''
+
+    store = SAFEPy.ExportStore(str(tmp_path))
+    request_hash = hashlib.sha256(b"request").hexdigest()
+    assert store.acquire(request_hash)
+    assert not store.acquire(request_hash)
+    store.release(request_hash)
+    assert store.acquire(request_hash)
+    store.release(request_hash)
+
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    with open(store._marker(request_hash), 'w') as marker:
+        marker.write(f"{socket.gethostname()} {finished.pid}")
+    assert store.acquire(request_hash)
+
+def test_changed_export_is_downloaded_again(carol):
+    '''A stored export is only reused while it holds as many cases as the query matches now.'''
+
+    rules = ("Aircraft", "AircraftCategory", "is", "BLIM")
+    SAFEPy.query(rules, download = True, histogram_path = None)
+    SAFEPy.query(rules, download = True, histogram_path = None)
+    assert len(carol.exports) == 1
+
+    carol.result_count = 2
+    carol.rows = "Mkey,NtsbNo\n1,ERA20LA001\n2,ERA20LA002\n"
+    aggregated_csv_file = SAFEPy.query(rules, download = True, histogram_path = None)
+    assert len(carol.exports) == 2
+    assert len(pandas.read_csv(aggregated_csv_file)) == 2
+
+def test_download_waits_until_it_holds_the_marker(carol, monkeypatch):
+    '''A download that loses the marker to another job again after waiting keeps waiting instead of downloading alongside it.'''
+
+    acquired = []
+    acquire = SAFEPy.ExportStore.acquire
+    def contended_acquire(store, request_hash):
+        acquired.append(len(acquired) >= 2 and acquire(store, request_hash))
+        return acquired[-1]
+    monkeypatch.setattr(SAFEPy.ExportStore, "acquire", contended_acquire)
+
+    q = SAFEPy.build_query(SAFEPy.query_rule("Aircraft", "AircraftCategory", "is", "BLIM"), require_all = True)
+    q.download()
+    assert acquired == [False, False, True]
+    assert len(carol.exports) == 1
+    assert not os.path.exists(SAFEPy.ExportStore(SAFEPy.export_store_path)._marker(q.request_hash()[0]))
+
+def test_download_uses_the_export_of_the_job_it_waited_for(carol):
+    '''A download that finds the marker held uses the export the other job stored instead of downloading it again.'''
+
+    q = SAFEPy.build_query(SAFEPy.query_rule("Aircraft", "AircraftCategory", "is", "BLIM"), require_all = True)
+    store = SAFEPy.ExportStore(SAFEPy.export_store_path)
+    request_hash, request = q.request_hash()
+    assert store.acquire(request_hash)
+
+    def finish_download():
+        time.sleep(0.5)
+        store.put(request_hash, request, [zipped(carol.rows)], "cases", None, None)
+        store.release(request_hash)
+    other = threading.Thread(target=finish_download)
+    other.start()
+    q.download(expected_count = 1)
+    other.join()
+    assert carol.exports == []
+    assert q._csv_file == store.get(request_hash)["file"]
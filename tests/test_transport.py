@@ -0,0 +1,40 @@
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import SAFEPy
+
+def test_prefetched_segments_are_exported_once(carol):
+    '''Every segment is exported exactly once, whether its worker or a prefetch downloads it.'''
+
+    carol.probe_seconds = 0.1
+    carol.export_seconds = 0.05
+    segments = [(SAFEPy.query_rule("Event", "ID", "is greater than", str(lower)), SAFEPy.query_rule("Event", "ID", "is less than", str(lower + 401)))
+                for lower in range(0, 6000, 400)]
+    kwargs = dict(download = True, only_download = False, require_all = True, has_key_constraint = True)
+
+    # the tasks of query(), where every worker prefetches the segment it is likely to be handed next
+    workers = 3
+    tasks = [(index, segments[index], segments[index + workers] if index + workers < len(segments) else None) for index in range(len(segments))]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda task: SAFEPy.submit_segment(task, **kwargs), tasks))
+
+    assert all(csv_file is not None for _, _, csv_file in results)
+    exports = Counter(json.dumps(body["QueryGroups"], sort_keys=True) for body in carol.exports)
+    assert len(exports) == len(segments)
+    assert set(exports.values()) == {1}
+
+def test_export_finished_after_the_probe_is_not_exported_again(carol):
+    '''A worker whose segment was exported by a prefetch while the worker was probing it uses the stored export.'''
+
+    rules = (SAFEPy.query_rule("Event", "ID", "is greater than", "10"),)
+    owner = SAFEPy.build_query(*rules, require_all = True, has_key_constraint = True)
+    owner.query(download = True)
+
+    # the prefetch of the same segment finishes while the owner is between its probe and its export
+    SAFEPy.submit_query(*rules, download = True, only_download = True, require_all = True, has_key_constraint = True)
+    assert len(carol.exports) == 1
+
+    owner.download()
+    assert len(carol.exports) == 1
+    assert owner._csv_file is not None
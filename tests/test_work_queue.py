@@ -0,0 +1,29 @@
+import os
+import shutil
+import sqlite3
+
+import pandas as pd
+
+import SAFEPy
+
+def test_merge_on_another_host(carol, tmp_path):
+    '''Segment files are recorded relative to the shared store, so a host that mounts the share elsewhere can merge them.'''
+
+    carol.result_count = 2
+    carol.rows = "Mkey,NtsbNo\n1,ERA20LA001\n2,ERA20LA002\n"
+    queue_path = str(tmp_path / "share" / "queue.sqlite")
+    job = SAFEPy.coordinate(("Event", "ID", "is greater than", "10"), queue_path = queue_path, histogram_path = None)
+    assert SAFEPy.work(queue_path = queue_path, job = job, wait = False) == 1
+
+    with sqlite3.connect(queue_path) as connection:
+        (csv_file,), = connection.execute("SELECT csv_file FROM segments WHERE job = ?", (job,)).fetchall()
+    assert not os.path.isabs(csv_file)
+    assert os.path.exists(tmp_path / "share" / "store" / csv_file)
+
+    # the coordinator mounts the share somewhere else, with a different working directory
+    shutil.copytree(tmp_path / "share", tmp_path / "mnt" / "share")
+    os.makedirs(tmp_path / "coordinator")
+    os.chdir(tmp_path / "coordinator")
+    aggregated = str(tmp_path / "coordinator" / "aggregated.csv")
+    SAFEPy.merge(job, queue_path = str(tmp_path / "mnt" / "share" / "queue.sqlite"), aggregated_csv_file = aggregated)
+    assert list(pd.read_csv(aggregated)["Mkey"]) == [1, 2]